@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Compares StringCleaner with the previous clean_string that called re.sub three times on
+every string. The corpus is the org and region names (and codes) in data with the org
+names repeated as they would be across activities.
+
+    python -m benchmarks.bench_clean_string --repeats 200
+"""
+import argparse
+import logging
+import re
+from os.path import join
+from time import perf_counter
+
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_json
+
+from iati.stringcleaner import StringCleaner
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_clean_string(s):
+    """ clean_string before StringCleaner (kept for comparison) """
+    s = re.sub(r'(\W)\1+', r'\1', s.strip())
+    s = re.sub(r'\s', ' ', s)
+    s = re.sub(r'^\W?([\w &]*)[^a-zA-Z0-9_\.]?$', r'\1', s)
+    return s.strip()
+
+
+def get_corpus(data_dir):
+    corpus = list()
+    for filename in ('IATIOrganisationIdentifier.json', 'Region.json'):
+        for entry in load_json(join(data_dir, filename))['data']:
+            corpus.append(entry['code'])
+            corpus.append(entry['name'])
+    return corpus
+
+
+def time_cleaner(clean, corpus, repeats):
+    start_time = perf_counter()
+    for _ in range(repeats):
+        for s in corpus:
+            clean(s)
+    return perf_counter() - start_time
+
+
+def main(repeats, data_dir):
+    corpus = get_corpus(data_dir)
+    no_strings = len(corpus) * repeats
+    results = dict()
+    StringCleaner.setup()
+    for name, clean in (('legacy', legacy_clean_string), ('regexes only', StringCleaner.clean_with_regexes),
+                        ('StringCleaner', StringCleaner.clean)):
+        duration = time_cleaner(clean, corpus, repeats)
+        results[name] = duration
+        logger.info(f'{name}: {duration:.3f}s ({no_strings / duration:.0f} strings/sec)')
+    logger.info(f'StringCleaner memo had {StringCleaner.hits} hits and {StringCleaner.misses} misses')
+    logger.info(f'Speedup: {results["legacy"] / results["StringCleaner"]:.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='clean_string micro-benchmark')
+    parser.add_argument('-r', '--repeats', default=200, type=int, help='Number of times to clean the corpus')
+    parser.add_argument('-d', '--data_dir', default='data', help='Folder with org and region data')
+    args = parser.parse_args()
+    main(args.repeats, args.data_dir)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the memory held per activity once the activities in the test fixture pages have
+been constructed. "before" keeps each diterator activity and its transactions alive
+alongside the Activity as the Activity and Transaction classes did before they copied out
+the fields they need, "after" keeps only the Activity objects.
+
+    python -m benchmarks.bench_memory --repeats 3
+"""
+import argparse
+import gc
+import logging
+import tracemalloc
+from glob import glob
+from os.path import join
+
+import diterator
+from hdx.location.country import Country
+from hdx.location.currency import Currency
+from hdx.utilities.downloader import Download
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_file_to_str, load_yaml
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+
+from iati.activity import Activity
+from iati.calculatesplits import CalculateSplits
+from iati.dportal import iterate_activities
+from iati.fxrates import FXRates
+from iati.lookups import Lookups
+from iati.processingcontext import ProcessingContext
+from iati.topicmatcher import TopicMatcher
+
+logger = logging.getLogger(__name__)
+
+
+def setup(configuration_path, config_dir, fixtures_dir, retriever):
+    configuration = load_yaml(configuration_path)
+    lookups_configuration = configuration['lookups']
+    # Use the filter files in the test config folder rather than downloading them
+    del lookups_configuration['filters_url']
+    del lookups_configuration['blocklist_url']
+    lookups_configuration['filters_file'] = join(config_dir, 'IATI Explorer Filters - Skipped Activities.csv')
+    lookups_configuration['blocklist_file'] = join(config_dir, 'IATI Explorer Filters - Spurious References.csv')
+    TopicMatcher.setup(configuration['topics'])
+    Lookups.checks = TopicMatcher.get('covid')
+    Lookups.filter_transaction_date = '2020-01'
+    Lookups.setup(lookups_configuration)
+    Country.countriesdata(use_live=False)
+    Currency.setup(retriever=retriever, fallback_historic_to_current=True, fallback_current_to_static=True)
+    FXRates.setup(retriever)
+    CalculateSplits.setup(configuration['calculate_splits'])
+    # The last page is D-Portal's empty JSON response that ends paging
+    paths = [path for path in sorted(glob(join(fixtures_dir, 'dportal_*.xml')))
+             if '<iati-activity' in load_file_to_str(path)]
+    Lookups.build_org_lookup(iterate_activities(paths))
+    Lookups.setup_org_info_cache()
+    return {'transaction_type_info': configuration['transaction_type_info']}, paths
+
+
+def iterate_retained_activities(paths):
+    # iterate_activities releases the elements of each activity so can't be used to retain them
+    for path in paths:
+        with open(path, 'rb') as page:
+            yield from diterator.XMLIterator(page)
+
+
+def build_activities(configuration, paths, keep_dactivities):
+    retained = list()
+    context = ProcessingContext.get()
+    if keep_dactivities:
+        dactivities = iterate_retained_activities(paths)
+    else:
+        dactivities = iterate_activities(paths)
+    for dactivity in dactivities:
+        activity, _ = Activity.get_activity(configuration, dactivity, context)
+        if activity is None:
+            continue
+        if keep_dactivities:
+            retained.append((activity, dactivity, dactivity.transactions))
+        else:
+            retained.append(activity)
+    return retained
+
+
+def measure(configuration, paths, keep_dactivities):
+    # Build once beforehand so that memos and caches are warm and not counted
+    build_activities(configuration, paths, keep_dactivities)
+    gc.collect()
+    tracemalloc.start()
+    retained = build_activities(configuration, paths, keep_dactivities)
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(retained), peak / len(retained), len(retained)
+
+
+def main(repeats, configuration_path, config_dir, fixtures_dir):
+    results = dict()
+    with temp_dir('bench_memory') as tempdir:
+        with Download(user_agent='bench') as downloader:
+            retriever = Retrieve(downloader, tempdir, fixtures_dir, tempdir, save=False, use_saved=True)
+            configuration, paths = setup(configuration_path, config_dir, fixtures_dir, retriever)
+            for name, keep_dactivities in (('before', True), ('after', False)):
+                measurements = [measure(configuration, paths, keep_dactivities) for _ in range(repeats)]
+                per_activity, peak_per_activity, no_activities = min(measurements)
+                results[name] = per_activity
+                logger.info(f'{name}: {per_activity:.0f} bytes/activity retained, '
+                            f'{peak_per_activity:.0f} bytes/activity peak ({no_activities} activities)')
+    logger.info(f'Reduction: {results["before"] / results["after"]:.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Activity memory benchmark')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-c', '--configuration', default=join('tests', 'config', 'project_configuration.yml'),
+                        help='Project configuration to take lookups configuration from')
+    parser.add_argument('-cd', '--config_dir', default=join('tests', 'config'), help='Folder with filter files')
+    parser.add_argument('-f', '--fixtures_dir', default=join('tests', 'fixtures'), help='Folder with D-Portal pages')
+    args = parser.parse_args()
+    main(args.repeats, args.configuration, args.config_dir, args.fixtures_dir)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the D-Portal pages in a folder (eg. the fixtures or a synthetic corpus) saved as files
+(as --save did before page stores) against page stores compressed with gzip and zstd: bytes on
+disk, seconds to import the files and seconds to replay all of the pages and one page from the
+middle (as --use_saved and --replay_pages do). Pages saved as files are used where they are so
+replaying them takes no time. Replayed pages must be the same as the files.
+
+    python -m benchmarks.bench_pagestore --pages_dir corpus
+"""
+import argparse
+import logging
+from glob import glob
+from os import makedirs
+from os.path import basename, getsize, join
+from shutil import copyfile, rmtree
+from time import perf_counter
+
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.path import temp_dir
+
+from iati.dportal import has_activities, replay_saved_pages
+from iati.pagestore import PageStore
+
+logger = logging.getLogger(__name__)
+
+dportal_configuration = {'filename': 'dportal_{}.xml'}
+
+
+def get_saved_pages(pages_dir):
+    """ Get the numbers of the pages with activities in pages_dir """
+    pages = list()
+    n = 0
+    while True:
+        path = join(pages_dir, dportal_configuration['filename'].format(n))
+        if not has_activities(path):
+            return pages
+        pages.append(n)
+        n += 1
+
+
+def replay(saved_dir, folder, replay_pages=None):
+    """ Replay saved pages into folder returning the seconds taken and their contents """
+    start_time = perf_counter()
+    paths = list(replay_saved_pages(dportal_configuration, saved_dir, folder, replay_pages))
+    seconds = perf_counter() - start_time
+    contents = list()
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return seconds, contents
+
+
+def main(repeats, pages_dir):
+    pages = get_saved_pages(pages_dir)
+    middle = {pages[len(pages) // 2]}
+    results = dict()
+    with temp_dir('bench_pagestore') as tempdir:
+        folder = join(tempdir, 'pages')
+        makedirs(folder)
+        files_seconds, expected = replay(pages_dir, folder, set(pages))
+        files_size = sum(getsize(join(pages_dir, dportal_configuration['filename'].format(n))) for n in pages)
+        results['files'] = {'bytes': files_size, 'import': 0, 'replay': files_seconds,
+                            'replay one': min(replay(pages_dir, folder, middle)[0] for _ in range(repeats))}
+        for compression in ('gzip', 'zstd'):
+            saved_dir = join(tempdir, compression)
+            import_seconds = list()
+            for _ in range(repeats):
+                rmtree(saved_dir, ignore_errors=True)
+                makedirs(saved_dir)
+                for path in glob(join(pages_dir, 'dportal_*.xml')):
+                    copyfile(path, join(saved_dir, basename(path)))
+                start_time = perf_counter()
+                PageStore.import_folder(saved_dir, compression=compression, delete=True)
+                import_seconds.append(perf_counter() - start_time)
+            replays = [replay(saved_dir, folder) for _ in range(repeats)]
+            if any(contents != expected for _, contents in replays):
+                raise ValueError(f'Pages replayed from {compression} page store are not the same!')
+            results[compression] = {'bytes': getsize(join(saved_dir, PageStore.data_filename)) +
+                                    getsize(join(saved_dir, PageStore.index_filename)),
+                                    'import': min(import_seconds), 'replay': min(seconds for seconds, _ in replays),
+                                    'replay one': min(replay(saved_dir, folder, middle)[0] for _ in range(repeats))}
+    for name, result in results.items():
+        logger.info(f'{name}: {result["bytes"]} bytes ({files_size / result["bytes"]:.1f}x smaller than files), '
+                    f'imported in {result["import"]:.3f}s, replayed {len(pages)} pages in {result["replay"]:.3f}s '
+                    f'and one in {result["replay one"]:.4f}s')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Saved data page store benchmark')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-p', '--pages_dir', default=join('tests', 'fixtures'),
+                        help='Folder with D-Portal pages (eg. the fixtures or a synthetic corpus)')
+    args = parser.parse_args()
+    main(args.repeats, args.pages_dir)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the peak memory per page of retrieving and parsing the test fixture pages served
+over HTTP from a local stand-in for D-Portal. "before" retrieves each page as text, scans
+it for activities, writes it to a file and parses it as start did before pages were
+streamed, "after" streams each page to a file, checks it has activities by parsing as far
+as the first one and parses it releasing each activity's elements once it has been used.
+
+    python -m benchmarks.bench_parse --repeats 3
+"""
+import argparse
+import gc
+import logging
+import tracemalloc
+from functools import partial
+from glob import glob
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os.path import basename, join
+from threading import Thread
+
+import diterator
+from hdx.utilities.downloader import Download
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_str_to_file
+
+from iati.dportal import has_activities, iterate_activities, retrieve_dportal_page
+
+logger = logging.getLogger(__name__)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def use_activities(dactivities):
+    no_activities = 0
+    for dactivity in dactivities:
+        if dactivity.identifier:
+            no_activities += len(dactivity.transactions)
+        no_activities += 1
+    return no_activities
+
+
+def parse_before(retriever, url, filename, folder):
+    text = retriever.retrieve_text(url, filename, 'D-Portal activities', False)
+    if '<iati-activity' not in text:
+        return 0
+    path = join(folder, filename)
+    save_str_to_file(text, path)
+    with open(path, 'rb') as page:
+        return use_activities(diterator.XMLIterator(page))
+
+
+def parse_after(retriever, url, filename, folder):
+    path = retrieve_dportal_page(retriever, url, filename, folder)
+    if not has_activities(path):
+        return 0
+    return use_activities(iterate_activities([path]))
+
+
+def measure(parse, retriever, url, filename, folder):
+    gc.collect()
+    tracemalloc.start()
+    parse(retriever, url, filename, folder)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(repeats, fixtures_dir):
+    filenames = [basename(path) for path in sorted(glob(join(fixtures_dir, 'dportal_*.xml')))]
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=fixtures_dir))
+    Thread(target=server.serve_forever, daemon=True).start()
+    results = dict()
+    try:
+        with temp_dir('bench_parse') as tempdir:
+            with Download(user_agent='bench') as downloader:
+                retriever = Retrieve(downloader, tempdir, tempdir, tempdir, save=False, use_saved=False)
+                for name, parse in (('before', parse_before), ('after', parse_after)):
+                    peaks = list()
+                    for filename in filenames:
+                        url = f'http://127.0.0.1:{server.server_port}/{filename}'
+                        peak = min(measure(parse, retriever, url, filename, tempdir) for _ in range(repeats))
+                        peaks.append(peak)
+                        logger.info(f'{name} {filename}: {peak / 1024:.0f}KB peak')
+                    results[name] = max(peaks)
+                    logger.info(f'{name}: {results[name] / 1024:.0f}KB largest peak per page')
+    finally:
+        server.shutdown()
+        server.server_close()
+    logger.info(f'Reduction: {results["before"] / results["after"]:.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Page retrieval and parsing memory benchmark')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-f', '--fixtures_dir', default=join('tests', 'fixtures'), help='Folder with D-Portal pages')
+    args = parser.parse_args()
+    main(args.repeats, args.fixtures_dir)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the time to retrieve and parse the D-Portal pages in a folder (eg. the fixtures or a
+synthetic corpus) served by a local stand-in for D-Portal that takes latency seconds to answer,
+takes slow seconds for every slow_every-th page and fails the first request for every
+fail_every-th page with a 503. "blocking" downloads a page at a time with Download as start
+did before, "threads" uses a pool of workers threads each with its own Download and "async"
+uses an AsyncRetrieve. Pages are parsed as they arrive, as in the first pass of a run, and
+all must give the same activities.
+
+    python -m benchmarks.bench_retrieve --pages_dir corpus --latency 0.05
+"""
+import argparse
+import logging
+import re
+from functools import partial
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from threading import Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
+
+from hdx.utilities.downloader import Download
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+
+from iati.asyncretriever import AsyncDownload, AsyncRetrieve
+from iati.dportal import iterate_activities, retrieve_dportal
+from iati.topicmatcher import TopicMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class SlowDPortalHandler(BaseHTTPRequestHandler):
+    """ Serves the pages in pages_dir as a stand-in for D-Portal over keep-alive connections, using the OFFSET in
+    the sql query to pick the page, with the latency, slow pages and failures described above
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, pages=None, limit=None, latency=0, slow=0, slow_every=0, fail_every=0, failed=None,
+                 **kwargs):
+        self.pages = pages
+        self.limit = limit
+        self.latency = latency
+        self.slow = slow
+        self.slow_every = slow_every
+        self.fail_every = fail_every
+        self.failed = failed
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        sql = parse_qs(urlsplit(self.path).query)['sql'][0]
+        n = min(int(re.search(r'OFFSET (\d+)', sql).group(1)) // self.limit, len(self.pages) - 1)
+        if self.slow_every and n % self.slow_every == self.slow_every - 1:
+            sleep(self.slow)
+        else:
+            sleep(self.latency)
+        if self.fail_every and n % self.fail_every == self.fail_every - 1 and n not in self.failed:
+            self.failed.add(n)
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.pages[n]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Pages beyond the last one are given up on once the last one has arrived
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_pages(pages_dir):
+    # The pages are ordered by number. The last page is D-Portal's empty JSON response that ends paging.
+    paths = glob(join(pages_dir, 'dportal_*.xml'))
+    pages = list()
+    for path in sorted(paths, key=lambda x: int(re.search(r'dportal_(\d+)\.xml', x).group(1))):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def retrieve_and_parse(configuration, retriever, folder):
+    """ Retrieve and parse the pages returning the seconds taken and the identifiers of the activities """
+    start_time = perf_counter()
+    identifiers = [dactivity.identifier for dactivity in
+                   iterate_activities(retrieve_dportal(configuration, retriever, None, 'covid', folder))]
+    return perf_counter() - start_time, identifiers
+
+
+def main(repeats, configuration_path, pages_dir, latency, slow, slow_every, fail_every, workers):
+    configuration = load_yaml(configuration_path)
+    TopicMatcher.setup(configuration['topics'])
+    pages = load_pages(pages_dir)
+    failed = set()
+    handler = partial(SlowDPortalHandler, pages=pages, limit=configuration['dportal']['limit'], latency=latency,
+                      slow=slow, slow_every=slow_every, fail_every=fail_every, failed=failed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    dportal_configuration = dict(configuration['dportal'])
+    dportal_configuration['url'] = f'http://127.0.0.1:{server.server_port}/dquery?form=xml&sql=%s'
+    dportal_configuration.pop('shards', None)
+    max_in_flight = dportal_configuration.get('max_in_flight', 2 * workers)
+    logger.info(f'Retrieving {len(pages) - 1} pages with {latency}s latency, {slow}s every {slow_every} pages and '
+                f'{max_in_flight} pages in flight')
+    versions = {'blocking': 1, 'threads': workers, 'async': 1}
+    timings = {name: list() for name in versions}
+    all_identifiers = dict()
+    try:
+        with temp_dir('bench_retrieve') as tempdir:
+            with Download(user_agent='bench') as downloader, \
+                    AsyncDownload(user_agent='bench', limit_per_host=workers) as async_downloader:
+                retrievers = {'blocking': Retrieve(downloader, tempdir, tempdir, tempdir),
+                              'threads': Retrieve(downloader, tempdir, tempdir, tempdir),
+                              'async': AsyncRetrieve(async_downloader, tempdir, tempdir, tempdir)}
+                # Alternate so that all are affected alike by anything else running
+                for _ in range(repeats):
+                    for name, version_workers in versions.items():
+                        failed.clear()
+                        version_configuration = {'dportal': dict(dportal_configuration, workers=version_workers)}
+                        seconds, all_identifiers[name] = retrieve_and_parse(version_configuration, retrievers[name],
+                                                                            tempdir)
+                        timings[name].append(seconds)
+    finally:
+        server.shutdown()
+        server.server_close()
+    if any(identifiers != all_identifiers['blocking'] for identifiers in all_identifiers.values()):
+        raise ValueError('Activities do not agree!')
+    results = {name: min(seconds) for name, seconds in timings.items()}
+    for name, seconds in results.items():
+        logger.info(f'{name}: {seconds:.2f}s for {len(all_identifiers[name])} activities '
+                    f'({results["blocking"] / seconds:.2f}x blocking)')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Page retrieval benchmark')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-c', '--configuration', default=join('config', 'project_configuration.yml'),
+                        help='Project configuration to take dportal configuration from')
+    parser.add_argument('-p', '--pages_dir', default=join('tests', 'fixtures'),
+                        help='Folder with D-Portal pages (eg. the fixtures or a synthetic corpus)')
+    parser.add_argument('-l', '--latency', default=0.05, type=float, help='Seconds to answer each request')
+    parser.add_argument('-s', '--slow', default=1.0, type=float, help='Seconds to answer a slow page')
+    parser.add_argument('-se', '--slow_every', default=10, type=int, help='Make every nth page slow (0 for none)')
+    parser.add_argument('-fe', '--fail_every', default=5, type=int,
+                        help='Fail the first request for every nth page (0 for none)')
+    parser.add_argument('-w', '--workers', default=4, type=int, help='Number of threads or connections per host')
+    args = parser.parse_args()
+    main(args.repeats, args.configuration, args.pages_dir, args.latency, args.slow, args.slow_every,
+         args.fail_every, args.workers)
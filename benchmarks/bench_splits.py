@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the cost per transaction of making country or region and sector splits and resolving them
+to output names as before (every transaction's splits made from its diterator transaction's XPath
+queries, names looked up through Country and the sector info and splits looked up by their contents
+for every transaction) against now (transactions without splits of their own sharing their
+activity's, splits made from one scan of the DOM children, names from tables made at setup and
+splits looked up once per activity). Both must give the same splits.
+
+    python -m benchmarks.bench_splits --pages_dir corpus --repeats 5
+"""
+import argparse
+import logging
+from collections import namedtuple
+from glob import glob
+from os.path import join
+from time import perf_counter
+
+import diterator
+from hdx.location.country import Country
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_file_to_str, load_yaml
+
+from iati.calculatesplits import CalculateSplits
+from iati.lookups import Lookups
+from iati.transactioncolumns import TransactionColumns
+
+logger = logging.getLogger(__name__)
+
+TransactionSplits = namedtuple('TransactionSplits', ('country_splits', 'sector_splits'))
+
+
+class LegacyCalculateSplits(CalculateSplits):
+    """ Splits as they were made from diterator's XPath queries before make_transaction_splits (kept for
+    comparison)
+    """
+    @classmethod
+    def make_country_or_region_splits(cls, entity, default_splits=None):
+        splits = {}
+        for country in entity.recipient_countries:
+            code = country.code
+            if code:
+                splits[code.upper()] = float(country.percentage if country.percentage else 100.0) / 100.0
+        for region in entity.recipient_regions:
+            if region.vocabulary != '1':
+                continue
+            code = region.code
+            if code:
+                splits[code.upper()] = float(region.percentage if region.percentage else 100.0) / 100.0
+        if splits:
+            return splits
+        elif default_splits is not None:
+            return default_splits
+        else:
+            return {cls.default_country_region: 1.0}
+
+    @classmethod
+    def make_sector_splits(cls, entity, default_splits=None, default_sector=None):
+        splits = {}
+        sectors = entity.sectors
+        if '2' in [sector.vocabulary for sector in sectors]:
+            vocabulary_code = '2'
+        else:
+            vocabulary_code = '1'
+        for sector in sectors:
+            code = sector.code
+            if sector.vocabulary == vocabulary_code and code:
+                splits[code.upper()] = float(sector.percentage if sector.percentage else 100.0) / 100.0
+        if splits:
+            return splits
+        elif default_splits is not None:
+            return default_splits
+        else:
+            if default_sector is None:
+                return {cls.default_sector: 1.0}
+            return {default_sector: 1.0}
+
+    @classmethod
+    def make_activity_splits(cls, dactivity):
+        return cls.make_country_or_region_splits(dactivity), cls.make_sector_splits(dactivity)
+
+    @classmethod
+    def make_transaction_splits(cls, dtransaction, activity_country_splits, activity_sector_splits):
+        return (cls.make_country_or_region_splits(dtransaction, activity_country_splits),
+                cls.make_sector_splits(dtransaction, activity_sector_splits))
+
+
+def legacy_get_sector_group_name(code):
+    code = code[:3]
+    if code in Lookups.sector_info:
+        return Lookups.sector_info.get(code)['dac-group']
+    else:
+        return Lookups.default_sector
+
+
+def legacy_get_country_region_name(code):
+    countryname = Country.get_country_name_from_iso2(code, shortname=True)
+    if countryname:
+        return countryname
+    regionname = Lookups.region_code_to_name.get(code)
+    if regionname:
+        return f'{regionname} (no country specified)'
+    return Lookups.default_country_region
+
+
+class LegacyTransactionColumns(TransactionColumns):
+    """ Splits as they were looked up before the name tables and get_activity_splits (kept for comparison) """
+    def get_splits(self, country_splits, sector_splits):
+        key = tuple(country_splits.items()), tuple(sector_splits.items())
+        splits = self.splits_memo.get(key)
+        if splits is None:
+            splits = list()
+            for country, country_percentage in country_splits.items():
+                country_code = self.get_code('country', legacy_get_country_region_name(country))
+                for sector, sector_percentage in sector_splits.items():
+                    sector_code = self.get_code('sector', legacy_get_sector_group_name(sector))
+                    splits.append((country_code, country_percentage, sector_code, sector_percentage))
+            self.splits_memo[key] = splits
+        return splits
+
+    def get_activity_splits(self, transactions):
+        for transaction in transactions:
+            yield self.get_splits(transaction.country_splits, transaction.sector_splits)
+
+
+def setup(configuration_path):
+    Country.countriesdata(use_live=False)
+    lookups_configuration = load_yaml(configuration_path)['lookups']
+    snapshot = Lookups.prepare_snapshot(lookups_configuration)
+    Lookups.sector_info = snapshot['sector_info']
+    Lookups.region_code_to_name = snapshot['region_code_to_name']
+    Lookups.default_sector = lookups_configuration['default_sector']
+    Lookups.default_country_region = lookups_configuration['default_country_region']
+    start_time = perf_counter()
+    Lookups.setup_split_names()
+    logger.info(f'Made split name tables in {perf_counter() - start_time:.3f}s')
+    CalculateSplits.setup(load_yaml(configuration_path)['calculate_splits'])
+
+
+def load_activities(pages_dir):
+    # The elements of the activities are kept so they can be split repeatedly. The last page is D-Portal's empty
+    # JSON response that ends paging.
+    activities = list()
+    for path in sorted(glob(join(pages_dir, 'dportal_*.xml'))):
+        if '<iati-activity' not in load_file_to_str(path):
+            continue
+        with open(path, 'rb') as page:
+            for dactivity in diterator.XMLIterator(page):
+                activities.append((dactivity, dactivity.transactions))
+    return activities
+
+
+def split(calculate_splits, columns, activities):
+    """ Make and resolve the splits of the transactions of activities returning the seconds taken
+    by each and the resolved splits
+    """
+    start_time = perf_counter()
+    all_transactions = list()
+    for dactivity, dtransactions in activities:
+        country_splits, sector_splits = calculate_splits.make_activity_splits(dactivity)
+        all_transactions.append([TransactionSplits(*calculate_splits.make_transaction_splits(
+            dtransaction, country_splits, sector_splits)) for dtransaction in dtransactions])
+    make_seconds = perf_counter() - start_time
+    start_time = perf_counter()
+    resolved = [list(columns.get_activity_splits(transactions)) for transactions in all_transactions]
+    return make_seconds, perf_counter() - start_time, resolved
+
+
+def main(repeats, configuration_path, pages_dir):
+    setup(configuration_path)
+    activities = load_activities(pages_dir)
+    no_transactions = sum(len(dtransactions) for _, dtransactions in activities)
+    logger.info(f'Splitting {no_transactions} transactions of {len(activities)} activities')
+    versions = {'before': (LegacyCalculateSplits, LegacyTransactionColumns),
+                'after': (CalculateSplits, TransactionColumns)}
+    timings = {name: {'make': list(), 'resolve': list()} for name in versions}
+    resolved = dict()
+    # Alternate so that both are affected alike by anything else running
+    for _ in range(repeats):
+        for name, (calculate_splits, columns_class) in versions.items():
+            make_seconds, resolve_seconds, resolved[name] = split(calculate_splits, columns_class(), activities)
+            timings[name]['make'].append(make_seconds)
+            timings[name]['resolve'].append(resolve_seconds)
+    if resolved['before'] != resolved['after']:
+        raise ValueError('Splits do not agree!')
+    results = dict()
+    for name, stage_timings in timings.items():
+        results[name] = {stage: min(seconds) / no_transactions for stage, seconds in stage_timings.items()}
+        logger.info(f'{name}: {results[name]["make"] * 1E6:.2f}us/transaction making splits, '
+                    f'{results[name]["resolve"] * 1E6:.2f}us/transaction resolving them')
+    before = sum(results['before'].values())
+    after = sum(results['after'].values())
+    logger.info(f'Total: {before * 1E6:.2f}us/transaction before, {after * 1E6:.2f}us/transaction after '
+                f'({before / after:.2f}x)')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Transaction splits benchmark')
+    parser.add_argument('-r', '--repeats', default=5, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-c', '--configuration', default=join('config', 'project_configuration.yml'),
+                        help='Project configuration to take lookups configuration from')
+    parser.add_argument('-p', '--pages_dir', default=join('tests', 'fixtures'),
+                        help='Folder with D-Portal pages (eg. the fixtures or a synthetic corpus)')
+    args = parser.parse_args()
+    main(args.repeats, args.configuration, args.pages_dir)
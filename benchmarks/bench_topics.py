@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the cost per activity of the topic checks as hand-written classes (as before
+TopicMatcher) against the TopicMatcher compiled from the configuration. The fields that the
+checks look at are copied out of the activities in the D-Portal pages beforehand so that only
+the checks of each activity and its transactions are timed. Both must agree on every activity.
+
+    python -m benchmarks.bench_topics --repeats 20
+"""
+import argparse
+import logging
+from collections import namedtuple
+from glob import glob
+from os.path import join
+from time import perf_counter
+
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_file_to_str, load_yaml
+
+from iati.dportal import iterate_activities
+from iati.topicmatcher import TopicMatcher
+
+logger = logging.getLogger(__name__)
+
+Scope = namedtuple('Scope', ('type', 'vocabulary', 'code'))
+Tag = namedtuple('Tag', ('vocabulary', 'code'))
+Sector = namedtuple('Sector', ('vocabulary', 'code'))
+CheckedActivity = namedtuple('CheckedActivity', ('scopes', 'tags', 'sectors', 'narratives', 'transactions'))
+CheckedTransaction = namedtuple('CheckedTransaction', ('sectors', 'narratives'))
+
+
+class LegacyCovidChecks:
+    """ The covid checks as they were before TopicMatcher (kept for comparison) """
+    @staticmethod
+    def has_desired_scope(scopes):
+        for scope in scopes:
+            if scope.type == '1' and scope.vocabulary == '1-2' and scope.code.upper() == 'EP-2020-000012-001':
+                return True
+            elif scope.type == '2' and scope.vocabulary == '2-1' and scope.code.upper() == 'HCOVD20':
+                return True
+        return False
+
+    @staticmethod
+    def has_desired_tag(tags):
+        for tag in tags:
+            if tag.vocabulary == '99' and tag.code.upper() == 'COVID-19':
+                return True
+        return False
+
+    @staticmethod
+    def has_desired_sector(sectors):
+        for sector in sectors:
+            if sector.vocabulary == '1' and sector.code == '12264':
+                return True
+        return False
+
+    @staticmethod
+    def is_desired_narrative(narratives):
+        for lang, text in narratives.items():
+            if 'COVID-19' in text.upper():
+                return True
+        return False
+
+
+class LegacyEbolaChecks:
+    """ The ebola checks as they were before TopicMatcher (kept for comparison) """
+    @staticmethod
+    def has_desired_scope(scopes):
+        for scope in scopes:
+            if scope.type == '2' and scope.vocabulary == '2-1' and scope.code.upper() == 'OXEBOLA1415':
+                return True
+        return False
+
+    @staticmethod
+    def has_desired_tag(tags):
+        return False
+
+    @staticmethod
+    def has_desired_sector(sectors):
+        return False
+
+    @staticmethod
+    def is_desired_narrative(narratives):
+        for lang, text in narratives.items():
+            if 'EBOLA' in text.upper():
+                return True
+        return False
+
+
+legacy_checks = {'covid': LegacyCovidChecks, 'ebola': LegacyEbolaChecks}
+
+
+def get_narratives(element):
+    if element is None:
+        return None
+    return dict(element.narratives)
+
+
+def load_activities(pages_dir):
+    # The last page is D-Portal's empty JSON response that ends paging
+    paths = [path for path in sorted(glob(join(pages_dir, 'dportal_*.xml')))
+             if '<iati-activity' in load_file_to_str(path)]
+    activities = list()
+    for dactivity in iterate_activities(paths):
+        transactions = [CheckedTransaction([Sector(sector.vocabulary, sector.code) for sector in dtransaction.sectors],
+                                           get_narratives(dtransaction.description))
+                        for dtransaction in dactivity.transactions]
+        activities.append(CheckedActivity([Scope(scope.type, scope.vocabulary, scope.code)
+                                           for scope in dactivity.humanitarian_scopes],
+                                          [Tag(tag.vocabulary, tag.code) for tag in dactivity.tags],
+                                          [Sector(sector.vocabulary, sector.code) for sector in dactivity.sectors],
+                                          get_narratives(dactivity.title), transactions))
+    return activities
+
+
+def check_activities(checks, activities):
+    """ Run the checks as Activity.is_strict and Transaction do returning the strict flags """
+    results = list()
+    for activity in activities:
+        results.append(checks.has_desired_scope(activity.scopes) or checks.has_desired_tag(activity.tags) or
+                       checks.has_desired_sector(activity.sectors) or
+                       checks.is_desired_narrative(activity.narratives or dict()))
+        for transaction in activity.transactions:
+            results.append(checks.has_desired_sector(transaction.sectors) or
+                           (transaction.narratives is not None and checks.is_desired_narrative(transaction.narratives)))
+    return results
+
+
+def measure(all_checks, activities, repeats):
+    """ Time each of all_checks alternately so that they are affected alike by anything else
+    running, returning the least seconds per activity and the strict flags of each
+    """
+    timings = [list() for _ in all_checks]
+    all_results = [None for _ in all_checks]
+    for _ in range(repeats):
+        for i, checks in enumerate(all_checks):
+            start_time = perf_counter()
+            all_results[i] = check_activities(checks, activities)
+            timings[i].append(perf_counter() - start_time)
+    return [min(seconds) / len(activities) for seconds in timings], all_results
+
+
+def main(repeats, configuration_path, pages_dir):
+    TopicMatcher.setup(load_yaml(configuration_path)['topics'])
+    activities = load_activities(pages_dir)
+    no_transactions = sum(len(activity.transactions) for activity in activities)
+    logger.info(f'Checking {len(activities)} activities with {no_transactions} transactions')
+    results = dict()
+    for topic, legacy in legacy_checks.items():
+        (before, after), (before_results, after_results) = measure((legacy, TopicMatcher.get(topic)), activities,
+                                                                   repeats)
+        if before_results != after_results:
+            raise ValueError(f'{topic} checks do not agree!')
+        results[topic] = {'before': before, 'after': after}
+        logger.info(f'{topic}: {before * 1E6:.2f}us/activity before, {after * 1E6:.2f}us/activity after '
+                    f'({before / after:.2f}x), {sum(after_results)} strict')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Topic checks benchmark')
+    parser.add_argument('-r', '--repeats', default=20, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-c', '--configuration', default=join('config', 'project_configuration.yml'),
+                        help='Project configuration to take topics from')
+    parser.add_argument('-p', '--pages_dir', default=join('tests', 'fixtures'),
+                        help='Folder with D-Portal pages (eg. the fixtures or a synthetic corpus)')
+    args = parser.parse_args()
+    main(args.repeats, args.configuration, args.pages_dir)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Compares accumulating and sorting split transactions as a list of 12 element lists sorted
+with a tuple key (as before TransactionColumns) against TransactionColumns, on a synthetic
+corpus. Wall time covers adding, sorting and iterating the output rows. Memory is what is
+held once all the split transactions have been added and the peak by the end of sorting.
+
+    python -m benchmarks.bench_transactions --rows 1000000
+"""
+import argparse
+import gc
+import logging
+import random
+import tracemalloc
+from time import perf_counter
+
+from hdx.location.country import Country
+from hdx.utilities.easy_logging import setup_logging
+
+from iati.lookups import Lookups
+from iati.transactioncolumns import TransactionColumns
+
+logger = logging.getLogger(__name__)
+
+
+class SplitTransaction:
+    """ The fields of a processed Transaction that the accumulators use """
+    __slots__ = ('year_month', 'value', 'net_value', 'is_humanitarian', 'is_strict', 'classification',
+                 'country_splits', 'sector_splits')
+
+    def __init__(self, year_month, value, net_value, is_humanitarian, is_strict, classification, country_splits,
+                 sector_splits):
+        self.year_month = year_month
+        self.value = value
+        self.net_value = net_value
+        self.is_humanitarian = is_humanitarian
+        self.is_strict = is_strict
+        self.classification = classification
+        self.country_splits = country_splits
+        self.sector_splits = sector_splits
+
+    def get_classification(self):
+        return self.classification
+
+
+class LegacyTransactions(list):
+    """ Split transactions as they were accumulated before TransactionColumns (kept for comparison) """
+    def add_activity(self, org, identifier, transactions):
+        for transaction in transactions:
+            for country, country_percentage in transaction.country_splits.items():
+                for sector, sector_percentage in transaction.sector_splits.items():
+                    sector_name = Lookups.get_sector_group_name(sector)
+                    country_name = Lookups.get_country_region_name(country)
+                    total_money = int(round(transaction.value * country_percentage * sector_percentage))
+                    net_money = int(round(transaction.net_value * country_percentage * sector_percentage))
+                    if total_money != 0:
+                        self.append([transaction.year_month, org['id'], org['name'], org['type'], sector_name,
+                                     country_name, transaction.is_humanitarian, transaction.is_strict,
+                                     transaction.get_classification(), identifier, net_money, total_money])
+
+    def sort(self):
+        super().sort(key=lambda x: (x[0], x[2], x[3], x[4], x[5], x[6], x[7], x[8], x[9], x[10]))
+
+
+def setup():
+    Country.countriesdata(use_live=False)
+    Lookups.sector_info = {'121': {'dac-group': 'Health'}, '720': {'dac-group': 'Emergency Response'},
+                           '151': {'dac-group': 'Government & Civil Society'}}
+    Lookups.default_sector = '(Unspecified sector)'
+    Lookups.region_code_to_name = {'998': 'Developing countries, unspecified'}
+    Lookups.default_country_region = '(Unspecified country)'
+    Lookups.setup_split_names()
+
+
+def make_activities(no_rows):
+    """ Make synthetic activities whose transactions have 4 splits each giving no_rows split rows """
+    random.seed(1)
+    countries = ('AF', 'PS', 'SY', 'YE', 'SO', 'SS', 'ET', 'CD', 'NG', '998')
+    sectors = ('12191', '12264', '72010', '72050', '15110', '121')
+    orgs = [{'id': f'xm-org-{i}', 'name': f'Org {i}', 'type': str(10 + i % 80)} for i in range(2000)]
+    activities = list()
+    no_transactions = no_rows // 4
+    while no_transactions > 0:
+        org = random.choice(orgs)
+        identifier = f'{org["id"]}-activity-{len(activities)}'
+        country_a, country_b = random.sample(countries, 2)
+        country_splits = {country_a: 0.6, country_b: 0.4}
+        sector_a, sector_b = random.sample(sectors, 2)
+        sector_splits = {sector_a: 0.5, sector_b: 0.5}
+        humanitarian = random.randint(0, 1)
+        strict = random.randint(0, 1)
+        transactions = list()
+        for _ in range(min(random.randint(1, 10), no_transactions)):
+            value = random.uniform(1000, 1E7)
+            transactions.append(SplitTransaction(f'202{random.randint(0, 2)}-{random.randint(1, 12):02d}', value,
+                                                 value * random.choice((0.0, 1.0)), humanitarian, strict,
+                                                 random.choice(('commitments', 'spending')), country_splits,
+                                                 sector_splits))
+        activities.append((org, identifier, transactions))
+        no_transactions -= len(transactions)
+    return activities
+
+
+def accumulate(accumulator_class, activities):
+    accumulator = accumulator_class()
+    for activity in activities:
+        accumulator.add_activity(*activity)
+    return accumulator
+
+
+def time_accumulator(accumulator_class, activities):
+    start_time = perf_counter()
+    accumulator = accumulate(accumulator_class, activities)
+    accumulator.sort()
+    for _ in accumulator:
+        pass
+    return perf_counter() - start_time, len(accumulator)
+
+
+def measure_accumulator(accumulator_class, activities):
+    gc.collect()
+    tracemalloc.start()
+    accumulator = accumulate(accumulator_class, activities)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    accumulator.sort()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, peak
+
+
+def main(no_rows):
+    setup()
+    logger.info(f'Making synthetic transactions giving {no_rows} split rows')
+    activities = make_activities(no_rows)
+    results = dict()
+    for name, accumulator_class in (('legacy', LegacyTransactions), ('columnar', TransactionColumns)):
+        duration, no_split_rows = time_accumulator(accumulator_class, activities)
+        size, peak = measure_accumulator(accumulator_class, activities)
+        results[name] = {'seconds': duration, 'bytes': size, 'sort_peak_bytes': peak}
+        logger.info(f'{name}: {duration:.2f}s ({no_split_rows / duration:.0f} rows/sec), '
+                    f'{size / no_split_rows:.0f} bytes/row held, {peak / no_split_rows:.0f} bytes/row peak')
+    logger.info(f'Speedup: {results["legacy"]["seconds"] / results["columnar"]["seconds"]:.2f}x, '
+                f'memory reduction: {results["legacy"]["bytes"] / results["columnar"]["bytes"]:.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Split transaction accumulator benchmark')
+    parser.add_argument('-r', '--rows', default=1000000, type=int, help='Number of synthetic split rows')
+    args = parser.parse_args()
+    main(args.rows)
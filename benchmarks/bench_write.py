@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the throughput of the output writer, which writes batches of rows through large
+(optionally gzip compressed) buffers, against the previous writers on a synthetic
+transactions input: one that wrote row by row with compiled row projections and one
+before that that evaluated each cell with eval.
+
+    python -m benchmarks.bench_write --rows 1000000
+"""
+import argparse
+import json
+import logging
+import random
+from os import listdir
+from os.path import getsize, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import unicodecsv
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_yaml
+
+from iati.outputs import compile_projection, write
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_write(today, output_dir, configuration, configuration_key, rows, skipped=None):
+    """ The writer before projections were compiled (kept for comparison) """
+    file_configuration = configuration[configuration_key]
+    headers = file_configuration['headers']
+    hxltags = file_configuration['hxltags']
+    process_cols = file_configuration.get('process_cols', dict())
+    csv_configuration = file_configuration['csv']
+    json_configuration = file_configuration['json']
+    csv_hxltags = csv_configuration.get('hxltags', hxltags)
+    json_hxltags = json_configuration.get('hxltags', hxltags)
+    hxltag_to_header = dict(zip(hxltags, headers))
+    csv_headers = [hxltag_to_header[hxltag] for hxltag in csv_hxltags]
+    metadata = {'#date+run': today, f'#meta+{configuration_key}+num': len(rows)}
+    if skipped is not None:
+        metadata[f'#meta+{configuration_key}+skipped+num'] = skipped
+    metadata_json = json.dumps(metadata, indent=None, separators=(',', ':'))
+    with open(join(output_dir, csv_configuration['filename']), 'wb') as output_csv:
+        writer = unicodecsv.writer(output_csv, encoding='utf-8', lineterminator='\n')
+        writer.writerow(csv_headers)
+        writer.writerow(csv_hxltags)
+        with open(join(output_dir, json_configuration['filename']), 'w') as output_json:
+            output_json.write(f'{{"metadata":{metadata_json},"data":[\n')
+
+            def write_row(inrow, ending):
+                def get_outrow(file_hxltags):
+                    outrow = dict()
+                    for file_hxltag in file_hxltags:
+                        expression = process_cols.get(file_hxltag)
+                        if expression:
+                            for i, hxltag in enumerate(hxltags):
+                                expression = expression.replace(hxltag, f'inrow[{i}]')
+                            outrow[file_hxltag] = eval(expression)
+                        else:
+                            outrow[file_hxltag] = inrow[hxltags.index(file_hxltag)]
+                    return outrow
+                writer.writerow(get_outrow(csv_hxltags).values())
+                row = get_outrow(json_hxltags)
+                output_json.write(json.dumps(row, indent=None, separators=(',', ':')) + ending)
+
+            [write_row(row, ',\n') for row in rows[:-1]]
+            write_row(rows[-1], ']')
+            output_json.write('}')
+
+
+def per_row_write(today, output_dir, configuration, configuration_key, rows, skipped=None):
+    """ The writer before rows were batched (kept for comparison) """
+    file_configuration = configuration[configuration_key]
+    headers = file_configuration['headers']
+    hxltags = file_configuration['hxltags']
+    process_cols = file_configuration.get('process_cols', dict())
+    csv_configuration = file_configuration['csv']
+    json_configuration = file_configuration['json']
+    csv_hxltags = csv_configuration.get('hxltags', hxltags)
+    json_hxltags = json_configuration.get('hxltags', hxltags)
+    hxltag_to_header = dict(zip(hxltags, headers))
+    csv_headers = [hxltag_to_header[hxltag] for hxltag in csv_hxltags]
+    get_csv_outrow = compile_projection(hxltags, csv_hxltags, process_cols)
+    get_json_outrow = compile_projection(hxltags, json_hxltags, process_cols, as_dict=True)
+    metadata = {'#date+run': today, f'#meta+{configuration_key}+num': len(rows)}
+    if skipped is not None:
+        metadata[f'#meta+{configuration_key}+skipped+num'] = skipped
+    metadata_json = json.dumps(metadata, indent=None, separators=(',', ':'))
+    with open(join(output_dir, csv_configuration['filename']), 'wb') as output_csv:
+        writer = unicodecsv.writer(output_csv, encoding='utf-8', lineterminator='\n')
+        writer.writerow(csv_headers)
+        writer.writerow(csv_hxltags)
+        with open(join(output_dir, json_configuration['filename']), 'w') as output_json:
+            output_json.write(f'{{"metadata":{metadata_json},"data":[\n')
+            ending = ''
+            for inrow in rows:
+                output_json.write(ending)
+                writer.writerow(get_csv_outrow(inrow))
+                output_json.write(json.dumps(get_json_outrow(inrow), indent=None, separators=(',', ':')))
+                ending = ',\n'
+            output_json.write(']}')
+
+
+def make_transactions(no_rows, seed=0):
+    """ Make synthetic rows in the shape of the transactions output """
+    rnd = random.Random(seed)
+    orgs = [(f'xm-org-{i}', f'Organisation {i}', str(rnd.choice((10, 21, 22, 40, 80)))) for i in range(2000)]
+    sectors = [f'Sector {i}' for i in range(40)]
+    countries = [f'Country {i}' for i in range(200)]
+    months = [f'2020-{month:02d}' for month in range(1, 13)] + [f'2021-{month:02d}' for month in range(1, 13)]
+    rows = list()
+    for i in range(no_rows):
+        org_id, org_name, org_type = rnd.choice(orgs)
+        value = rnd.randint(-1000, 10000000)
+        rows.append([rnd.choice(months), org_id, org_name, org_type, rnd.choice(sectors), rnd.choice(countries),
+                     rnd.randint(0, 1), rnd.randint(0, 1), rnd.choice(('spending', 'commitments')),
+                     f'{org_id}-{i // 5}', int(value * rnd.random()), value])
+    return rows
+
+
+def time_writer(writer, outputs_configuration, rows):
+    with TemporaryDirectory() as folder:
+        start_time = perf_counter()
+        writer('2021-05-06', folder, outputs_configuration, 'transactions', rows, 0)
+        duration = perf_counter() - start_time
+        no_bytes = sum(getsize(join(folder, filename)) for filename in listdir(folder))
+        return duration, no_bytes
+
+
+def main(no_rows, configuration_path):
+    outputs_configuration = load_yaml(configuration_path)['outputs']
+    logger.info(f'Making {no_rows} synthetic transactions')
+    rows = make_transactions(no_rows)
+    variants = {'hxltags only': dict(),
+                'with process_cols': {'#value+net': 'int(#value+net / 1000)', '#value+total': 'int(#value+total / 1000)'}}
+    results = dict()
+    transactions_configuration = outputs_configuration['transactions']
+    for variant, process_cols in variants.items():
+        transactions_configuration['process_cols'] = process_cols
+        for name, writer in (('legacy', legacy_write), ('per row', per_row_write), ('batched', write)):
+            duration, no_bytes = time_writer(writer, outputs_configuration, rows)
+            results[f'{variant} {name}'] = duration
+            logger.info(f'{variant} {name}: {duration:.2f}s ({no_rows / duration:.0f} rows/sec, {no_bytes} bytes)')
+        logger.info(f'{variant} speedup: {results[f"{variant} legacy"] / results[f"{variant} batched"]:.2f}x '
+                    f'over legacy, {results[f"{variant} per row"] / results[f"{variant} batched"]:.2f}x over per row')
+    for file_type in ('csv', 'json'):
+        transactions_configuration[file_type] = dict(transactions_configuration[file_type], gzip=True)
+    duration, no_bytes = time_writer(write, outputs_configuration, rows)
+    results['gzip batched'] = duration
+    logger.info(f'gzip batched: {duration:.2f}s ({no_rows / duration:.0f} rows/sec, {no_bytes} bytes)')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Writer throughput benchmark')
+    parser.add_argument('-r', '--rows', default=1000000, type=int, help='Number of synthetic rows')
+    parser.add_argument('-c', '--configuration', default=join('config', 'project_configuration.yml'),
+                        help='Project configuration to take outputs configuration from')
+    args = parser.parse_args()
+    main(args.rows, args.configuration)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic corpora of D-Portal pages for benchmarking and a retriever that serves them
+in place of D-Portal. Activities have a long tailed distribution of reporting orgs, a mix of
+currencies, single and multi country (or region) and sector splits and the transaction types the
+configuration knows about along with some it doesn't. Corpora are deterministic for a given seed.
+
+    python -m benchmarks.corpus --activities 100000 --corpus_dir corpus
+"""
+import argparse
+import logging
+import random
+from html import escape
+from os import makedirs
+from os.path import exists, join
+
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_file_to_str, load_json, load_yaml
+from hdx.utilities.retriever import Retrieve
+
+logger = logging.getLogger(__name__)
+
+header = '<?xml version="1.0" encoding="UTF-8"?>\n<iati-activities version="2.03">\n '
+footer = '\n</iati-activities>\n'
+# What D-Portal returns once there are no more activities
+end_page = '{"result":[],"time":0.0}'
+currencies = ('USD', 'EUR', 'GBP', 'CHF', 'SEK', 'NOK', 'JPY', 'CAD', 'KRW', 'DKK', 'AUD')
+currency_weights = (40, 20, 12, 4, 4, 3, 4, 4, 3, 3, 3)
+countries = ('AF', 'BD', 'CD', 'ET', 'HT', 'IQ', 'JO', 'KE', 'LB', 'ML', 'MM', 'MZ', 'NE', 'NG', 'PH', 'PK', 'PS',
+             'SD', 'SO', 'SS', 'SY', 'TD', 'TR', 'UA', 'UG', 'VE', 'YE', 'ZW', 'XK', 'ZZ')
+regions = ('298', '398', '498', '589', '619', '789', '998')
+sectors = ('12264', '12191', '12220', '12240', '12262', '13010', '15110', '15170', '16010', '31161', '43010',
+           '72010', '72040', '72050', '74020', '99810', '11220', '14030', '151', '720')
+# Transaction types 5 to 10 and 12 and 13 aren't in the configuration so their transactions are skipped
+transaction_types = ('1', '2', '3', '4', '11', '5', '7', '12')
+transaction_type_weights = (10, 25, 35, 20, 5, 2, 2, 1)
+org_types = ('10', '11', '15', '21', '22', '23', '30', '40', '60', '70', '80', '90')
+months = [f'{year}-{month:02d}' for year in (2019, 2020, 2021) for month in range(1, 13)][5:28]
+
+
+class CorpusGenerator:
+    """
+    Makes synthetic iati-activity elements. Reporting orgs are drawn with weights falling off with
+    rank so that a few orgs report most activities as in D-Portal.
+    """
+
+    def __init__(self, no_activities, seed=0):
+        self.random = random.Random(seed)
+        no_orgs = max(20, no_activities // 25)
+        self.orgs = [(f'XM-SYN-{i}', f'Synthetic Organisation {i}', self.random.choice(org_types))
+                     for i in range(no_orgs)]
+        self.org_weights = [1 / (rank + 1) for rank in range(no_orgs)]
+        self.no_activities = no_activities
+
+    def get_org(self):
+        return self.random.choices(self.orgs, self.org_weights)[0]
+
+    @staticmethod
+    def get_org_element(tag, org, extra=''):
+        ref, name, org_type = org
+        return f'<{tag}{extra} ref="{ref}" type="{org_type}">\n   <narrative xml:lang="EN">{escape(name)}' \
+               f'</narrative>\n  </{tag}>'
+
+    def get_percentages(self, codes):
+        if len(codes) == 1:
+            return [100]
+        weights = [self.random.randint(1, 10) for _ in codes]
+        percentages = [round(100 * weight / sum(weights)) for weight in weights]
+        percentages[-1] = 100 - sum(percentages[:-1])
+        return percentages
+
+    def get_splits(self):
+        elements = list()
+        if self.random.random() < 0.1:
+            chosen = self.random.sample(regions, 1)
+            tag = 'recipient-region'
+            extra = ' vocabulary="1"'
+        else:
+            chosen = self.random.sample(countries, self.random.choices((1, 2, 3, 5), (60, 20, 12, 8))[0])
+            tag = 'recipient-country'
+            extra = ''
+        for code, percentage in zip(chosen, self.get_percentages(chosen)):
+            elements.append(f'<{tag} code="{code}" percentage="{percentage}"{extra}></{tag}>')
+        chosen = self.random.sample(sectors, self.random.choices((1, 2, 4), (55, 30, 15))[0])
+        for code, percentage in zip(chosen, self.get_percentages(chosen)):
+            vocabulary = '2' if len(code) == 3 else '1'
+            elements.append(f'<sector code="{code}" percentage="{percentage}" vocabulary="{vocabulary}"></sector>')
+        return elements
+
+    def get_transaction(self, identifier, reporting_org):
+        transaction_type = self.random.choices(transaction_types, transaction_type_weights)[0]
+        date = f'{self.random.choice(months)}-{self.random.randint(1, 28):02d}'
+        value = round(self.random.lognormvariate(11, 2.5), 2)
+        if self.random.random() < 0.02:
+            value = 0
+        currency = ''
+        if self.random.random() < 0.1:
+            currency = f' currency="{self.random.choices(currencies, currency_weights)[0]}"'
+        elements = [f'<transaction-type code="{transaction_type}"></transaction-type>',
+                    f'<transaction-date iso-date="{date}"></transaction-date>',
+                    f'<value{currency} value-date="{date}">{value}</value>']
+        if transaction_type in ('1', '11'):
+            elements.append(self.get_org_element('provider-org', self.get_org(),
+                                                 f' provider-activity-id="{identifier}"'))
+        else:
+            elements.append(self.get_org_element('receiver-org', self.random.choice((self.get_org(),
+                                                                                      reporting_org))))
+        if self.random.random() < 0.1:
+            elements.extend(self.get_splits())
+        humanitarian = ''
+        if self.random.random() < 0.05:
+            humanitarian = f' humanitarian="{self.random.randint(0, 1)}"'
+        return f'<transaction{humanitarian}>\n   ' + '\n   '.join(elements) + '\n  </transaction>'
+
+    def get_activity(self, n):
+        reporting_org = self.get_org()
+        identifier = f'{reporting_org[0]}-{n}'
+        default_currency = self.random.choices(currencies, currency_weights)[0]
+        humanitarian = '1' if self.random.random() < 0.4 else '0'
+        timestamp = f'2021-0{1 + n * 4 // self.no_activities}-{1 + n % 28:02d}T{n % 24:02d}:00:00'
+        start_tag = f'<iati-activity default-currency="{default_currency}" hierarchy="1" ' \
+                    f'humanitarian="{humanitarian}" iati-activities:generated-datetime="{timestamp}" ' \
+                    f'iati-activities:version="2.03" last-updated-datetime="{timestamp}" xml:lang="EN" ' \
+                    f'xmlns:iati-activities="http://d-portal.org/xmlns/iati-activities">'
+        secondary = ' secondary-reporter="1"' if self.random.random() < 0.03 else ''
+        if self.random.random() < 0.6:
+            title = f'COVID-19 response {n}'
+        else:
+            title = f'Health and livelihoods programme {n}'
+        elements = [f'<iati-identifier>{identifier}</iati-identifier>',
+                    self.get_org_element('reporting-org', reporting_org, secondary),
+                    f'<title>\n   <narrative xml:lang="EN">{title}</narrative>\n  </title>']
+        for role in self.random.choices(('1', '2', '3', '4'), k=self.random.randint(0, 4)):
+            elements.append(self.get_org_element('participating-org', self.get_org(), f' role="{role}"'))
+        if self.random.random() < 0.2:
+            elements.append('<tag code="COVID-19" vocabulary="99"></tag>')
+        elements.extend(self.get_splits())
+        for _ in range(self.random.choices((1, 2, 4, 8, 20), (30, 30, 20, 15, 5))[0]):
+            elements.append(self.get_transaction(identifier, reporting_org))
+        return start_tag + '\n  ' + '\n  '.join(elements) + '\n </iati-activity>'
+
+
+def make_corpus(corpus_dir, no_activities, limit=100, seed=0, filename='dportal_{}.xml'):
+    """ Write no_activities synthetic activities to corpus_dir as D-Portal pages of limit activities
+    followed by D-Portal's empty page. Returns the number of pages with activities.
+    """
+    makedirs(corpus_dir, exist_ok=True)
+    generator = CorpusGenerator(no_activities, seed)
+    no_pages = 0
+    for offset in range(0, no_activities, limit):
+        activities = [generator.get_activity(n) for n in range(offset, min(offset + limit, no_activities))]
+        with open(join(corpus_dir, filename.format(no_pages)), 'w', encoding='utf-8') as f:
+            f.write(header + '\n '.join(activities) + footer)
+        no_pages += 1
+    with open(join(corpus_dir, filename.format(no_pages)), 'w', encoding='utf-8') as f:
+        f.write(end_page)
+    logger.info(f'Made {no_activities} activities in {no_pages} pages in {corpus_dir}')
+    return no_pages
+
+
+class CorpusRetriever(Retrieve):
+    """
+    Retriever that never downloads. Files in the corpus folder (the D-Portal pages) are served from
+    there and anything else (eg. fx rates) from the fixtures folder.
+    """
+
+    def __init__(self, downloader, corpus_dir, fixtures_dir, temp_dir):
+        super().__init__(downloader, fixtures_dir, fixtures_dir, temp_dir, save=False, use_saved=True)
+        self.corpus_dir = corpus_dir
+
+    def get_path(self, filename):
+        path = join(self.corpus_dir, filename)
+        if exists(path):
+            return path
+        return join(self.saved_dir, filename)
+
+    def retrieve_file(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return self.get_path(filename)
+
+    def retrieve_text(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return load_file_to_str(self.get_path(filename))
+
+    def retrieve_yaml(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return load_yaml(self.get_path(filename))
+
+    def retrieve_json(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return load_json(self.get_path(filename))
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Synthetic D-Portal corpus generator')
+    parser.add_argument('-a', '--activities', default=1000, type=int, help='Number of activities')
+    parser.add_argument('-l', '--limit', default=100, type=int, help='Activities per page')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='Random seed')
+    parser.add_argument('-cd', '--corpus_dir', default='corpus', help='Folder to write the pages to')
+    args = parser.parse_args()
+    make_corpus(args.corpus_dir, args.activities, args.limit, args.seed)
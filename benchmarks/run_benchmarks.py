@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks a whole run and its main components on a synthetic corpus of D-Portal pages (see
+corpus.py) which is made if the corpus folder doesn't have one already. The run goes through
+start with a retriever that serves the corpus instead of downloading from D-Portal and its
+stage timings are taken from the run stats that it returns. The components (parsing, processing activities
+with a cold and a warm org info cache, writing transactions and rolling them up) are then
+timed on their own. Results are written as JSON with the commit and Python version so that
+they can be compared across commits.
+
+    python -m benchmarks.run_benchmarks --activities 100000 --output results.json
+"""
+import argparse
+import json
+import logging
+import platform
+import subprocess
+from glob import glob
+from os.path import exists, join
+from time import perf_counter
+
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import temp_dir
+
+from benchmarks.corpus import CorpusRetriever, make_corpus
+from iati.dportal import has_activities, iterate_activities
+from iati.lookups import Lookups
+from iati.main import start
+from iati.outputs import get_rollup_configuration, write
+from iati.processing import process_activities
+
+logger = logging.getLogger(__name__)
+
+today = '2021-05-06'
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_configuration(configuration_path, config_dir, workers):
+    configuration = load_yaml(configuration_path)
+    lookups_configuration = configuration['lookups']
+    # Use the filter files in the test config folder rather than downloading them
+    del lookups_configuration['filters_url']
+    del lookups_configuration['blocklist_url']
+    lookups_configuration['filters_file'] = join(config_dir, 'IATI Explorer Filters - Skipped Activities.csv')
+    lookups_configuration['blocklist_file'] = join(config_dir, 'IATI Explorer Filters - Spurious References.csv')
+    configuration['dportal']['workers'] = workers
+    return configuration
+
+
+def get_corpus(configuration, corpus_dir, no_activities, seed):
+    dportal_configuration = configuration['dportal']
+    base_filename = dportal_configuration['filename']
+    if exists(join(corpus_dir, base_filename.format(0))):
+        logger.info(f'Using existing corpus in {corpus_dir}')
+    else:
+        make_corpus(corpus_dir, no_activities, dportal_configuration['limit'], seed, base_filename)
+    # The last page is D-Portal's empty JSON response that ends paging
+    return [path for path in sorted(glob(join(corpus_dir, base_filename.format('*')))) if has_activities(path)]
+
+
+def run_end_to_end(configuration, retriever, output_dir, processes):
+    start_time = perf_counter()
+    stats = start(configuration, today, retriever, output_dir, None, 'covid', '2020-01', processes=processes)
+    duration = perf_counter() - start_time
+    stats['activities_per_second'] = stats['counts']['activities'] / duration
+    return stats
+
+
+def time_parse(paths):
+    start_time = perf_counter()
+    no_activities = sum(1 for _ in iterate_activities(paths))
+    duration = perf_counter() - start_time
+    return {'seconds': duration, 'activities_per_second': no_activities / duration}
+
+
+def time_process(configuration, paths, cold):
+    if cold:
+        Lookups.setup_org_info_cache(configuration['lookups'].get('org_info_cache_size'))
+    start_time = perf_counter()
+    result = process_activities(configuration, today[:7], iterate_activities(paths))
+    duration = perf_counter() - start_time
+    timings = {'seconds': duration, 'activities_per_second': result['activities'] / duration,
+               'parse_seconds': result['parse_seconds'], 'activities_seconds': result['activities_seconds'],
+               'splits_seconds': result['splits_seconds'],
+               'org_info_cache_hits': result['org_info_cache_hits'],
+               'org_info_cache_misses': result['org_info_cache_misses']}
+    return timings, result['transactions']
+
+
+def time_write(outputs_configuration, transactions, output_dir):
+    start_time = perf_counter()
+    write(today, output_dir, outputs_configuration, 'transactions', transactions)
+    duration = perf_counter() - start_time
+    return {'seconds': duration, 'rows_per_second': len(transactions) / duration}
+
+
+def time_rollups(outputs_configuration, transactions, output_dir):
+    transactions_configuration = outputs_configuration['transactions']
+    results = dict()
+    for key, rollup_configuration in outputs_configuration.get('rollups', dict()).items():
+        rollup_configuration = get_rollup_configuration(transactions_configuration, rollup_configuration)
+        fields = [transactions_configuration['hxltags'].index(hxltag) for hxltag in rollup_configuration['group_by']]
+        start_time = perf_counter()
+        rows = transactions.rollup(fields)
+        write(today, output_dir, {key: rollup_configuration}, key, rows)
+        results[key] = {'seconds': perf_counter() - start_time, 'rows': len(rows)}
+    return results
+
+
+def main(no_activities, corpus_dir, seed, repeats, processes, workers, configuration_path, config_dir, fixtures_dir,
+         output_path):
+    configuration = load_configuration(configuration_path, config_dir, workers)
+    paths = get_corpus(configuration, corpus_dir, no_activities, seed)
+    Country.countriesdata(use_live=False)
+    results = {'commit': get_commit(), 'python': platform.python_version(), 'corpus': corpus_dir,
+               'pages': len(paths), 'processes': processes, 'workers': workers, 'repeats': repeats}
+    with temp_dir('run_benchmarks') as tempdir:
+        with Download(user_agent='bench') as downloader:
+            retriever = CorpusRetriever(downloader, corpus_dir, fixtures_dir, tempdir)
+            runs = [run_end_to_end(configuration, retriever, tempdir, processes) for _ in range(repeats)]
+            end_to_end = min(runs, key=lambda stats: stats['total_seconds'])
+            results['activities'] = end_to_end['counts']['activities']
+            results['end_to_end'] = end_to_end
+            logger.info(f'End to end: {end_to_end["total_seconds"]:.2f}s '
+                        f'({end_to_end["activities_per_second"]:.0f} activities/sec)')
+
+            # start leaves the lookups set up so the components can be run on their own
+            components = dict()
+            components['parse'] = min((time_parse(paths) for _ in range(repeats)), key=lambda x: x['seconds'])
+            for name, cold in (('process cold cache', True), ('process warm cache', False)):
+                timings, transactions = min((time_process(configuration, paths, cold) for _ in range(repeats)),
+                                            key=lambda x: x[0]['seconds'])
+                components[name] = timings
+            transactions.sort()
+            outputs_configuration = configuration['outputs']
+            components['write transactions'] = min((time_write(outputs_configuration, transactions, tempdir)
+                                                    for _ in range(repeats)), key=lambda x: x['seconds'])
+            components['rollups'] = time_rollups(outputs_configuration, transactions, tempdir)
+            results['components'] = components
+    for name, timings in components.items():
+        if 'seconds' in timings:
+            logger.info(f'{name}: {timings["seconds"]:.2f}s')
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f'Wrote results to {output_path}')
+    return results
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='End to end and component benchmarks on a synthetic corpus')
+    parser.add_argument('-a', '--activities', default=10000, type=int,
+                        help='Number of activities in the corpus if it has to be made')
+    parser.add_argument('-cd', '--corpus_dir', default='corpus', help='Folder with (or to make) the corpus')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='Random seed for making the corpus')
+    parser.add_argument('-r', '--repeats', default=1, type=int, help='Number of measurements to take the minimum of')
+    parser.add_argument('-p', '--processes', default=1, type=int, help='Number of processes for the second pass')
+    parser.add_argument('-w', '--workers', default=1, type=int, help='Number of threads retrieving pages')
+    parser.add_argument('-c', '--configuration', default=join('config', 'project_configuration.yml'),
+                        help='Project configuration')
+    parser.add_argument('-cfd', '--config_dir', default=join('tests', 'config'), help='Folder with filter files')
+    parser.add_argument('-f', '--fixtures_dir', default=join('tests', 'fixtures'), help='Folder with fx rates')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='File to write results to')
+    args = parser.parse_args()
+    main(args.activities, args.corpus_dir, args.seed, args.repeats, args.processes, args.workers, args.configuration,
+         args.config_dir, args.fixtures_dir, args.output)
@@ -5,56 +5,68 @@ from iati.transaction import Transaction
 
 
 class Activity:
-    def __init__(self, dactivity):
+    __slots__ = ('identifier', 'reporting_org_ref', 'org', 'strict', 'humanitarian', 'countryregion_splits', 'sector_splits',
+                 'funder_org', 'implementer_org', 'transactions', 'commitment_factor', 'spending_factor')
+
+    def __init__(self, dactivity, context):
         """
-        Use the get_activity static method to construct
+        Use the get_activity static method to construct. Only the fields needed for
+        processing are copied from dactivity so that it can be released afterwards.
         """
-        self.dactivity = dactivity
         self.identifier = dactivity.identifier
+        self.reporting_org_ref = dactivity.reporting_org.ref
         # Get the reporting-org and C19 strictness at activity level
-        self.org = Lookups.get_org_info(dactivity.reporting_org, reporting_org=True)
-        self.strict = self.is_strict()
+        self.org = context.get_org_info(dactivity.reporting_org, reporting_org=True)
+        self.strict = self.is_strict(dactivity, context.checks)
         self.humanitarian = dactivity.humanitarian
         # Figure out default country or region/sector percentage splits at the activity level
-        self.countryregion_splits = CalculateSplits.make_country_or_region_splits(dactivity)
-        self.sector_splits = CalculateSplits.make_sector_splits(dactivity)
+        self.countryregion_splits, self.sector_splits = CalculateSplits.make_activity_splits(dactivity)
+        self.funder_org, self.implementer_org = self.get_raw_funder_implementer(dactivity)
         self.transactions = list()
+        self.commitment_factor = None
+        self.spending_factor = None
 
-    def add_transactions(self, configuration):
-        skipped = 0
-        for dtransaction in self.dactivity.transactions:
-            transaction = Transaction.get_transaction(configuration, dtransaction)
-            if not transaction:
-                skipped += 1
-                continue
-            self.transactions.append(transaction)
+    def add_transactions(self, configuration, dtransactions, context):
+        transactions, skipped = Transaction.get_transactions(configuration, dtransactions, self, context)
+        self.transactions.extend(transactions)
         return skipped
 
     @staticmethod
-    def get_activity(configuration, dactivity):
+    def get_activity(configuration, dactivity, context):
         """
         We exclude activities from secondary reporters and certain sorts
         of organisations where the data is very poor quality. We also
         exclude hierarchy=1 activities for UNDP (XM-DAC-41114) and FCDO (GB-GOV-1).
+        The activity uses the checks and org lookup of context and records into it
+        (see ProcessingContext).
         """
+        reporting_org_ref = dactivity.reporting_org.ref
         # Skip activities from a secondary reporter
         if dactivity.secondary_reporter:
-            return None, len(dactivity.transactions)
-        reporting_org_ref = dactivity.reporting_org.ref
+            no_transactions = len(dactivity.transactions)
+            context.record_skip('secondary_reporter', reporting_org_ref, no_transactions, 1)
+            return None, no_transactions
         # Filter out certain orgs
         if Lookups.is_filter_reporting_orgs(reporting_org_ref):
-            return None, len(dactivity.transactions)
+            no_transactions = len(dactivity.transactions)
+            context.record_removal('reporting_orgs', reporting_org_ref, no_transactions)
+            context.record_skip('filtered_org', reporting_org_ref, no_transactions, 1)
+            return None, no_transactions
         # Filter out eg. UNDP and DFID activities that have children (i.e. filter out h=1)
         if Lookups.is_filter_reporting_orgs_children(reporting_org_ref):
             if '2' in dactivity.related_activities_by_type:
-                return None, len(dactivity.transactions)
-        activity = Activity(dactivity)
-        skipped = activity.add_transactions(configuration)
+                no_transactions = len(dactivity.transactions)
+                context.record_removal('reporting_orgs_children', reporting_org_ref, no_transactions)
+                context.record_skip('filtered_parent', reporting_org_ref, no_transactions, 1)
+                return None, no_transactions
+        activity = Activity(dactivity, context)
+        skipped = activity.add_transactions(configuration, dactivity.transactions, context)
         return activity, skipped
 
-    def is_strict(self):
-        return True if (Lookups.checks.has_desired_scope(self.dactivity.humanitarian_scopes) or Lookups.checks.has_desired_tag(self.dactivity.tags) or
-                        Lookups.checks.has_desired_sector(self.dactivity.sectors) or Lookups.checks.is_desired_narrative(self.dactivity.title.narratives)) \
+    @staticmethod
+    def is_strict(dactivity, checks):
+        return True if (checks.has_desired_scope(dactivity.humanitarian_scopes) or checks.has_desired_tag(dactivity.tags) or
+                        checks.has_desired_sector(dactivity.sectors) or checks.is_desired_narrative(dactivity.title.narratives)) \
             else False
 
     def sum_transactions_by_type(self):
@@ -97,10 +109,10 @@ class Activity:
             else:
                 self.spending_factor = 0.0
 
-    def add_to_flows(self, out_flows, transaction, funder, implementer):
+    def add_to_flows(self, out_flows, transaction, funder, implementer, context):
         if transaction.get_classification() != 'spending':
             return
-        provider, receiver = transaction.get_provider_receiver()
+        provider, receiver = transaction.get_provider_receiver(context)
         if funder and provider['name'] == Lookups.default_org_name:
             provider = funder
         if implementer and receiver['name'] == Lookups.default_org_name:
@@ -116,8 +128,9 @@ class Activity:
             key = self.org['name'], provider_name, receiver_name,\
                   transaction.is_humanitarian, transaction.is_strict, transaction.get_direction()
             # ignore internal transactions or unknown reporting orgs
+            # values are kept in order so that flows from different activities can be merged and summed exactly
             cur_output = out_flows.get(key, dict())
-            cur_output['value'] = cur_output.get('value', 0) + transaction.value
+            cur_output.setdefault('values', list()).append(transaction.value)
             if 'row' not in cur_output:
                 cur_output['row'] = [self.org['id'], self.org['name'], self.org['type'], provider['id'],
                                      provider_name, provider['type'], receiver['id'], receiver_name,
@@ -125,64 +138,55 @@ class Activity:
                                      transaction.get_direction()]
             out_flows[key] = cur_output
 
-    def generate_split_transactions(self, out_transactions, transaction):
-        # Make the splits for the transaction (default to activity splits)
-        country_splits = transaction.make_country_or_region_splits(self.countryregion_splits)
-        sector_splits = transaction.make_sector_splits(self.sector_splits)
-
-        # Apply the country and sector percentage splits to the transaction
+    def generate_split_transactions(self, out_transactions, transactions):
+        # Apply the country and sector percentage splits to the transactions
         # generate multiple split transactions
-        for country, country_percentage in country_splits.items():
-            for sector, sector_percentage in sector_splits.items():
-
-                sector_name = Lookups.get_sector_group_name(sector)
-                country_name = Lookups.get_country_region_name(country)
+        out_transactions.add_activity(self.org, self.identifier, transactions)
 
-                #
-                # Add to transactions
-                #
-
-                total_money = int(round(transaction.value * country_percentage * sector_percentage))
-                net_money = int(round(transaction.net_value * country_percentage * sector_percentage))
-
-                if total_money != 0:
-                    # add to transactions
-                    out_transactions.append([transaction.year_month, self.org['id'], self.org['name'], self.org['type'],
-                                             sector_name, country_name, transaction.is_humanitarian,
-                                             transaction.is_strict, transaction.get_classification(), self.identifier,
-                                             net_money, total_money])
-
-    def get_funder_implementer(self):
+    @staticmethod
+    def get_raw_funder_implementer(dactivity):
         funder = None
         implementer = None
-        participating_orgs_by_role = self.dactivity.participating_orgs_by_role
+        participating_orgs_by_role = dactivity.participating_orgs_by_role
         for role in participating_orgs_by_role:
             if role not in ('1', '4'):
                 continue
             participating_orgs = participating_orgs_by_role[role]
             if len(participating_orgs) != 1:
                 continue
-            org = Lookups.get_org_info(participating_orgs[0])
+            org = Lookups.get_raw_org(participating_orgs[0])
             if role == '1':
                 funder = org
             else:
                 implementer = org
         return funder, implementer
 
-    def process(self, today_year_month, out_flows, out_transactions):
+    def get_funder_implementer(self, context):
+        funder = None
+        implementer = None
+        if self.funder_org is not None:
+            funder = context.get_raw_org_info(self.funder_org)
+        if self.implementer_org is not None:
+            implementer = context.get_raw_org_info(self.implementer_org)
+        return funder, implementer
+
+    def process(self, today_year_month, out_flows, out_transactions, context):
         self.factor_new_money()
         #
         # Walk through the activity's transactions one-by-one, and split by country/sector
         #
-        funder, implementer = self.get_funder_implementer()
+        funder, implementer = self.get_funder_implementer(context)
         skipped = 0
+        transactions_to_split = list()
         for transaction in self.transactions:
-            if not transaction.process(today_year_month, self):
+            if not transaction.process(today_year_month, self, context):
                 skipped += 1
                 continue
-            self.add_to_flows(out_flows, transaction, funder, implementer)
+            self.add_to_flows(out_flows, transaction, funder, implementer, context)
             if transaction.net_value is None:
+                context.record_skip('no_net_value', self.reporting_org_ref)
                 skipped += 1
                 continue
-            self.generate_split_transactions(out_transactions, transaction)
+            transactions_to_split.append(transaction)
+        self.generate_split_transactions(out_transactions, transactions_to_split)
         return skipped
\ No newline at end of file
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+
+def canonical(obj):
+    """ Convert obj into something that json.dumps gives the same output for whenever the
+    contents are the same (eg. sets are sorted, classes are given by name and regexes by pattern)
+    """
+    if isinstance(obj, dict):
+        if all(isinstance(key, str) for key in obj):
+            return {key: canonical(value) for key, value in obj.items()}
+        return sorted(([canonical(key), canonical(value)] for key, value in obj.items()), key=repr)
+    if isinstance(obj, (list, tuple)):
+        return [canonical(value) for value in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted((canonical(value) for value in obj), key=repr)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, re.Pattern):
+        return [obj.pattern, obj.flags]
+    if isinstance(obj, type):
+        return obj.__qualname__
+    if hasattr(obj, '__dict__'):
+        return [type(obj).__qualname__, canonical(vars(obj))]
+    return obj
+
+
+class ActivityStore:
+    """
+    On-disk store of the contribution each activity makes to the outputs keyed by iati-identifier
+    and last-updated-datetime. The store has a fingerprint of what affects every activity's
+    contribution and doesn't change from day to day (eg. filters and configuration). If that
+    changes, the store is cleared forcing a full recompute. What changes daily (eg. the org
+    lookup and fx rates) is checked for each contribution before it is reused.
+    """
+    version = 3
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            # Lets worker processes read while new contributions are written
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS contributions (identifier TEXT, last_updated TEXT, '
+                                    'contribution TEXT, PRIMARY KEY (identifier, last_updated))')
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def get_fingerprint(cls, inputs):
+        hash = hashlib.sha256(str(cls.version).encode('utf-8'))
+        hash.update(json.dumps(canonical(inputs), sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        return hash.hexdigest()
+
+    def check_fingerprint(self, inputs):
+        """ Clear the store if the inputs are different to those of the stored contributions.
+        Returns True if the stored contributions can be used.
+        """
+        fingerprint = self.get_fingerprint(inputs)
+        row = self.connection.execute("SELECT value FROM metadata WHERE key = 'fingerprint'").fetchone()
+        if row is not None and row[0] == fingerprint:
+            return True
+        if row is None:
+            logger.info(f'Creating activity store {self.path}')
+        else:
+            logger.info('Lookups, filters or configuration have changed so clearing activity store')
+        with self.connection:
+            self.connection.execute('DELETE FROM contributions')
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('fingerprint', ?)", (fingerprint,))
+        return False
+
+    def get(self, identifier, last_updated):
+        row = self.connection.execute('SELECT contribution FROM contributions WHERE identifier = ? AND '
+                                      'last_updated = ?', (identifier, last_updated)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, contributions):
+        """ Store contributions given as a list of ((identifier, last_updated), contribution) """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO contributions VALUES (?, ?, ?)',
+                                        ((identifier, last_updated, json.dumps(contribution, separators=(',', ':')))
+                                         for (identifier, last_updated), contribution in contributions))
+
+    def prune(self, keys):
+        """ Remove contributions of activities that are not in keys (eg. ones that have been updated)
+        returning the number removed
+        """
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE seen (identifier TEXT, last_updated TEXT, '
+                                    'PRIMARY KEY (identifier, last_updated))')
+            self.connection.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', keys)
+            cursor = self.connection.execute('DELETE FROM contributions WHERE NOT EXISTS (SELECT 1 FROM seen WHERE '
+                                             'seen.identifier = contributions.identifier AND '
+                                             'seen.last_updated = contributions.last_updated)')
+            self.connection.execute('DROP TABLE seen')
+        return cursor.rowcount
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import random
+from os.path import join
+from threading import Thread
+
+from hdx.utilities.downloader import DownloadError
+from hdx.utilities.loader import load_file_to_str, load_json, load_yaml
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_json, save_str_to_file, save_yaml
+from hdx.utilities.useragent import UserAgent
+from ruamel.yaml import YAML
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDownload:
+    """
+    Downloads with aiohttp on an asyncio event loop that runs in a background thread so that
+    blocking code can start downloads, get on with something else (eg. parsing pages that have
+    already been downloaded) and wait for them later. Connections are kept alive in a pool of at
+    most limit connections with at most limit_per_host to any one host. A request that times out,
+    loses its connection or gets a status in retry_statuses is retried up to retries times after
+    a random wait of up to backoff_factor * 2 ^ attempt seconds capped at max_backoff (or after
+    the Retry-After seconds the server asks for). Needs aiohttp which is only imported when an
+    AsyncDownload is made.
+    """
+
+    def __init__(self, user_agent=None, limit=16, limit_per_host=4, timeout=300, connect_timeout=30, retries=5,
+                 backoff_factor=0.5, max_backoff=60, retry_statuses=(429, 500, 502, 503, 504), chunk_size=65536):
+        import aiohttp
+        self.aiohttp = aiohttp
+        self.user_agent = UserAgent.get(user_agent)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+        self.chunk_size = chunk_size
+        self.retried = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='AsyncDownload', daemon=True)
+        self.thread.start()
+        # The session must be made on the loop that it will be used from
+        self.session = self.run(self.make_session())
+
+    async def make_session(self):
+        connector = self.aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        return self.aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                          headers={'User-Agent': self.user_agent})
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        try:
+            self.run(self.session.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, coroutine):
+        """ Run a coroutine on the event loop returning a concurrent.futures.Future of its result """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """ Run a coroutine on the event loop waiting for its result """
+        return self.submit(coroutine).result()
+
+    def get_backoff(self, attempt, retry_after=None):
+        """ Get the seconds to wait before retrying after attempt (0 for the first) failed """
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                # Retry-After can also be an HTTP date which is not worth parsing here
+                pass
+        return random.uniform(0, min(self.backoff_factor * 2 ** attempt, self.max_backoff))
+
+    async def fetch(self, url, path=None):
+        """ Download url returning its text or, if path is given, streaming it to the file at path and
+        returning path. Raises DownloadError once there are no retries left.
+        """
+        aiohttp = self.aiohttp
+        attempt = 0
+        while True:
+            retry_after = None
+            cause = None
+            try:
+                async with self.session.get(url) as response:
+                    if response.status < 400:
+                        if path is None:
+                            return await response.text()
+                        with open(path, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(self.chunk_size):
+                                f.write(chunk)
+                        return path
+                    error = f'status {response.status}'
+                    if response.status not in self.retry_statuses:
+                        raise DownloadError(f'Download of {url} failed with {error}!')
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as ex:
+                error = repr(ex)
+                cause = ex
+            if attempt >= self.retries:
+                raise DownloadError(f'Download of {url} failed after {attempt + 1} attempts with {error}!') \
+                    from cause
+            backoff = self.get_backoff(attempt, retry_after)
+            logger.warning(f'Download of {Retrieve.get_url_logstr(url)} failed with {error}. '
+                           f'Retrying in {backoff:.2f}s')
+            self.retried += 1
+            attempt += 1
+            await asyncio.sleep(backoff)
+
+    def submit_text(self, url):
+        return self.submit(self.fetch(url))
+
+    def download_text(self, url):
+        return self.run(self.fetch(url))
+
+    def download_file(self, url, path):
+        return self.run(self.fetch(url, path))
+
+
+def parse_yaml(text):
+    return YAML().load(text)
+
+
+class AsyncRetrieve(Retrieve):
+    """
+    Retrieve that downloads with an AsyncDownload. retrieve_file, retrieve_text, retrieve_json
+    and retrieve_yaml have the same contract as in Retrieve (including saving, using saved data
+    and falling back to static data) and block, but can be called from any thread.
+    submit_file and submit_text start a retrieval and return a concurrent.futures.Future of
+    its result so that many can be in flight while the caller carries on.
+    """
+
+    async def retrieve_file_async(self, url, filename, logstr=None, fallback=False):
+        if not logstr:
+            logstr = filename
+        if self.save:
+            folder = self.saved_dir
+        else:
+            folder = self.temp_dir
+        output_path = join(folder, filename)
+        saved_path = join(self.saved_dir, filename)
+        if self.use_saved:
+            logger.info(f'Using saved {logstr} in {saved_path}')
+            return saved_path
+        try:
+            logger.info(f'Downloading {logstr} from {self.get_url_logstr(url)} into {output_path}')
+            return await self.downloader.fetch(url, output_path)
+        except DownloadError:
+            if not fallback:
+                raise
+            fallback_path = join(self.fallback_dir, filename)
+            logger.exception(f'{logstr} download failed, using static data {fallback_path}!')
+            return fallback_path
+
+    async def retrieve_async(self, url, filename, logstr, fallback, parse, load, save):
+        """ Retrieve text from url converting it with parse. Saved and static data are read with load
+        and downloaded data saved with save.
+        """
+        if not logstr:
+            logstr = filename
+        saved_path = join(self.saved_dir, filename)
+        if self.use_saved:
+            logger.info(f'Using saved {logstr} in {saved_path}')
+            return load(saved_path)
+        try:
+            logger.info(f'Downloading {logstr} from {self.get_url_logstr(url)}')
+            data = parse(await self.downloader.fetch(url))
+            if self.save:
+                logger.info(f'Saving {logstr} in {saved_path}')
+                save(data, saved_path)
+        except DownloadError:
+            if not fallback:
+                raise
+            fallback_path = join(self.fallback_dir, filename)
+            logger.exception(f'{logstr} download failed, using static data {fallback_path}!')
+            data = load(fallback_path)
+        return data
+
+    def submit_file(self, url, filename, logstr=None, fallback=False):
+        return self.downloader.submit(self.retrieve_file_async(url, filename, logstr, fallback))
+
+    def submit_text(self, url, filename, logstr=None, fallback=False):
+        return self.downloader.submit(self.retrieve_async(url, filename, logstr, fallback, str, load_file_to_str,
+                                                          save_str_to_file))
+
+    def retrieve_file(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return self.submit_file(url, filename, logstr, fallback).result()
+
+    def retrieve_text(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return self.submit_text(url, filename, logstr, fallback).result()
+
+    def retrieve_json(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return self.downloader.run(self.retrieve_async(url, filename, logstr, fallback, json.loads, load_json,
+                                                       save_json))
+
+    def retrieve_yaml(self, url, filename, logstr=None, fallback=False, **kwargs):
+        return self.downloader.run(self.retrieve_async(url, filename, logstr, fallback, parse_yaml, load_yaml,
+                                                       save_yaml))
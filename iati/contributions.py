@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from iati.activity import Activity
+from iati.filters import FilterRegistry
+from iati.fxrates import FXRates
+from iati.skipledger import SkipLedger
+from iati.transactioncolumns import TransactionColumns
+
+logger = logging.getLogger(__name__)
+
+
+def get_contribution(configuration, today_year_month, dactivity, context):
+    """
+    Processes an activity with the checks and org lookup of context returning its contribution
+    to the outputs in a form that can be stored as JSON: flows (key, row and values), split
+    transaction rows, number of skipped transactions, reporting orgs looked up, filter removals
+    and skip reasons. It also has what the orgs of the activity resolved to and the fx rates
+    used so that it can be checked against the org lookup and fx rates of a later run (see
+    is_contribution_current).
+    """
+    context = context.for_contribution()
+    flows = dict()
+    transactions = TransactionColumns()
+    activity, skipped = Activity.get_activity(configuration, dactivity, context)
+    if activity:
+        skipped += activity.process(today_year_month, flows, transactions, context)
+    return {'flows': [[list(key), flow['row'], flow['values']] for key, flow in flows.items()],
+            'transactions': list(transactions), 'skipped': skipped,
+            'orgs_lookedup': [list(org) for org in context.orgs_lookedup],
+            'filter_removals': [[rule, org_id] + counts for (rule, org_id), counts in context.filter_removals.items()],
+            'skip_reasons': [[reason, org_ref] + counts for (reason, org_ref), counts in context.skip_counts.items()],
+            'orgs_resolved': [[ref, orig_name, [list(narrative) for narrative in narratives], org_type,
+                               reporting_org, expenditure, org_info, list(org_lookedup) if org_lookedup else None]
+                              for (ref, orig_name, narratives, org_type, reporting_org, expenditure),
+                              (org_info, org_lookedup) in context.orgs_resolved.items()],
+            'fx_rates': [[currency, day, list(rate)] for (currency, day), rate in context.rates_used.items()]}
+
+
+def new_current_inputs():
+    """
+    Returns empty caches for a run of what stored orgs resolve to (keyed by raw org, reporting
+    org and expenditure) and of the fx rates of stored days in the form they are stored in so
+    that orgs and rates shared by many contributions are only looked up and converted once.
+    """
+    return {'orgs': dict(), 'fx_rates': dict()}
+
+
+def is_contribution_current(contribution, context, current_inputs):
+    """
+    Checks that the orgs of a stored contribution resolve to the same with the org lookup of
+    context and that the fx rates it used are the same as the current ones so that it can be
+    reused. The org lookup is built from each run's activities and current rates (and so
+    historic rates falling back on them) change daily, so these are checked for each
+    contribution rather than being part of the activity store's fingerprint. What the orgs
+    resolve to and the rates are cached in current_inputs (see new_current_inputs) which
+    must only be used for one run.
+    """
+    current_orgs = current_inputs['orgs']
+    for ref, orig_name, narratives, org_type, reporting_org, expenditure, org_info, org_lookedup in \
+            contribution['orgs_resolved']:
+        raw_org = ref, orig_name, tuple(tuple(narrative) for narrative in narratives), org_type
+        key = raw_org + (reporting_org, expenditure)
+        current = current_orgs.get(key)
+        if current is None:
+            current_org_info, current_org_lookedup = context.get_resolved_org_info(raw_org, reporting_org, expenditure)
+            current = current_org_info, list(current_org_lookedup) if current_org_lookedup else None
+            current_orgs[key] = current
+        if current[0] != org_info or current[1] != org_lookedup:
+            return False
+    current_rates = current_inputs['fx_rates']
+    for currency, day, rate in contribution['fx_rates']:
+        key = currency, day
+        current_rate = current_rates.get(key)
+        if current_rate is None:
+            current_rate = list(FXRates.get_rate_on_day(currency, day))
+            current_rates[key] = current_rate
+        if current_rate != rate:
+            return False
+    return True
+
+
+def add_contribution(accumulators, contribution):
+    """
+    Adds an activity's contribution to the flows, transactions, number of skipped transactions,
+    reporting orgs looked up, filter removals and skip reasons of accumulators.
+    """
+    flows = accumulators['flows']
+    for key, row, values in contribution['flows']:
+        key = tuple(key)
+        flow = flows.get(key)
+        if flow is None:
+            flows[key] = {'row': row, 'values': list(values)}
+        else:
+            flow['values'].extend(values)
+    accumulators['transactions'].add_rows(contribution['transactions'])
+    accumulators['skipped'] += contribution['skipped']
+    accumulators['orgs_lookedup'].update(tuple(org) for org in contribution['orgs_lookedup'])
+    FilterRegistry.merge_removals(accumulators['filter_removals'],
+                                  {(rule, org_id): counts for rule, org_id, *counts in contribution['filter_removals']})
+    SkipLedger.merge_counts(accumulators['skip_reasons'],
+                            {(reason, org_ref): counts for reason, org_ref, *counts in contribution['skip_reasons']})
+
+
+def new_accumulators():
+    """
+    Returns empty accumulators for the flows, transactions, number of skipped transactions,
+    skip reasons, reporting orgs looked up, filter removals and number of activities of an
+    output.
+    """
+    return {'flows': dict(), 'transactions': TransactionColumns(), 'skipped': 0, 'skip_reasons': dict(),
+            'orgs_lookedup': set(), 'filter_removals': dict(), 'activities': 0}
+
+
+def merge_flows(flows, partial_flows):
+    """
+    Adds partial flows to flows keeping the first row seen for each key. Values are summed
+    in the order they were seen so that totals are the same as from a single process.
+    """
+    for key, partial_flow in partial_flows.items():
+        flow = flows.get(key)
+        if flow is None:
+            flow = {'row': partial_flow['row'], 'value': 0}
+            flows[key] = flow
+        for value in partial_flow['values']:
+            flow['value'] += value
+
+
+def merge_result(totals, result):
+    """
+    Adds the flows, transactions, number of skipped transactions, skip reasons, reporting orgs
+    looked up, filter removals and number of activities of a result of process_activities to
+    the accumulators in totals. The flows in totals are summed.
+    """
+    merge_flows(totals['flows'], result['flows'])
+    totals['transactions'].extend(result['transactions'])
+    totals['skipped'] += result['skipped']
+    totals['activities'] += result['activities']
+    totals['orgs_lookedup'].update(result['orgs_lookedup'])
+    FilterRegistry.merge_removals(totals['filter_removals'], result['filter_removals'])
+    SkipLedger.merge_counts(totals['skip_reasons'], result['skip_reasons'])
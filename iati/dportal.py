@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from copy import copy
+from itertools import chain
+from operator import itemgetter
+from os import makedirs, remove
+from os.path import dirname, exists, join
+from shutil import rmtree
+from threading import local
+from urllib.parse import quote
+from xml.dom import pulldom
+from xml.sax import SAXParseException
+
+import diterator
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json, save_str_to_file
+from ratelimit import RateLimitDecorator, sleep_and_retry
+
+from iati.asyncretriever import AsyncRetrieve
+from iati.pagestore import PageStore, PageStoreWriter
+from iati.topicmatcher import TopicMatcher
+
+logger = logging.getLogger(__name__)
+
+generated_datetime_regex = re.compile(r'iati-activities:generated-datetime="([^"]*)"')
+last_updated_datetime_regex = re.compile(r'last-updated-datetime="([^"]*)"')
+identifier_regex = re.compile(r'<iati-identifier>([^<]*)</iati-identifier>')
+
+
+def get_dportal_url(dportal_configuration, whattorun, params, shard=''):
+    query = TopicMatcher.get(whattorun).dportal_query.format(params, shard=shard)
+    return dportal_configuration['url'] % quote(query)
+
+
+def get_rate_limiter(downloader):
+    """
+    Gets the RateLimitDecorator that a Download made with a rate_limit wraps its setup in or None if it has none
+    """
+    rate_limited_setup = getattr(downloader.setup, '__wrapped__', None)
+    for cell in getattr(rate_limited_setup, '__closure__', None) or ():
+        if isinstance(cell.cell_contents, RateLimitDecorator):
+            return cell.cell_contents
+    return None
+
+
+def copy_retriever(retriever):
+    """
+    Copies a retriever so that it can be used from another thread. The copy has its own Download object (sharing the
+    underlying session) because Download keeps the current response as state. If the Download has a rate limit, the
+    copy's setup is wrapped in the same RateLimitDecorator so that all of the copies share the one limit. An
+    AsyncRetrieve can be used from any thread as it is.
+    """
+    if isinstance(retriever, AsyncRetrieve):
+        return retriever
+    rate_limiter = get_rate_limiter(retriever.downloader)
+    downloader = copy(retriever.downloader)
+    downloader.response = None
+    if rate_limiter is None:
+        downloader.setup = downloader.normal_setup
+    else:
+        downloader.setup = sleep_and_retry(rate_limiter(downloader.normal_setup))
+    thread_retriever = copy(retriever)
+    thread_retriever.downloader = downloader
+    return thread_retriever
+
+
+def get_page_retriever(retriever, folder):
+    """
+    Gets a retriever that downloads pages of D-Portal activities into folder unless saving
+    (when they go in the saved folder) or using saved data (when they are used where they are).
+    """
+    if not retriever.save and not retriever.use_saved:
+        retriever = copy(retriever)
+        retriever.temp_dir = folder
+    return retriever
+
+
+def retrieve_dportal_page(retriever, url, filename, folder):
+    """
+    Streams a page of D-Portal activities to a file in folder (or the saved folder if saving)
+    returning its path. Saved pages are used where they are rather than being copied.
+    """
+    return get_page_retriever(retriever, folder).retrieve_file(url, filename, 'D-Portal activities', False)
+
+
+def has_activities(path):
+    """
+    Checks whether a page of D-Portal activities has any by parsing only as far as the first
+    activity. Once there are no more activities, D-Portal returns JSON rather than XML.
+    """
+    with open(path, 'rb') as page:
+        try:
+            for event, node in pulldom.parse(page):
+                if event == pulldom.START_ELEMENT and node.tagName == 'iati-activity':
+                    return True
+        except SAXParseException:
+            pass
+    return False
+
+
+def retrieve_dportal_concurrently(dportal_configuration, retriever, whattorun, workers, folder):
+    """
+    Downloads pages of activity data from D-Portal into folder using a pool of threads (or the event loop of an
+    AsyncRetrieve) keeping up to max_in_flight pages ahead of the consumer. Paths are yielded in offset order until
+    the first page that has no activities.
+    """
+    base_filename = dportal_configuration['filename']
+    dportal_limit = dportal_configuration['limit']
+    max_in_flight = max(dportal_configuration.get('max_in_flight', 2 * workers), 1)
+    thread_data = local()
+
+    def get_page_url(n):
+        offset = n * dportal_limit
+        logger.info(f'OFFSET {offset}')
+        return get_dportal_url(dportal_configuration, whattorun, f'LIMIT {dportal_limit} OFFSET {offset}')
+
+    def retrieve_page(n):
+        thread_retriever = getattr(thread_data, 'retriever', None)
+        if thread_retriever is None:
+            thread_retriever = copy_retriever(retriever)
+            thread_data.retriever = thread_retriever
+        return retrieve_dportal_page(thread_retriever, get_page_url(n), base_filename.format(n), folder)
+
+    with ExitStack() as stack:
+        if isinstance(retriever, AsyncRetrieve):
+            page_retriever = get_page_retriever(retriever, folder)
+
+            def submit_page(n):
+                return page_retriever.submit_file(get_page_url(n), base_filename.format(n), 'D-Portal activities',
+                                                  False)
+        else:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+
+            def submit_page(n):
+                return executor.submit(retrieve_page, n)
+
+        futures = deque()
+        next_n = 0
+        try:
+            while True:
+                while len(futures) < max_in_flight:
+                    futures.append(submit_page(next_n))
+                    next_n += 1
+                path = futures.popleft().result()
+                if not has_activities(path):
+                    # If the result doesn't contain any IATI activities, we're done
+                    break
+                yield path
+        finally:
+            # Pages beyond the last one are not needed (and may not exist when using saved data)
+            for future in futures:
+                future.cancel()
+
+
+def get_activity_sort_key(activity):
+    """
+    Gets the key that D-Portal orders activities by (generated-datetime, last-updated-datetime
+    and identifier) from the text of an iati-activity element. Missing values sort last as
+    in the D-Portal query.
+    """
+    start_tag = activity[:activity.index('>')]
+    key = list()
+    for regex in (generated_datetime_regex, last_updated_datetime_regex):
+        match = regex.search(start_tag)
+        key.append((False, match.group(1)) if match else (True, ''))
+    match = identifier_regex.search(activity)
+    key.append((False, match.group(1)) if match else (True, ''))
+    return tuple(key)
+
+
+def split_activities(text):
+    """
+    Splits a page of D-Portal activities returning the text before the first activity and
+    the text of each iati-activity element.
+    """
+    activities = list()
+    start = text.find('<iati-activity ')
+    header = text[:start]
+    while start != -1:
+        end = text.index('</iati-activity>', start) + len('</iati-activity>')
+        activities.append(text[start:end])
+        start = text.find('<iati-activity ', end)
+    return header, activities
+
+
+def join_activities(header, activities):
+    """
+    Makes a page of D-Portal activities from the text before the first activity and the text
+    of each iati-activity element.
+    """
+    return '%s%s\n</iati-activities>\n' % (header, '\n '.join(activities))
+
+
+def retrieve_dportal_shard(dportal_configuration, retriever, whattorun, shard, predicate, folder):
+    """
+    Downloads the pages of one shard of the D-Portal query into folder returning their paths.
+    Pages within the shard use LIMIT and OFFSET.
+    """
+    base_filename = dportal_configuration['filename']
+    dportal_limit = dportal_configuration['limit']
+    paths = list()
+    while True:
+        offset = len(paths) * dportal_limit
+        logger.info(f'Shard {shard} OFFSET {offset}')
+        url = get_dportal_url(dportal_configuration, whattorun, f'LIMIT {dportal_limit} OFFSET {offset}',
+                              f' HAVING {predicate}')
+        path = retrieve_dportal_page(retriever, url, base_filename.format(f'{shard}_{len(paths)}'), folder)
+        if not has_activities(path):
+            return paths
+        paths.append(path)
+
+
+def iterate_shard(paths):
+    """
+    Yields the sort key and text of the activities of a downloaded shard in sort order. Pages
+    are in sort order but the activities within them are not.
+    """
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            _, activities = split_activities(f.read())
+        yield from sorted(((get_activity_sort_key(activity), activity) for activity in activities),
+                          key=itemgetter(0))
+
+
+def retrieve_dportal_sharded(dportal_configuration, retriever, whattorun, workers, folder):
+    """
+    Downloads activity data from D-Portal with the query split into shards by the predicates
+    in the dportal configuration. Shards are downloaded concurrently into shards_folder with a
+    manifest of the completed ones so that an interrupted run downloads only the rest. The
+    activities of the shards are merged into D-Portal order and written to folder as pages of
+    limit activities whose paths are yielded.
+    """
+    base_filename = dportal_configuration['filename']
+    dportal_limit = dportal_configuration['limit']
+    predicates = dportal_configuration['shards']
+    shards_folder = f'{dportal_configuration.get("shards_folder", "dportal_shards")}_{whattorun}'
+    manifest_path = join(shards_folder, 'manifest.json')
+    query = {'url': get_dportal_url(dportal_configuration, whattorun, '{}', '{}'), 'limit': dportal_limit,
+             'shards': predicates}
+    manifest = None
+    if exists(manifest_path):
+        manifest = load_json(manifest_path)
+        if manifest['query'] != query:
+            logger.info('D-Portal query or shards have changed so not resuming')
+            manifest = None
+    if manifest is None:
+        rmtree(shards_folder, ignore_errors=True)
+        makedirs(shards_folder)
+        manifest = {'query': query, 'completed': dict()}
+        save_json(manifest, manifest_path)
+    completed = manifest['completed']
+    if completed:
+        logger.info(f'Resuming with {len(completed)} of {len(predicates)} shards already downloaded')
+    thread_data = local()
+
+    def retrieve_shard(shard):
+        thread_retriever = getattr(thread_data, 'retriever', None)
+        if thread_retriever is None:
+            thread_retriever = copy_retriever(retriever)
+            thread_data.retriever = thread_retriever
+        return retrieve_dportal_shard(dportal_configuration, thread_retriever, whattorun, shard, predicates[shard],
+                                      shards_folder)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(retrieve_shard, shard): shard for shard in range(len(predicates))
+                   if str(shard) not in completed}
+        error = None
+        for future in as_completed(futures):
+            try:
+                completed[str(futures[future])] = future.result()
+            except Exception as ex:
+                # Record the shards that do complete before raising so that they are not downloaded again
+                error = error or ex
+                continue
+            save_json(manifest, manifest_path)
+        if error is not None:
+            raise error
+
+    header = None
+    for shard in range(len(predicates)):
+        if completed[str(shard)]:
+            with open(completed[str(shard)][0], encoding='utf-8') as f:
+                header, _ = split_activities(f.read())
+            break
+    if header is not None:
+        shards = [iterate_shard(completed[str(shard)]) for shard in range(len(predicates))]
+        activities = list()
+        n = 0
+        for _, activity in heapq.merge(*shards, key=itemgetter(0)):
+            activities.append(activity)
+            if len(activities) == dportal_limit:
+                path = join(folder, base_filename.format(n))
+                save_str_to_file(join_activities(header, activities), path)
+                yield path
+                activities = list()
+                n += 1
+        if activities:
+            path = join(folder, base_filename.format(n))
+            save_str_to_file(join_activities(header, activities), path)
+            yield path
+    # All shards have been used so the next run starts afresh
+    rmtree(shards_folder, ignore_errors=True)
+
+
+def replay_saved_pages(dportal_configuration, saved_dir, folder, replay_pages=None):
+    """
+    Yields the paths of the saved pages of activity data in saved_dir (only those numbered in
+    replay_pages if given). Pages in a page store are decompressed into folder. Pages saved as
+    files are used where they are.
+    """
+    if PageStore.exists(saved_dir):
+        with PageStore(saved_dir) as store:
+            logger.info(f'Using saved pages in {saved_dir} compressed with {store.compression}')
+            for page in store.pages:
+                if replay_pages is None or page['page'] in replay_pages:
+                    yield store.extract(page, folder)
+        return
+    base_filename = dportal_configuration['filename']
+    for n in sorted(replay_pages):
+        yield join(saved_dir, base_filename.format(n))
+
+
+def save_pages(store_configuration, pages, saved_dir):
+    """
+    Adds the pages of activity data at the paths in pages to a page store in saved_dir as they
+    are yielded. The store is only written once all of the pages have been.
+    """
+    with PageStoreWriter(saved_dir, store_configuration.get('compression', 'gzip'),
+                         store_configuration.get('level')) as writer:
+        for n, path in enumerate(pages):
+            writer.add(n, path)
+            yield path
+
+
+def retrieve_dportal(configuration, retriever, dportal_params, whattorun, folder, replay_pages=None):
+    """
+    Downloads pages of activity data from D-Portal streaming them to files
+    in folder and yields their paths. If workers is set to more than 1 in
+    the dportal configuration or the retriever is an AsyncRetrieve, pages
+    are downloaded concurrently. If shards are set, the query is split into
+    shards. If saved_store is set, saved pages are kept in a page store.
+    When using saved data, only the pages numbered in replay_pages are used
+    if it is given.
+    """
+    dportal_configuration = configuration['dportal']
+    if retriever.use_saved and (replay_pages is not None or PageStore.exists(retriever.saved_dir)):
+        yield from replay_saved_pages(dportal_configuration, retriever.saved_dir, folder, replay_pages)
+        return
+    store_configuration = dportal_configuration.get('saved_store')
+    if retriever.save and store_configuration:
+        # Pages are downloaded into folder and added to the store rather than saved as files
+        store_retriever = copy(retriever)
+        store_retriever.save = False
+        yield from save_pages(store_configuration,
+                              retrieve_dportal(configuration, store_retriever, dportal_params, whattorun, folder),
+                              retriever.saved_dir)
+        return
+    workers = dportal_configuration.get('workers', 1)
+    if not dportal_params and dportal_configuration.get('shards'):
+        yield from retrieve_dportal_sharded(dportal_configuration, retriever, whattorun, workers, folder)
+        return
+    if not dportal_params and (workers > 1 or isinstance(retriever, AsyncRetrieve)):
+        yield from retrieve_dportal_concurrently(dportal_configuration, retriever, whattorun, workers, folder)
+        return
+    base_filename = dportal_configuration['filename']
+    dportal_limit = dportal_configuration['limit']
+    n = 0
+    dont_exit = True
+    while dont_exit:
+        if dportal_params:
+            params = dportal_params
+            dont_exit = False
+        else:
+            offset = n * dportal_limit
+            params = f'LIMIT {dportal_limit} OFFSET {offset}'
+            logger.info(f'OFFSET {offset}')
+        url = get_dportal_url(dportal_configuration, whattorun, params)
+        path = retrieve_dportal_page(retriever, url, base_filename.format(n), folder)
+        if has_activities(path):
+            n += 1
+            yield path
+        else:
+            # If the result doesn't contain any IATI activities, we're done
+            dont_exit = False
+
+
+def retrieve_dportal_topics(configuration, retrievers, dportal_params, folder, activity_topics, page_keys,
+                            topic_keys, replay_pages=None):
+    """
+    Downloads the pages of activity data of each topic (a dict of topic to retriever) from
+    D-Portal, the topics after the first in background threads, and merges them into pages of
+    unique activities in folder whose paths are yielded. Activities are identified by the key
+    D-Portal orders them by. Each topic's activities are kept in the topic's order: before an
+    activity is added, the activities that come before it in the later topics that have it are
+    added. (If D-Portal gives activities in more than one topic in a different order for each,
+    the order of the earlier topic wins.) activity_topics is filled with the topics of each
+    activity key, page_keys with the activity keys of each merged page and topic_keys (a dict
+    of topic to list) with the activity keys of each topic in its order so that activities can
+    be routed to their topics and each topic's org lookup built once all the pages have been
+    merged. When using saved data, only the pages numbered in replay_pages are used if it is
+    given.
+    """
+    dportal_configuration = configuration['dportal']
+    base_filename = dportal_configuration['filename']
+    dportal_limit = dportal_configuration['limit']
+    topics = list(retrievers)
+    for topic in topics:
+        topic_keys[topic] = list()
+    # Activities mostly share a few combinations of topics so one tuple is kept per combination
+    topic_tuples = dict()
+    # The position of each activity key in each topic after the first, their activities and how many
+    # of those have been merged
+    positions = dict()
+    topic_activities = dict()
+    no_merged = dict()
+    header = None
+    activities = list()
+    keys = list()
+
+    def retrieve_topic(topic):
+        topic_folder = join(folder, topic)
+        makedirs(topic_folder)
+        retriever = retrievers[topic]
+        if topic != topics[0]:
+            retriever = copy_retriever(retriever)
+        return retrieve_dportal(configuration, retriever, dportal_params, topic, topic_folder, replay_pages)
+
+    def read_pages(topic, paths):
+        nonlocal header
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                page_header, page_activities = split_activities(f.read())
+            # Pages in the topic's folder were downloaded or decompressed there rather than saved
+            if dirname(path) == join(folder, topic):
+                remove(path)
+            if header is None:
+                header = page_header
+            for activity in page_activities:
+                yield get_activity_sort_key(activity), activity
+
+    def write_page():
+        nonlocal activities, keys
+        path = join(folder, base_filename.format(len(page_keys)))
+        save_str_to_file(join_activities(header, activities), path)
+        page_keys.append(keys)
+        activities = list()
+        keys = list()
+        return path
+
+    def merge_activity(topic, key, activity):
+        for later_topic in topics[topics.index(topic) + 1:]:
+            position = positions[later_topic].get(key)
+            if position is not None:
+                yield from merge_topic(later_topic, position)
+        key_topics = activity_topics.get(key)
+        if key_topics is not None and topic not in key_topics:
+            key_topics = key_topics + (topic,)
+            activity_topics[key] = topic_tuples.setdefault(key_topics, key_topics)
+            return
+        if key_topics is None:
+            activity_topics[key] = topic_tuples.setdefault((topic,), (topic,))
+        activities.append(activity)
+        keys.append(key)
+        if len(activities) == dportal_limit:
+            yield write_page()
+
+    def merge_topic(topic, end):
+        """ Merge the activities of a topic after the first up to position end """
+        while no_merged[topic] < end:
+            no_merged[topic] += 1
+            yield from merge_activity(topic, *next(topic_activities[topic]))
+
+    with ThreadPoolExecutor(max_workers=max(len(topics) - 1, 1)) as executor:
+        futures = {topic: executor.submit(list, retrieve_topic(topic)) for topic in topics[1:]}
+        # The first topic is downloaded while waiting for the others as their keys are needed to merge
+        paths = retrieve_topic(topics[0])
+        first_paths = list()
+        for path in paths:
+            first_paths.append(path)
+            if all(future.done() for future in futures.values()):
+                break
+        for topic in topics[1:]:
+            topic_paths = futures[topic].result()
+            for path in topic_paths:
+                with open(path, encoding='utf-8') as f:
+                    _, page_activities = split_activities(f.read())
+                topic_keys[topic].extend(get_activity_sort_key(activity) for activity in page_activities)
+            positions[topic] = {key: position for position, key in enumerate(topic_keys[topic])}
+            topic_activities[topic] = read_pages(topic, topic_paths)
+            no_merged[topic] = 0
+        for key, activity in read_pages(topics[0], chain(first_paths, paths)):
+            topic_keys[topics[0]].append(key)
+            yield from merge_activity(topics[0], key, activity)
+        for topic in topics[1:]:
+            yield from merge_topic(topic, len(topic_keys[topic]))
+    if activities:
+        yield write_page()
+
+
+def iterate_activities(paths):
+    """
+    Parses the pages of D-Portal activities at paths one activity at a time. Each activity's
+    elements are released once the consumer has moved on to the next one.
+    """
+    for path in paths:
+        with open(path, 'rb') as page:
+            for dactivity in diterator.XMLIterator(page):
+                yield dactivity
+                # Break the activity's DOM reference cycles so it is freed without waiting for gc
+                dactivity.node.unlink()
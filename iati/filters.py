@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import logging
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import hxl
+
+logger = logging.getLogger(__name__)
+
+
+class FilterRegistry:
+    """ Registry of org filter rules. Each rule is a set of org ids so that checking membership is O(1).
+    The number of activities and transactions removed by each rule is counted per org id in a dict of
+    (rule, org id) to counts which belongs to the output being processed (see ProcessingContext).
+    """
+    def __init__(self):
+        self.rules = dict()
+
+    def add(self, rule, org_id):
+        self.rules.setdefault(rule, set()).add(org_id)
+
+    def load(self, url_or_path, hxltag_to_rule):
+        """ Load org ids from a url or a local CSV/HXL file. hxltag_to_rule maps the hxltag of each column
+        to read to the rule to which its org ids are added.
+        """
+        allow_local = not urlsplit(url_or_path).scheme
+        self.load_rows(hxl.data(url_or_path, allow_local=allow_local), hxltag_to_rule)
+
+    def load_text(self, text, hxltag_to_rule):
+        """ Load org ids from the text of a CSV/HXL file that has already been downloaded """
+        self.load_rows(hxl.data(BytesIO(text.encode('utf-8'))), hxltag_to_rule)
+
+    def load_rows(self, rows, hxltag_to_rule):
+        for rule in hxltag_to_rule.values():
+            self.rules.setdefault(rule, set())
+        for row in rows:
+            for hxltag, rule in hxltag_to_rule.items():
+                org_id = row.get(hxltag)
+                if org_id:
+                    self.add(rule, org_id)
+
+    def contains(self, rule, org_id):
+        return org_id in self.rules.get(rule, ())
+
+    @staticmethod
+    def record_removal(removals, rule, org_id, no_transactions):
+        key = rule, org_id
+        counts = removals.get(key)
+        if counts is None:
+            counts = [0, 0]
+            removals[key] = counts
+        counts[0] += 1
+        counts[1] += no_transactions
+
+    @staticmethod
+    def merge_removals(removals, partial_removals):
+        for (rule, org_id), (no_activities, no_transactions) in partial_removals.items():
+            counts = removals.setdefault((rule, org_id), [0, 0])
+            counts[0] += no_activities
+            counts[1] += no_transactions
+
+    @staticmethod
+    def log_removals(removals):
+        for (rule, org_id), (no_activities, no_transactions) in sorted(removals.items()):
+            logger.info(f'Filter {rule} {org_id} removed {no_activities} activities and {no_transactions} transactions')
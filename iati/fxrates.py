@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import logging
+from os.path import exists, join
+
+import exchangerates
+from hdx.location.currency import Currency, CurrencyError
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class FXRates:
+    """ Memoised conversion of values to USD on top of Currency. Parsed dates and the fx rate for
+    each (currency, day) are cached and the rate table can be saved and loaded with the saved data
+    so that reruns using saved data do not have to look up rates.
+    """
+    filename = 'fx_rates.json'
+    dates = dict()
+    rates = dict()
+    new_rates = dict()
+    hits = 0
+    misses = 0
+    fallbacks = 0
+
+    @classmethod
+    def setup(cls, retriever=None):
+        cls.dates = dict()
+        cls.rates = dict()
+        cls.new_rates = dict()
+        cls.hits = 0
+        cls.misses = 0
+        cls.fallbacks = 0
+        if retriever is not None and retriever.use_saved:
+            path = join(retriever.saved_dir, cls.filename)
+            if exists(path):
+                logger.info(f'Using saved fx rates in {path}')
+                for currency, day_rates in load_json(path).items():
+                    for day, (fx_rate, fallback) in day_rates.items():
+                        cls.rates[(currency, day)] = fx_rate, fallback
+
+    @classmethod
+    def save(cls, folder):
+        day_rates_by_currency = dict()
+        for (currency, day), rate in sorted(cls.rates.items()):
+            day_rates_by_currency.setdefault(currency, dict())[day] = rate
+        path = join(folder, cls.filename)
+        logger.info(f'Saving fx rates in {path}')
+        save_json(day_rates_by_currency, path)
+
+    @classmethod
+    def get_state(cls):
+        return cls.rates
+
+    @classmethod
+    def set_state(cls, rates):
+        cls.setup()
+        cls.rates = rates
+
+    @classmethod
+    def take_new_rates(cls):
+        """ Return the rates looked up since the last call so that they can be merged into the parent process """
+        new_rates = cls.new_rates
+        cls.new_rates = dict()
+        return new_rates
+
+    @classmethod
+    def merge_rates(cls, rates):
+        cls.rates.update(rates)
+
+    @classmethod
+    def parse_date(cls, date):
+        parsed_date = cls.dates.get(date)
+        if parsed_date is None:
+            parsed_date = parse_date(date)
+            cls.dates[date] = parsed_date
+        return parsed_date
+
+    @classmethod
+    def get_rate(cls, currency, date, rates_used=None):
+        """ Get the fx rate and whether it fell back on the current rate in the same way as
+        Currency.get_historic_value_in_usd. If rates_used is a dict, the rate is recorded in it.
+        """
+        key = currency, date.date().isoformat()
+        rate = cls.rates.get(key)
+        if rate is not None:
+            cls.hits += 1
+        else:
+            cls.misses += 1
+            rate = cls.look_up_rate(currency, date)
+            cls.rates[key] = rate
+            cls.new_rates[key] = rate
+        if rates_used is not None:
+            rates_used[key] = rate
+        return rate
+
+    @staticmethod
+    def look_up_rate(currency, date):
+        if Currency._historic_rates:
+            try:
+                return Currency.get_historic_rate(currency, date), False
+            except exchangerates.UnknownCurrencyException:
+                pass
+        if not Currency._fallback_to_current:
+            raise CurrencyError(f'Currency {currency} is invalid!')
+        return Currency.get_current_rate(currency), True
+
+    @classmethod
+    def get_rate_on_day(cls, currency, day):
+        """ Get the fx rate as get_rate does for a day given as an ISO date """
+        return cls.get_rate(currency, cls.parse_date(day))
+
+    @classmethod
+    def get_value_in_usd(cls, value, currency, date, rates_used=None):
+        """ Get the USD value of the value in currency on the date (as a string) recording the rate
+        in rates_used if it is a dict
+        """
+        date = cls.parse_date(date)
+        currency = currency.upper()
+        if currency == 'USD':
+            return value
+        fx_rate, fallback = cls.get_rate(currency, date, rates_used)
+        if fallback:
+            cls.fallbacks += 1
+        return value / fx_rate
+
+    @classmethod
+    def get_values_in_usd(cls, conversions, rates_used=None):
+        """ Convert a batch of (value, currency, date) to USD. The result for a conversion is None if
+        its currency or date is missing or invalid.
+        """
+        values = list()
+        for value, currency, date in conversions:
+            try:
+                values.append(cls.get_value_in_usd(value, currency, date, rates_used))
+            except (ValueError, AttributeError):
+                values.append(None)
+        return values
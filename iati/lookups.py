@@ -1,21 +1,23 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import logging
-import re
+from collections import OrderedDict
+from os import replace
+from time import perf_counter
+from urllib.parse import urlsplit
 
-import hxl
 from hdx.location.country import Country
 from hdx.utilities.loader import load_json
 
+from iati.filters import FilterRegistry
+from iati.stringcleaner import StringCleaner
+
 logger = logging.getLogger(__name__)
 
 
 def clean_string(s):
-    # Normalise one or more whitespaces to a single space and remove any punctuation at the start/end except
-    # for any trailing full stop
-    s = re.sub(r'(\W)\1+', r'\1', s.strip())
-    s = re.sub(r'\s', ' ', s)
-    s = re.sub(r'^\W?([\w &]*)[^a-zA-Z0-9_\.]?$', r'\1', s)
-    return s.strip()
+    return StringCleaner.clean(s)
 
 
 def clean_region(region):
@@ -25,12 +27,17 @@ def clean_region(region):
 
 
 class Lookups:
-    org_ref_blocklist = list()
     org_ref_to_name = dict()
     org_ref_to_type = dict()
     org_names_to_ref = dict()
     org_names_to_type = dict()
-    orgs_lookedup = set()
+    # The org lookup of each topic when several topics are run in one pass
+    topic_org_lookups = dict()
+    # The org info cache of the run (keyed by None) or of each topic
+    org_info_caches = dict()
+    org_info_cache_size = None
+    org_info_cache_hits = 0
+    org_info_cache_misses = 0
     default_org_id = None
     default_org_name = None
     default_expenditure_org_name = None
@@ -38,75 +45,242 @@ class Lookups:
     default_sector = None
     region_code_to_name = dict()
     default_country_region = None
-    filter_reporting_orgs = list()
-    filter_reporting_orgs_children = list()
+    sector_group_names = dict()
+    country_region_names = dict()
+    filters = FilterRegistry()
     checks = None
     filter_transaction_date = None
+    state_keys = ('org_ref_to_name', 'org_ref_to_type', 'org_names_to_ref', 'org_names_to_type', 'default_org_id',
+                  'default_org_name', 'default_expenditure_org_name', 'sector_info', 'default_sector',
+                  'region_code_to_name', 'default_country_region', 'sector_group_names', 'country_region_names',
+                  'filters', 'checks', 'filter_transaction_date', 'org_info_cache_size', 'topic_org_lookups')
+    # The state built from each run's activities
+    org_lookup_keys = ('org_ref_to_name', 'org_ref_to_type', 'org_names_to_ref', 'org_names_to_type')
+    # Increment when the preparation of the snapshot (eg. string cleaning) changes
+    snapshot_version = 1
 
     @classmethod
-    def setup(cls, configuration):
+    def setup(cls, configuration, snapshot_path=None, offline=False, downloader=None):
+        """ Set up the lookups. If snapshot_path is given, the prepared org, sector and region maps and filters
+        are taken from the snapshot there if it is valid and the snapshot is (re)written if not. If offline,
+        the filters are taken from the snapshot rather than downloaded. If an AsyncDownload is given, the
+        filter urls are downloaded together while the maps are being prepared.
+        """
         logger.info('Reading in lookups data')
+        start_time = perf_counter()
+        StringCleaner.setup(configuration.get('clean_string_memo_size', 100000))
+        cls.default_org_id = configuration['default_org_id']
+        cls.default_org_name = configuration['default_org_name']
+        cls.default_expenditure_org_name = configuration['default_expenditure_org_name']
+
+        cls.default_sector = configuration['default_sector']
+        cls.default_country_region = configuration['default_country_region']
+        filter_texts = None
+        if downloader is not None and not offline:
+            filter_texts = cls.submit_filters(configuration, downloader)
+        snapshot = None
+        sources = None
+        if snapshot_path:
+            sources = cls.get_snapshot_sources(configuration)
+            snapshot = cls.load_snapshot(snapshot_path, sources)
+        from_snapshot = snapshot is not None
+        if not from_snapshot:
+            if offline:
+                raise ValueError(f'Cannot run offline without a valid lookups snapshot {snapshot_path}!')
+            snapshot = cls.prepare_snapshot(configuration)
+        save = bool(snapshot_path) and not from_snapshot
+        # The org lookup starts afresh so that it is only built from this run's activities
+        cls.org_ref_to_name = dict(snapshot['org_ref_to_name'])
+        cls.org_ref_to_type = dict()
+        cls.org_names_to_ref = dict(snapshot['org_names_to_ref'])
+        cls.org_names_to_type = dict()
+        cls.topic_org_lookups = dict()
+        cls.sector_info = snapshot['sector_info']
+        cls.region_code_to_name.update(snapshot['region_code_to_name'])
+        cls.setup_split_names()
+        cls.filters = FilterRegistry()
+        if offline:
+            logger.info('Using filters from lookups snapshot')
+            for rule, org_ids in snapshot['filters'].items():
+                cls.filters.rules[rule] = set(org_ids)
+        else:
+            cls.load_filters(configuration, filter_texts)
+            filters = {rule: sorted(org_ids) for rule, org_ids in cls.filters.rules.items()}
+            if snapshot.get('filters') != filters:
+                snapshot['filters'] = filters
+                save = bool(snapshot_path)
+        if save:
+            cls.save_snapshot(snapshot_path, sources, snapshot)
+        source = ' from snapshot' if from_snapshot else ''
+        logger.info(f'Set up lookups{source} in {perf_counter() - start_time:.3f}s')
+
+    @staticmethod
+    def prepare_snapshot(configuration):
+        """ Prepare the org, sector and region maps from the source data """
+        org_ref_to_name = dict()
+        org_names_to_ref = dict()
         org_data = load_json(configuration['org_data'])
         """ Map from IATI identifiers to organisation names """
         # Prime with org identifiers from code4iati
         for entry in org_data['data']:
             code = clean_string(entry['code']).lower()
             name = clean_string(entry['name'])
-            cls.org_ref_to_name[code] = name
-            cls.org_names_to_ref[name.lower()] = code
-        cls.sector_info = load_json(configuration['sector_data'])
+            org_ref_to_name[code] = name
+            org_names_to_ref[name.lower()] = code
+        sector_info = load_json(configuration['sector_data'])
+        region_code_to_name = dict()
         region_data = load_json(configuration['region_data'])
         """ Map from region codes to region names """
         # Prime with region codes from code4iati
         for entry in region_data['data']:
             code = clean_string(entry['code']).lower()
             name = clean_region(entry['name'])
-            cls.region_code_to_name[code] = name
-        cls.default_org_id = configuration['default_org_id']
-        cls.default_org_name = configuration['default_org_name']
-        cls.default_expenditure_org_name = configuration['default_expenditure_org_name']
+            region_code_to_name[code] = name
+        return {'org_ref_to_name': org_ref_to_name, 'org_names_to_ref': org_names_to_ref,
+                'sector_info': sector_info, 'region_code_to_name': region_code_to_name}
 
-        cls.default_sector = configuration['default_sector']
-        cls.default_country_region = configuration['default_country_region']
-        for row in hxl.data(configuration['filters_url']):
-            org_id = row.get('#org+reporting+id')
-            if org_id:
-                cls.filter_reporting_orgs.append(org_id)
-            org_id = row.get('#org+reporting_children+id')
-            if org_id:
-                cls.filter_reporting_orgs_children.append(org_id)
-        for row in hxl.data(configuration['blocklist_url']):
-            org_id = row.get('#org+reporting+id')
-            if org_id:
-                cls.org_ref_blocklist.append(org_id)
+    @staticmethod
+    def get_filter_sources(configuration):
+        filter_hxltags = {'#org+reporting+id': 'reporting_orgs', '#org+reporting_children+id': 'reporting_orgs_children'}
+        blocklist_hxltags = {'#org+reporting+id': 'org_ref_blocklist'}
+        for key, hxltag_to_rule in (('filters_url', filter_hxltags), ('filters_file', filter_hxltags),
+                                    ('blocklist_url', blocklist_hxltags), ('blocklist_file', blocklist_hxltags)):
+            url_or_path = configuration.get(key)
+            if url_or_path:
+                yield url_or_path, hxltag_to_rule
+
+    @classmethod
+    def submit_filters(cls, configuration, downloader):
+        """ Start downloading the filter urls with an AsyncDownload returning a dict of url to future text """
+        return {url: downloader.submit_text(url) for url, _ in cls.get_filter_sources(configuration)
+                if urlsplit(url).scheme}
+
+    @classmethod
+    def load_filters(cls, configuration, filter_texts=None):
+        """ Load the filters from their urls or files. filter_texts is a dict of url to future text for
+        urls that are already being downloaded.
+        """
+        for url_or_path, hxltag_to_rule in cls.get_filter_sources(configuration):
+            future_text = (filter_texts or dict()).get(url_or_path)
+            if future_text is None:
+                cls.filters.load(url_or_path, hxltag_to_rule)
+            else:
+                cls.filters.load_text(future_text.result(), hxltag_to_rule)
+
+    @staticmethod
+    def get_snapshot_sources(configuration):
+        """ Get what a snapshot depends on: the lookups configuration and hashes of the local source files """
+        sources = {'configuration': json.dumps(dict(configuration), sort_keys=True)}
+        for key in ('org_data', 'sector_data', 'region_data', 'filters_file', 'blocklist_file'):
+            path = configuration.get(key)
+            if path:
+                with open(path, 'rb') as f:
+                    sources[key] = hashlib.sha256(f.read()).hexdigest()
+        return sources
+
+    @staticmethod
+    def get_snapshot_checksum(sources, snapshot):
+        text = json.dumps({'sources': sources, 'snapshot': snapshot}, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load_snapshot(cls, path, sources):
+        """ Load a snapshot returning None if there isn't one, it is from a different version, it is
+        corrupt or its sources have changed
+        """
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            logger.info(f'No lookups snapshot {path}')
+            return None
+        except ValueError:
+            logger.warning(f'Lookups snapshot {path} is corrupt!')
+            return None
+        if saved.get('version') != cls.snapshot_version:
+            logger.info(f'Lookups snapshot {path} is from a different version')
+            return None
+        if saved.get('checksum') != cls.get_snapshot_checksum(saved.get('sources'), saved.get('snapshot')):
+            logger.warning(f'Lookups snapshot {path} is corrupt!')
+            return None
+        if saved['sources'] != sources:
+            logger.info(f'Lookups snapshot {path} is out of date')
+            return None
+        return saved['snapshot']
+
+    @classmethod
+    def save_snapshot(cls, path, sources, snapshot):
+        logger.info(f'Saving lookups snapshot {path}')
+        saved = {'version': cls.snapshot_version, 'checksum': cls.get_snapshot_checksum(sources, snapshot),
+                 'sources': sources, 'snapshot': snapshot}
+        # Write to a temporary file first so that an interrupted save doesn't replace a good snapshot
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(saved, f, separators=(',', ':'))
+        replace(temp_path, path)
+
+    @classmethod
+    def get_state(cls):
+        """ Get the lookup tables and settings so that they can be copied to worker processes """
+        return {key: getattr(cls, key) for key in cls.state_keys}
+
+    @classmethod
+    def set_state(cls, state):
+        for key, value in state.items():
+            setattr(cls, key, value)
 
     @classmethod
     def is_filter_reporting_orgs(cls, orgid):
-        return True if orgid in cls.filter_reporting_orgs else False
+        return cls.filters.contains('reporting_orgs', orgid)
 
     @classmethod
     def is_filter_reporting_orgs_children(cls, orgid):
-        return True if orgid in cls.filter_reporting_orgs_children else False
+        return cls.filters.contains('reporting_orgs_children', orgid)
+
+    @classmethod
+    def is_org_ref_blocklisted(cls, ref):
+        return cls.filters.contains('org_ref_blocklist', ref)
+
+    @staticmethod
+    def get_raw_org(org):
+        """ Get the ref, default name, narratives and type of an org. The default name is chosen as in
+        NarrativeText.__str__ without getting the narratives again.
+        """
+        if org is None:
+            return None, None, (), None
+        name = org.name
+        if name is None:
+            orig_name = None
+            narratives = dict()
+        else:
+            narratives = name.narratives
+            default_language = name.activity.default_language
+            if default_language in narratives:
+                orig_name = narratives[default_language]
+            elif 'en' in narratives:
+                orig_name = narratives['en']
+            elif narratives:
+                orig_name = next(iter(narratives.values()))
+            else:
+                orig_name = ''
+        return org.ref, orig_name, tuple(narratives.items()), org.type
 
     @staticmethod
-    def get_cleaned_ref_name_type(org):
-        ref = None if org is None or org.ref is None else clean_string(str(org.ref)).lower()
+    def clean_raw_org(ref, orig_name, narratives, org_type):
+        ref = None if ref is None else clean_string(str(ref)).lower()
         other_names = list()
-        orig_name = None
         org_name = None
-        org_type = None
-        if org:
-            if org.name:
-                orig_name = clean_string(str(org.name))
-                for key, value in org.name.narratives.items():
-                    value = clean_string(value)
-                    if value:
-                        if key.lower() == 'en':
-                            org_name = value
-                        else:
-                            other_names.append(value)
-            if org.type:
-                org_type = org.type
+        if orig_name is not None:
+            orig_name = clean_string(orig_name)
+            for key, value in narratives:
+                value = clean_string(value)
+                if value:
+                    if key.lower() == 'en':
+                        org_name = value
+                    else:
+                        other_names.append(value)
+        if not org_type:
+            org_type = None
         names = list()
         if org_name:
             names.append(org_name)
@@ -116,9 +290,17 @@ class Lookups:
             [names.append(x) for x in other_names if x not in names]
         return ref, names, org_type
 
+    @classmethod
+    def get_cleaned_ref_name_type(cls, org):
+        return cls.clean_raw_org(*cls.get_raw_org(org))
+
     @classmethod
     def add_to_org_lookup(cls, org, is_participating_org=False):
         ref, names, org_type = cls.get_cleaned_ref_name_type(org)
+        cls.add_cleaned_to_org_lookup(ref, names, org_type, is_participating_org)
+
+    @classmethod
+    def add_cleaned_to_org_lookup(cls, ref, names, org_type, is_participating_org=False):
         for name in names:
             lower_name = name.lower()
             cur_ref = cls.org_names_to_ref.get(lower_name)
@@ -126,7 +308,7 @@ class Lookups:
                 if cur_ref not in cls.org_ref_to_name:
                     cls.org_ref_to_name[cur_ref] = name
             if ref and ref != lower_name:
-                if is_participating_org and ref in cls.org_ref_blocklist:
+                if is_participating_org and cls.is_org_ref_blocklisted(ref):
                     continue
                 if cur_ref:
                     if ref not in cls.org_ref_to_name:
@@ -140,34 +322,99 @@ class Lookups:
             elif org_type and lower_name not in cls.org_names_to_type:
                 cls.org_names_to_type[lower_name] = org_type
         if org_type:
-            if is_participating_org and ref and ref in cls.org_ref_blocklist:
+            if is_participating_org and ref and cls.is_org_ref_blocklisted(ref):
                 return
             if ref and ref not in cls.org_ref_to_type:
                 cls.org_ref_to_type[ref] = org_type
 
     @classmethod
-    def get_org_info(cls, org, reporting_org=False, expenditure=False):
-        """ Standardise organisation names
+    def get_org_lookup(cls, topic=None):
+        """ Get the org lookup tables of the run or if topic is given, of the topic """
+        if topic is not None:
+            return cls.topic_org_lookups[topic]
+        return {key: getattr(cls, key) for key in cls.org_lookup_keys}
+
+    @classmethod
+    def set_org_lookup(cls, org_lookup):
+        for key in cls.org_lookup_keys:
+            setattr(cls, key, org_lookup[key])
+
+    @classmethod
+    def get_org_info_cache(cls, topic=None):
+        """ Get the org info cache of the run or if topic is given, of the topic as what orgs resolve to
+        depends on the org lookup. It is None if there is no caching.
+        """
+        if topic not in cls.org_info_caches:
+            cls.org_info_caches[topic] = cls.new_org_info_cache(cls.org_info_cache_size)
+        return cls.org_info_caches[topic]
+
+    @staticmethod
+    def new_org_info_cache(size):
+        if size == 0:
+            return None
+        if size is None:
+            return dict()
+        return OrderedDict()
+
+    @classmethod
+    def setup_org_info_cache(cls, size=None):
+        """ Set up the caches of resolved org info. This must be done after the lookup tables are final.
+        If size is None, the caches are unbounded, if it is 0 there is no caching, otherwise the least
+        recently used entries are evicted when a cache is full.
+        """
+        cls.org_info_cache_size = size
+        cls.org_info_caches = dict()
+        cls.org_info_cache_hits = 0
+        cls.org_info_cache_misses = 0
+
+    @classmethod
+    def get_resolved_org_info(cls, org_lookup, org_info_cache, raw_org, reporting_org=False, expenditure=False):
+        """ Get the org info and reporting org looked up (as returned by resolve_org_info) of the output of
+        get_raw_org with org_lookup using org_info_cache if it is not None. The org info must not be changed.
+        """
+        if org_info_cache is None:
+            return cls.resolve_org_info(org_lookup, *cls.clean_raw_org(*raw_org), reporting_org, expenditure)
+        key = raw_org + (reporting_org, expenditure)
+        cached = org_info_cache.get(key)
+        if cached is None:
+            cls.org_info_cache_misses += 1
+            cached = cls.resolve_org_info(org_lookup, *cls.clean_raw_org(*raw_org), reporting_org, expenditure)
+            org_info_cache[key] = cached
+            if cls.org_info_cache_size and len(org_info_cache) > cls.org_info_cache_size:
+                org_info_cache.popitem(last=False)
+        else:
+            cls.org_info_cache_hits += 1
+            if cls.org_info_cache_size:
+                org_info_cache.move_to_end(key)
+        return cached
+
+    @classmethod
+    def resolve_org_info(cls, org_lookup, ref, names, org_type, reporting_org=False, expenditure=False):
+        """ Standardise organisation names using the tables of org_lookup (see get_org_lookup)
         For now, use the first name found for an identifier.
         Later, we can reference the registry.
+        Returns the org info and the reporting org looked up (if any).
         """
+        org_ref_to_name = org_lookup['org_ref_to_name']
+        org_ref_to_type = org_lookup['org_ref_to_type']
+        org_names_to_ref = org_lookup['org_names_to_ref']
+        org_names_to_type = org_lookup['org_names_to_type']
         if expenditure:
             default_org_name = cls.default_expenditure_org_name
         else:
             default_org_name = cls.default_org_name
-        ref, names, org_type = cls.get_cleaned_ref_name_type(org)
 
         refs = list()
         if ref:
             refs.append(ref)
         for name in names:
             if name:
-                associated_ref = cls.org_names_to_ref.get(name.lower())
+                associated_ref = org_names_to_ref.get(name.lower())
                 if associated_ref and associated_ref not in refs:
                     refs.append(associated_ref)
         # In case ref is being misused as a name
         if ref and not names:
-            ref = cls.org_names_to_ref.get(ref.lower(), ref)
+            ref = org_names_to_ref.get(ref.lower(), ref)
             if ref and ref not in refs:
                 refs.append(ref)
         ref = None
@@ -175,10 +422,10 @@ class Lookups:
         i = 0
         while i != len(refs):
             ref_to_consider = refs[i]
-            if not reporting_org and ref_to_consider in cls.org_ref_blocklist:
+            if not reporting_org and cls.is_org_ref_blocklisted(ref_to_consider):
                 i += 1
                 continue
-            preferred_name = cls.org_ref_to_name.get(ref_to_consider)
+            preferred_name = org_ref_to_name.get(ref_to_consider)
             if preferred_name:
                 ref = ref_to_consider
                 break
@@ -196,19 +443,20 @@ class Lookups:
             name = default_org_name
 
         preferred_type = None
+        org_lookedup = None
         if ref and ref != cls.default_org_id:
             if reporting_org:
                 if name != default_org_name:
-                    cls.orgs_lookedup.add((ref, name))
-            elif ref in cls.org_ref_blocklist and name and name != default_org_name:
-                ref = cls.org_names_to_ref.get(name.lower())
+                    org_lookedup = ref, name
+            elif cls.is_org_ref_blocklisted(ref) and name and name != default_org_name:
+                ref = org_names_to_ref.get(name.lower())
             if ref:
-                preferred_type = cls.org_ref_to_type.get(ref)
+                preferred_type = org_ref_to_type.get(ref)
         if not preferred_type and name and name != default_org_name:
-            preferred_type = cls.org_names_to_type.get(name.lower())
+            preferred_type = org_names_to_type.get(name.lower())
         if preferred_type:
             org_type = preferred_type
-        return {'id': ref, 'name': name, 'type': org_type}
+        return {'id': ref, 'name': name, 'type': org_type}, org_lookedup
 
     # This can be used to get a list of org refs to check to see if they should be added to the manual list
     # @classmethod
@@ -221,7 +469,7 @@ class Lookups:
     #                 dict_of_sets_add(ref_to_names, ref, name)
     #     for ref, names in ref_to_names.items():
     #         if len(names) > 5:
-    #             cls.org_ref_blocklist.append(ref)
+    #             cls.filters.add('org_ref_blocklist', ref)
 
     @classmethod
     def add_reporting_orgs(cls, dactivities):
@@ -234,22 +482,70 @@ class Lookups:
             for org in dactivity.participating_orgs:
                 cls.add_to_org_lookup(org, is_participating_org=True)
 
+    @classmethod
+    def get_org_record(cls, org):
+        """ Get the cleaned details of an org as recorded for the org lookup """
+        ref, names, org_type = cls.get_cleaned_ref_name_type(org)
+        return ref, tuple(names), org_type
+
+    @classmethod
+    def get_activity_org_records(cls, dactivity):
+        """ Get the records of the reporting org and participating orgs of an activity (see get_org_record) """
+        return cls.get_org_record(dactivity.reporting_org), \
+            tuple(cls.get_org_record(org) for org in dactivity.participating_orgs)
+
+    @staticmethod
+    def record_org(orgs, org_record):
+        """ Record an org in the ordered dict orgs keeping only its last occurrence. Adding to the org lookup
+        only ever sets values that are not already set, so adding the recorded orgs in reverse gives the same
+        lookup as adding every occurrence in reverse.
+        """
+        orgs.pop(org_record, None)
+        orgs[org_record] = None
+
+    @classmethod
+    def build_org_lookup(cls, dactivities):
+        """ Add reporting orgs and then participating orgs to the org lookup in one pass through dactivities
+        which can be a generator. Gives the same result as add_reporting_orgs followed by add_participating_orgs.
+        """
+        cls.build_org_lookup_from_records(cls.get_activity_org_records(dactivity) for dactivity in dactivities)
+
+    @classmethod
+    def build_org_lookup_from_records(cls, activity_org_records):
+        """ Build the org lookup from the org records of activities (see get_activity_org_records) as
+        build_org_lookup does from the activities.
+        """
+        reporting_orgs = dict()
+        participating_orgs = dict()
+        for reporting_org, orgs in activity_org_records:
+            cls.record_org(reporting_orgs, reporting_org)
+            for org in orgs:
+                cls.record_org(participating_orgs, org)
+        for ref, names, org_type in reversed(reporting_orgs):
+            cls.add_cleaned_to_org_lookup(ref, names, org_type)
+        for ref, names, org_type in reversed(participating_orgs):
+            cls.add_cleaned_to_org_lookup(ref, names, org_type, is_participating_org=True)
+
+    @classmethod
+    def setup_split_names(cls):
+        """ Resolve every 3-digit sector code and country and region code to the name used in the outputs
+        up front so that naming a split is one dict lookup. Country names take precedence over region names.
+        """
+        cls.sector_group_names = {code: info['dac-group'] for code, info in cls.sector_info.items()}
+        names = {code: f'{name} (no country specified)' for code, name in cls.region_code_to_name.items() if name}
+        for iso2 in Country.countriesdata()['iso2iso3']:
+            countryname = Country.get_country_name_from_iso2(iso2, shortname=True)
+            if countryname:
+                names[iso2] = countryname
+        cls.country_region_names = names
+
     @classmethod
     def get_sector_group_name(cls, code):
         """ Look up a group name for a 3- or 5-digit sector code.
         """
-        code = code[:3]
-        if code in cls.sector_info:
-            return cls.sector_info.get(code)['dac-group']
-        else:
-            return cls.default_sector
+        return cls.sector_group_names.get(code[:3], cls.default_sector)
 
     @classmethod
     def get_country_region_name(cls, code):
-        countryname = Country.get_country_name_from_iso2(code, shortname=True)
-        if countryname:
-            return countryname
-        regionname = cls.region_code_to_name.get(code)
-        if regionname:
-            return f'{regionname} (no country specified)'
-        return cls.default_country_region
+        """ Look up the name of an upper case ISO2 country code or region code """
+        return cls.country_region_names.get(code, cls.default_country_region)
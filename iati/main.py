@@ -1,142 +1,209 @@
 # -*- coding: utf-8 -*-
-import json
 import logging
-from io import StringIO
-from os.path import join
-from urllib.parse import quote
+from tempfile import TemporaryDirectory
 
-import diterator
-import unicodecsv
 from hdx.location.currency import Currency
 
-from iati import checks
-from iati.activity import Activity
+from iati.activitystore import ActivityStore
+from iati.asyncretriever import AsyncRetrieve
 from iati.calculatesplits import CalculateSplits
+from iati.contributions import merge_result, new_accumulators
+from iati.dportal import iterate_activities, retrieve_dportal, retrieve_dportal_topics
+from iati.fxrates import FXRates
 from iati.lookups import Lookups
+from iati.outputs import write_outputs
+from iati.processing import get_store_inputs, process_pages
+from iati.runstats import RunStats
+from iati.topicmatcher import TopicMatcher
 
 logger = logging.getLogger(__name__)
 
 
-def retrieve_dportal(configuration, retriever, dportal_params, whattorun):
+def setup_run(configuration, retriever, filterdate, lookups_snapshot=None, offline=False):
     """
-    Downloads activity data from D-Portal. Filters them and returns a
-    list of activities.
+    Sets up the lookups, currency, fx rates and splits for a run. The checks
+    must already be set in Lookups.
     """
-    dportal_configuration = configuration['dportal']
-    base_filename = dportal_configuration['filename']
-    dportal_limit = dportal_configuration['limit']
-    n = 0
-    dont_exit = True
-    while dont_exit:
-        if dportal_params:
-            params = dportal_params
-            dont_exit = False
-        else:
-            offset = n * dportal_limit
-            params = f'LIMIT {dportal_limit} OFFSET {offset}'
-            logger.info(f'OFFSET {offset}')
-        url = dportal_configuration['url'] % quote(dportal_configuration[f'{whattorun}_query'].format(params))
-        filename = base_filename.format(n)
-        text = retriever.retrieve_text(url, filename, 'D-Portal activities', False)
-        if '<iati-activity' in text:
-            n += 1
-            yield text
-        else:
-            # If the result doesn't contain any IATI activities, we're done
-            dont_exit = False
-
-
-def write(today, output_dir, configuration, configuration_key, rows, skipped=None):
-    logger.info(f'Writing {configuration_key} files to {output_dir}')
-    file_configuration = configuration[configuration_key]
-    headers = file_configuration['headers']
-    hxltags = file_configuration['hxltags']
-    process_cols = file_configuration.get('process_cols', dict())
-    csv_configuration = file_configuration['csv']
-    json_configuration = file_configuration['json']
-    csv_hxltags = csv_configuration.get('hxltags', hxltags)
-    json_hxltags = json_configuration.get('hxltags', hxltags)
-    hxltag_to_header = dict(zip(hxltags, headers))
-    csv_headers = [hxltag_to_header[hxltag] for hxltag in csv_hxltags]
-    metadata = {'#date+run': today, f'#meta+{configuration_key}+num': len(rows)}
-    if skipped is not None:
-        metadata[f'#meta+{configuration_key}+skipped+num'] = skipped
-    metadata_json = json.dumps(metadata, indent=None, separators=(',', ':'))
-    with open(join(output_dir, csv_configuration['filename']), 'wb') as output_csv:
-        writer = unicodecsv.writer(output_csv, encoding='utf-8', lineterminator='\n')
-        writer.writerow(csv_headers)
-        writer.writerow(csv_hxltags)
-        with open(join(output_dir, json_configuration['filename']), 'w') as output_json:
-            output_json.write(f'{{"metadata":{metadata_json},"data":[\n')
-
-            def write_row(inrow, ending):
-                def get_outrow(file_hxltags):
-                    outrow = dict()
-                    for file_hxltag in file_hxltags:
-                        expression = process_cols.get(file_hxltag)
-                        if expression:
-                            for i, hxltag in enumerate(hxltags):
-                                expression = expression.replace(hxltag, f'inrow[{i}]')
-                            outrow[file_hxltag] = eval(expression)
-                        else:
-                            outrow[file_hxltag] = inrow[hxltags.index(file_hxltag)]
-                    return outrow
-                writer.writerow(get_outrow(csv_hxltags).values())
-                row = get_outrow(json_hxltags)
-                output_json.write(json.dumps(row, indent=None, separators=(',', ':')) + ending)
-
-            [write_row(row, ',\n') for row in rows[:-1]]
-            write_row(rows[-1], ']')
-            output_json.write('}')
-
-
-def start(configuration, today, retriever, output_dir, dportal_params, whattorun, filterdate):
-    if filterdate:
-        text = f'removing transactions before {filterdate}'
-    else:
-        text = 'without removing transactions before a certain date'
-    logger.info(f'Running {whattorun} {text}')
-    Lookups.checks = checks[whattorun]
     Lookups.filter_transaction_date = filterdate
-    generator = retrieve_dportal(configuration, retriever, dportal_params, whattorun)
-    Lookups.setup(configuration['lookups'])
+    downloader = retriever.downloader if isinstance(retriever, AsyncRetrieve) else None
+    Lookups.setup(configuration['lookups'], lookups_snapshot, offline, downloader)
     Currency.setup(retriever=retriever, fallback_historic_to_current=True, fallback_current_to_static=True)
+    FXRates.setup(retriever)
     CalculateSplits.setup(configuration['calculate_splits'])
 
-    # Build org name lookup
-    dactivities = list()
-    for text in generator:
-        for dactivity in diterator.XMLIterator(StringIO(text)):
-            dactivities.append(dactivity)
-#    Lookups.build_reporting_org_blocklist(dactivities)
-    Lookups.add_reporting_orgs(dactivities)
-    Lookups.add_participating_orgs(dactivities)
-
-    # Build the accumulators from the IATI activities and transactions
-    flows = dict()
-    transactions = list()
-    all_skipped = 0
-    for i, dactivity in enumerate(dactivities):
-        activity, skipped = Activity.get_activity(configuration, dactivity)
-        all_skipped += skipped
-        if activity:
-            all_skipped += activity.process(today[:7], flows, transactions)
-        if i % 1000 == 0:
-            logger.info(f'Processed {i} activities')
-
-    logger.info(f'Processed {len(flows)} flows')
-    logger.info(f'Processed {len(transactions)} transactions')
-    logger.info(f'Skipped {all_skipped} transactions')
-
-    outputs_configuration = configuration['outputs']
-
-    # Prepare and write flows
-    write(today, output_dir, outputs_configuration, 'flows',
-          [flows[key]['row']+[int(round(flows[key]['value']))] for key in sorted(flows)])
-
-    # Write transactions
-    write(today, output_dir, outputs_configuration, 'transactions',
-          sorted(transactions, key=lambda x: (x[0], x[2], x[3], x[4], x[5], x[6], x[7], x[8], x[9], x[10])), all_skipped)
-
-    # Write orgs
-    write(today, output_dir, outputs_configuration, 'orgs', sorted(Lookups.orgs_lookedup, key=lambda x: (x[1], x[0])))
+
+def run_first_pass(stats, pages):
+    """
+    Builds the org lookup from the activities of pages (an iterable of paths) while they are
+    being retrieved returning their paths.
+    """
+    paths = list()
+
+    def spool_activities():
+        for path in stats.timed('download', pages):
+            paths.append(path)
+            yield from iterate_activities([path])
+
+    with stats.stage('first pass'):
+        Lookups.build_org_lookup(spool_activities())
+    return paths
+
+
+def run_first_pass_topics(stats, pages, page_keys, topic_keys):
+    """
+    Records the orgs of the activities of pages (an iterable of paths of merged pages whose
+    activity keys are in page_keys) while they are being retrieved and then builds the org
+    lookup of each topic from the topic's activities in its own order (topic_keys) as a run
+    of the topic alone would, returning the paths.
+    """
+    paths = list()
+    org_records = dict()
+    with stats.stage('first pass'):
+        for path in stats.timed('download', pages):
+            for key, dactivity in zip(page_keys[len(paths)], iterate_activities([path])):
+                org_records[key] = Lookups.get_activity_org_records(dactivity)
+            paths.append(path)
+        org_lookup = Lookups.get_org_lookup()
+        try:
+            for topic, keys in topic_keys.items():
+                Lookups.set_org_lookup({key: dict(table) for key, table in org_lookup.items()})
+                Lookups.build_org_lookup_from_records(org_records[key] for key in keys)
+                Lookups.topic_org_lookups[topic] = Lookups.get_org_lookup()
+        finally:
+            Lookups.set_org_lookup(org_lookup)
+    return paths
+
+
+def add_result_stats(stats, result):
+    """
+    Merges the fx rates looked up in a result of process_page and adds its cache counts
+    and processing times (including checking stored contributions) to stats.
+    """
+    FXRates.merge_rates(result['fx_rates'])
+    stats.add_counts(org_info_cache_hits=result['org_info_cache_hits'],
+                     org_info_cache_misses=result['org_info_cache_misses'], fx_rate_hits=result['fx_rate_hits'],
+                     fx_rate_misses=result['fx_rate_misses'], fx_rate_fallbacks=result['fx_rate_fallbacks'])
+    # Summed over worker processes so these can add up to more than the second pass
+    stats.add_time('parse', result['parse_seconds'])
+    stats.add_time('build activities', result['activities_seconds'])
+    stats.add_time('flows and splits', result['splits_seconds'])
+    if 'check_seconds' in result:
+        stats.add_time('check reuse', result['check_seconds'])
+
+
+def log_cache_stats(stats):
+    counts = stats.counts
+    logger.info(f'Org info cache had {counts.get("org_info_cache_hits", 0)} hits and '
+                f'{counts.get("org_info_cache_misses", 0)} misses')
+    logger.info(f'FX rate cache had {counts.get("fx_rate_hits", 0)} hits and {counts.get("fx_rate_misses", 0)} misses')
+    logger.info(f'{counts.get("fx_rate_fallbacks", 0)} conversions fell back to current rates')
+
+
+def get_filter_text(filterdate):
+    if filterdate:
+        return f'removing transactions before {filterdate}'
+    return 'without removing transactions before a certain date'
+
+
+def start(configuration, today, retriever, output_dir, dportal_params, whattorun, filterdate, processes=1,
+          incremental_store=None, lookups_snapshot=None, offline=False, profile=False, replay_pages=None,
+          stats_dir=None):
+    logger.info(f'Running {whattorun} {get_filter_text(filterdate)}')
+    stats = RunStats(stats_dir, profile)
+    TopicMatcher.setup(configuration['topics'])
+    Lookups.checks = TopicMatcher.get(whattorun)
+    with stats.stage('startup'):
+        setup_run(configuration, retriever, filterdate, lookups_snapshot, offline)
+    logger.info(f'Startup took {stats.stages["startup"]:.3f}s')
+
+    totals = new_accumulators()
+    with TemporaryDirectory() as folder:
+        # Build org name lookup while downloading the pages to a folder (first pass)
+        paths = run_first_pass(stats, retrieve_dportal(configuration, retriever, dportal_params, whattorun, folder,
+                                                       replay_pages))
+
+        # Build the accumulators from the IATI activities and transactions (second pass)
+        Lookups.setup_org_info_cache(configuration['lookups'].get('org_info_cache_size'))
+        store = None
+        if incremental_store:
+            store = ActivityStore(incremental_store)
+            store.check_fingerprint(get_store_inputs(configuration, today[:7]))
+        keys = list()
+        reused = 0
+        with stats.stage('second pass'):
+            for result in process_pages(configuration, today[:7], paths, processes, store):
+                if store is not None:
+                    store.put(result['contributions'])
+                    keys.extend(result['keys'])
+                    reused += result['reused']
+                merge_result(totals, result)
+                add_result_stats(stats, result)
+                logger.info(f'Processed {totals["activities"]} activities')
+            if store is not None:
+                logger.info(f'Reused {reused} activities from activity store')
+                logger.info(f'Removed {store.prune(keys)} old activities from activity store')
+                store.close()
+
+    log_cache_stats(stats)
+    stats.add_counts(pages=len(paths))
+    if store is not None:
+        stats.add_counts(reused_activities=reused)
+    if retriever.save:
+        FXRates.save(retriever.saved_dir)
+    stats.counts.update(write_outputs(today, output_dir, configuration, totals, stats))
+    return stats.save()
+
+
+def start_topics(configuration, today, retrievers, output_dirs, dportal_params, filterdate, processes=1,
+                 lookups_snapshot=None, offline=False, profile=False, replay_pages=None, stats_dir=None):
+    """
+    Runs several topics (eg. covid and ebola) in one pass. retrievers and output_dirs are dicts
+    of topic to the retriever and output folder of the topic. Setup is done once, the pages of
+    each topic's D-Portal query are merged so that activities in more than one topic are parsed
+    once and each activity is processed with the checks and org lookup of each of its topics
+    into that topic's outputs. Each topic's org lookup is built from its own activities in its
+    own order so that its outputs are the same as from a run of the topic alone. The run stats
+    have counts per topic.
+    """
+    topics = list(retrievers)
+    logger.info(f'Running {", ".join(topics)} {get_filter_text(filterdate)}')
+    stats = RunStats(stats_dir, profile)
+    TopicMatcher.setup(configuration['topics'])
+    Lookups.checks = TopicMatcher.get(topics[0])
+    with stats.stage('startup'):
+        setup_run(configuration, retrievers[topics[0]], filterdate, lookups_snapshot, offline)
+    logger.info(f'Startup took {stats.stages["startup"]:.3f}s')
+
+    topic_totals = {topic: new_accumulators() for topic in topics}
+    activity_topics = dict()
+    page_keys = list()
+    topic_keys = dict()
+    no_activities = 0
+    with TemporaryDirectory() as folder:
+        # Build the org name lookups of the topics while downloading and merging their pages (first pass)
+        pages = retrieve_dportal_topics(configuration, retrievers, dportal_params, folder, activity_topics, page_keys,
+                                        topic_keys, replay_pages)
+        paths = run_first_pass_topics(stats, pages, page_keys, topic_keys)
+        page_topics = [[activity_topics[key] for key in keys] for keys in page_keys]
+        del activity_topics, topic_keys
+
+        # Build the accumulators of each topic from the IATI activities and transactions (second pass)
+        Lookups.setup_org_info_cache(configuration['lookups'].get('org_info_cache_size'))
+        with stats.stage('second pass'):
+            for result in process_pages(configuration, today[:7], paths, processes, page_topics=page_topics):
+                for topic, topic_result in result['topics'].items():
+                    merge_result(topic_totals[topic], topic_result)
+                add_result_stats(stats, result)
+                no_activities += result['activities']
+                logger.info(f'Processed {no_activities} activities')
+
+    log_cache_stats(stats)
+    stats.add_counts(pages=len(paths), activities=no_activities)
+    stats.counts['topics'] = dict()
+    for topic in topics:
+        retriever = retrievers[topic]
+        if retriever.save:
+            FXRates.save(retriever.saved_dir)
+        stats.counts['topics'][topic] = write_outputs(today, output_dirs[topic], configuration, topic_totals[topic],
+                                                      stats, topic)
+    return stats.save()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import logging
+import re
+from os import remove, replace
+from os.path import exists
+
+logger = logging.getLogger(__name__)
+
+run_date_regex = re.compile(rb'"#date\+run":"[^"]*",?')
+
+
+class OutputFile:
+    """
+    Binary output file that is written through a large buffer (gzip compressed if compress is
+    True) to a temporary file while hashing what is written. On closing, the temporary file
+    replaces the output unless the output already has the same content in which case it is
+    left untouched. If run_metadata is True, the output starts with a line of metadata whose
+    #date+run is left out of the comparison as it changes on every run.
+    """
+    buffer_size = 1 << 20
+    compress_level = 6
+
+    def __init__(self, path, compress=False, run_metadata=False):
+        if compress:
+            path = f'{path}.gz'
+        self.path = path
+        self.temp_path = f'{path}.tmp'
+        self.compress = compress
+        self.run_metadata = run_metadata
+        self.file = open(self.temp_path, 'wb', buffering=self.buffer_size)
+        self.hash = hashlib.sha256()
+        # The metadata line is kept here until it is complete
+        self.first_line = b'' if run_metadata else None
+        self.bytes_written = 0
+        self.changed = None
+        if compress:
+            # mtime is fixed so that the same content always compresses to the same bytes
+            self.stream = gzip.GzipFile(filename='', mode='wb', compresslevel=self.compress_level,
+                                        fileobj=self, mtime=0)
+        else:
+            self.stream = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            remove(self.temp_path)
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def write_text(self, text):
+        data = text.encode('utf-8')
+        self.update_hash(data)
+        self.stream.write(data)
+
+    def update_hash(self, data):
+        """ Hash what is written (before compression) without the run date """
+        if self.first_line is not None:
+            self.first_line += data
+            end = self.first_line.find(b'\n') + 1
+            if not end:
+                return
+            data = self.first_line[end:]
+            self.hash.update(run_date_regex.sub(b'', self.first_line[:end]))
+            self.first_line = None
+        self.hash.update(data)
+
+    @classmethod
+    def get_content_hash(cls, path, compress=False, run_metadata=False):
+        """ Get the hash of the content of an output as update_hash gives it """
+        hash = hashlib.sha256()
+        with (gzip.open(path, 'rb') if compress else open(path, 'rb')) as f:
+            if run_metadata:
+                hash.update(run_date_regex.sub(b'', f.readline()))
+            for chunk in iter(lambda: f.read(cls.buffer_size), b''):
+                hash.update(chunk)
+        return hash.hexdigest()
+
+    @staticmethod
+    def replace_if_changed(temp_path, path, is_unchanged):
+        """ Replace the file at path with temp_path unless is_unchanged(path) is True for the output that
+        is already there returning True if it was replaced.
+        """
+        if exists(path) and is_unchanged(path):
+            logger.info(f'{path} is unchanged so not replacing it')
+            remove(temp_path)
+            return False
+        replace(temp_path, path)
+        return True
+
+    def close(self):
+        """ Finish writing returning True if the output was changed """
+        if self.stream is not self:
+            self.stream.close()
+        self.file.close()
+        if self.first_line is not None:
+            self.hash.update(run_date_regex.sub(b'', self.first_line))
+        file_hash = self.hash.hexdigest()
+        self.changed = self.replace_if_changed(
+            self.temp_path, self.path,
+            lambda path: self.get_content_hash(path, self.compress, self.run_metadata) == file_hash)
+        return self.changed
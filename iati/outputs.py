@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import logging
+from contextlib import ExitStack
+from io import StringIO
+from itertools import islice
+from os import listdir, remove
+from os.path import isdir, join
+from shutil import rmtree
+from time import perf_counter
+
+from iati.filters import FilterRegistry
+from iati.outputfile import OutputFile
+from iati.parquetoutput import ParquetOutput
+from iati.skipledger import SkipLedger
+
+logger = logging.getLogger(__name__)
+
+write_batch_size = 10000
+
+
+def compile_projection(hxltags, file_hxltags, process_cols, as_dict=False):
+    """
+    Compiles a function that takes an input row and returns the values for file_hxltags
+    as a tuple or dict. Expressions in process_cols are parsed once here rather than for
+    every row.
+    """
+    items = list()
+    for file_hxltag in dict.fromkeys(file_hxltags):
+        expression = process_cols.get(file_hxltag)
+        if expression:
+            for i, hxltag in enumerate(hxltags):
+                expression = expression.replace(hxltag, f'inrow[{i}]')
+            expression = f'({expression})'
+        else:
+            expression = f'inrow[{hxltags.index(file_hxltag)}]'
+        if as_dict:
+            items.append(f'{file_hxltag!r}: {expression}')
+        else:
+            items.append(expression)
+    if as_dict:
+        source = f'lambda inrow: {{{", ".join(items)}}}'
+    else:
+        source = f'lambda inrow: ({", ".join(items)},)'
+    return eval(compile(source, '<projection>', 'eval'), globals())
+
+
+def get_rollup_configuration(transactions_configuration, rollup_configuration):
+    """
+    Makes the output configuration of a rollup of transactions. Its columns are the group_by hxltags
+    followed by the net and total money with headers from the transactions configuration.
+    """
+    transactions_hxltags = transactions_configuration['hxltags']
+    hxltag_to_header = dict(zip(transactions_hxltags, transactions_configuration['headers']))
+    rollup_configuration = dict(rollup_configuration)
+    hxltags = rollup_configuration['group_by'] + transactions_hxltags[-2:]
+    rollup_configuration['hxltags'] = hxltags
+    rollup_configuration['headers'] = [hxltag_to_header[hxltag] for hxltag in hxltags]
+    return rollup_configuration
+
+
+def get_output_filenames(outputs_configuration):
+    """
+    Gets the filenames of the outputs (including rollups and any that are gzipped or Parquet)
+    that the outputs configuration gives.
+    """
+    filenames = set()
+    file_configurations = [outputs_configuration[key] for key in outputs_configuration if key != 'rollups']
+    file_configurations.extend(outputs_configuration.get('rollups', dict()).values())
+    for file_configuration in file_configurations:
+        for output_type in ('csv', 'json'):
+            output_configuration = file_configuration[output_type]
+            filename = output_configuration['filename']
+            filenames.add(f'{filename}.gz' if output_configuration.get('gzip', False) else filename)
+        if 'parquet' in file_configuration:
+            filenames.add(file_configuration['parquet']['filename'])
+    return filenames
+
+
+def remove_stale_outputs(output_dir, outputs_configuration):
+    """
+    Removes everything in output_dir other than the outputs that the outputs configuration
+    gives (eg. outputs no longer configured and files downloaded by the last run) so that
+    outputs that don't change are left untouched by the next run.
+    """
+    filenames = get_output_filenames(outputs_configuration)
+    for filename in listdir(output_dir):
+        if filename in filenames:
+            continue
+        path = join(output_dir, filename)
+        if isdir(path):
+            rmtree(path)
+        else:
+            remove(path)
+
+
+def write(today, output_dir, configuration, configuration_key, rows, skipped=None, skip_reasons=None):
+    logger.info(f'Writing {configuration_key} files to {output_dir}')
+    file_configuration = configuration[configuration_key]
+    headers = file_configuration['headers']
+    hxltags = file_configuration['hxltags']
+    process_cols = file_configuration.get('process_cols', dict())
+    csv_configuration = file_configuration['csv']
+    json_configuration = file_configuration['json']
+    csv_hxltags = csv_configuration.get('hxltags', hxltags)
+    json_hxltags = json_configuration.get('hxltags', hxltags)
+    hxltag_to_header = dict(zip(hxltags, headers))
+    csv_headers = [hxltag_to_header[hxltag] for hxltag in csv_hxltags]
+    get_csv_outrow = compile_projection(hxltags, csv_hxltags, process_cols)
+    get_json_outrow = compile_projection(hxltags, json_hxltags, process_cols, as_dict=True)
+    metadata = {'#date+run': today, f'#meta+{configuration_key}+num': len(rows)}
+    if skipped is not None:
+        metadata[f'#meta+{configuration_key}+skipped+num'] = skipped
+    if skip_reasons is not None:
+        for reason, no_skipped in skip_reasons.items():
+            metadata[f'#meta+{configuration_key}+skipped+{reason}+num'] = no_skipped
+    metadata_json = json.dumps(metadata, indent=None, separators=(',', ':'))
+    encode_json = json.JSONEncoder(indent=None, separators=(',', ':')).encode
+    csv_buffer = StringIO()
+    writer = csv.writer(csv_buffer, lineterminator='\n')
+    parquet_configuration = file_configuration.get('parquet')
+    start_time = perf_counter()
+    no_rows = 0
+    with ExitStack() as output_files:
+        output_csv = output_files.enter_context(OutputFile(join(output_dir, csv_configuration['filename']),
+                                                           csv_configuration.get('gzip', False)))
+        output_json = output_files.enter_context(OutputFile(join(output_dir, json_configuration['filename']),
+                                                            json_configuration.get('gzip', False), run_metadata=True))
+        output_parquet = None
+        if parquet_configuration:
+            parquet_hxltags = parquet_configuration.get('hxltags', hxltags)
+            get_parquet_outrow = compile_projection(hxltags, parquet_hxltags, process_cols)
+            output_parquet = output_files.enter_context(
+                ParquetOutput(join(output_dir, parquet_configuration['filename']), parquet_hxltags, metadata_json))
+
+        def write_csv_buffer():
+            output_csv.write_text(csv_buffer.getvalue())
+            csv_buffer.seek(0)
+            csv_buffer.truncate()
+
+        writer.writerow(csv_headers)
+        writer.writerow(csv_hxltags)
+        write_csv_buffer()
+        output_json.write_text(f'{{"metadata":{metadata_json},"data":[\n')
+        ending = ''
+        rows = iter(rows)
+        # Rows are written in batches so that each file gets one large write per batch
+        while True:
+            batch = list(islice(rows, write_batch_size))
+            if not batch:
+                break
+            writer.writerows(map(get_csv_outrow, batch))
+            write_csv_buffer()
+            output_json.write_text(ending + ',\n'.join(map(encode_json, map(get_json_outrow, batch))))
+            ending = ',\n'
+            if output_parquet is not None:
+                output_parquet.write_rows(list(map(get_parquet_outrow, batch)))
+            no_rows += len(batch)
+        output_json.write_text(']}')
+    duration = perf_counter() - start_time
+    bytes_written = f'{output_csv.bytes_written} bytes to csv and {output_json.bytes_written} bytes to json'
+    if output_parquet is not None:
+        bytes_written = f'{bytes_written} and {output_parquet.bytes_written} bytes to parquet'
+    logger.info(f'Wrote {no_rows} {configuration_key} rows in {duration:.2f}s '
+                f'({no_rows / max(duration, 1E-9):.0f} rows/sec): {bytes_written}')
+
+
+def write_outputs(today, output_dir, configuration, totals, stats, topic=None):
+    """
+    Writes the flows, transactions, rollups, reporting orgs and skipped outputs from the
+    accumulators in totals to output_dir returning counts of what was written. If topic is
+    given, it prefixes the stage names.
+    """
+    def stage(name):
+        return stats.stage(f'{topic} {name}' if topic else name)
+
+    flows = totals['flows']
+    transactions = totals['transactions']
+    all_skipped = totals['skipped']
+    prefix = f'{topic}: ' if topic else ''
+    logger.info(f'{prefix}Processed {len(flows)} flows')
+    logger.info(f'{prefix}Processed {len(transactions)} transactions')
+    logger.info(f'{prefix}Skipped {all_skipped} transactions')
+    FilterRegistry.log_removals(totals['filter_removals'])
+    SkipLedger.log_totals(totals['skip_reasons'])
+    skip_totals = SkipLedger.get_totals(totals['skip_reasons'])
+    counts = {'activities': totals['activities'], 'flows': len(flows), 'transactions': len(transactions),
+              'skipped_transactions': all_skipped,
+              'skip_reasons': {reason: {'activities': no_activities, 'transactions': no_transactions}
+                               for reason, (no_activities, no_transactions) in skip_totals.items()}}
+
+    outputs_configuration = configuration['outputs']
+
+    # Prepare and write flows
+    with stage('write flows'):
+        write(today, output_dir, outputs_configuration, 'flows',
+              [flows[key]['row']+[int(round(flows[key]['value']))] for key in sorted(flows)])
+
+    # Write transactions
+    with stage('sort'):
+        transactions.sort()
+    with stage('write transactions'):
+        write(today, output_dir, outputs_configuration, 'transactions', transactions, all_skipped,
+              {reason: no_transactions for reason, (_, no_transactions) in skip_totals.items()})
+
+    # Write rollups of transactions
+    transactions_configuration = outputs_configuration['transactions']
+    for key, rollup_configuration in outputs_configuration.get('rollups', dict()).items():
+        with stage(f'rollup {key}'):
+            rollup_configuration = get_rollup_configuration(transactions_configuration, rollup_configuration)
+            fields = [transactions_configuration['hxltags'].index(hxltag)
+                      for hxltag in rollup_configuration['group_by']]
+            rows = transactions.rollup(fields)
+            logger.info(f'Rolled up {len(transactions)} transactions into {len(rows)} {key} rows')
+            write(today, output_dir, {key: rollup_configuration}, key, rows)
+
+    # Write orgs
+    with stage('write orgs'):
+        write(today, output_dir, outputs_configuration, 'orgs',
+              sorted(totals['orgs_lookedup'], key=lambda x: (x[1], x[0])))
+
+    # Write what was skipped and why by reporting org
+    if 'skipped' in outputs_configuration:
+        with stage('write skipped'):
+            write(today, output_dir, outputs_configuration, 'skipped', SkipLedger.get_rows(totals['skip_reasons']))
+    return counts
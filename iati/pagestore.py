@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import mmap
+import re
+import zlib
+from glob import glob
+from os import remove, replace
+from os.path import basename, exists, getsize, join
+
+logger = logging.getLogger(__name__)
+
+page_number_regex = re.compile(r'(\d+)\D*$')
+
+
+def get_codec(compression, level=None):
+    """ Get functions that make a compressor and a decompressor for compression (gzip or zstd which needs
+    zstandard and is only imported when used). Both have the compress/decompress and flush methods of zlib's.
+    """
+    if compression == 'gzip':
+        # wbits of 31 gives gzip framing. It has no timestamp so the same pages always compress to the same bytes.
+        return (lambda: zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31),
+                lambda: zlib.decompressobj(31))
+    if compression == 'zstd':
+        import zstandard
+        return (lambda: zstandard.ZstdCompressor(level=3 if level is None else level).compressobj(),
+                lambda: zstandard.ZstdDecompressor().decompressobj())
+    raise ValueError(f'Unknown compression {compression}!')
+
+
+def parse_pages(text):
+    """ Parse page numbers and ranges like 0-2,5 into a set of page numbers """
+    pages = set()
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        pages.update(range(int(first), int(last or first) + 1))
+    return pages
+
+
+class PageStoreWriter:
+    """
+    Writes pages of D-Portal activities to a PageStore in folder, each compressed on its own. The
+    data and index are written to temporary files that replace the store on closing so that a
+    store is only there once all of its pages are.
+    """
+
+    def __init__(self, folder, compression='gzip', level=None):
+        self.data_path = join(folder, PageStore.data_filename)
+        self.index_path = join(folder, PageStore.index_filename)
+        self.make_compressor, _ = get_codec(compression, level)
+        self.file = open(f'{self.data_path}.tmp', 'wb')
+        self.index = {'version': PageStore.version, 'compression': compression, 'pages': list()}
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            remove(self.file.name)
+
+    def add(self, page, path):
+        """ Add the page numbered page (eg. 0 for dportal_0.xml) from the file at path """
+        with open(path, 'rb') as f:
+            self.add_data(page, basename(path), f.read())
+
+    def add_data(self, page, filename, data):
+        compressor = self.make_compressor()
+        compressed = compressor.compress(data) + compressor.flush()
+        self.file.write(compressed)
+        self.index['pages'].append({'page': page, 'filename': filename, 'offset': self.offset,
+                                    'length': len(compressed), 'size': len(data),
+                                    'activities': data.count(b'</iati-activity>'),
+                                    'sha256': hashlib.sha256(data).hexdigest()})
+        self.offset += len(compressed)
+
+    def close(self):
+        self.file.close()
+        with open(f'{self.index_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, indent=1)
+        replace(self.file.name, self.data_path)
+        replace(f'{self.index_path}.tmp', self.index_path)
+        pages = self.index['pages']
+        logger.info(f'Saved {len(pages)} pages with {sum(page["activities"] for page in pages)} activities '
+                    f'in {self.data_path} ({sum(page["size"] for page in pages)} bytes compressed to '
+                    f'{self.offset})')
+
+
+class PageStore:
+    """
+    Saved pages of D-Portal activities kept compressed in one data file with an index (a JSON
+    file) of the byte range, size, number of activities and hash of each page. The data file is
+    memory mapped so that a page is read and decompressed only when it is extracted, a chunk at
+    a time, to a file that can be parsed like a downloaded page.
+    """
+    data_filename = 'dportal_pages.bin'
+    index_filename = 'dportal_pages.json'
+    version = 1
+    chunk_size = 1 << 20
+
+    def __init__(self, folder):
+        with open(join(folder, self.index_filename), encoding='utf-8') as f:
+            index = json.load(f)
+        if index['version'] != self.version:
+            raise ValueError(f'Page store in {folder} is version {index["version"]} not {self.version}!')
+        self.compression = index['compression']
+        _, self.make_decompressor = get_codec(self.compression)
+        self.pages = index['pages']
+        self.file = open(join(folder, self.data_filename), 'rb')
+        # mmap cannot map an empty file
+        if getsize(self.file.name):
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+    @classmethod
+    def exists(cls, folder):
+        return exists(join(folder, cls.index_filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def iterate_chunks(self, page):
+        """ Yield the decompressed data of a page (an entry of pages) in chunks """
+        decompressor = self.make_decompressor()
+        end = page['offset'] + page['length']
+        for start in range(page['offset'], end, self.chunk_size):
+            yield decompressor.decompress(self.data[start:min(start + self.chunk_size, end)])
+        yield decompressor.flush()
+
+    def read(self, page):
+        return b''.join(self.iterate_chunks(page))
+
+    def extract(self, page, folder):
+        """ Write a page (an entry of pages) to its filename in folder returning its path """
+        path = join(folder, page['filename'])
+        with open(path, 'wb') as f:
+            for chunk in self.iterate_chunks(page):
+                f.write(chunk)
+        return path
+
+    def verify(self):
+        """ Check that every page decompresses to what was saved raising ValueError if not """
+        for page in self.pages:
+            hash = hashlib.sha256()
+            size = 0
+            for chunk in self.iterate_chunks(page):
+                hash.update(chunk)
+                size += len(chunk)
+            if size != page['size'] or hash.hexdigest() != page['sha256']:
+                raise ValueError(f'Page {page["filename"]} in {self.file.name} is corrupt!')
+
+    @staticmethod
+    def import_folder(folder, pattern='dportal_*.xml', compression='gzip', level=None, delete=False):
+        """ Import the saved pages matching pattern in folder (as saved by --save without a page store)
+        into a page store in folder. Pages without activities (eg. D-Portal's response for the page
+        after the last) are left out as they would be by --save. The store is verified before the
+        pages are deleted if delete is True. Returns the number of pages imported.
+        """
+        paths = sorted(glob(join(folder, pattern)), key=lambda x: int(page_number_regex.search(x).group(1)))
+        no_imported = 0
+        with PageStoreWriter(folder, compression, level) as writer:
+            for path in paths:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if b'</iati-activity>' in data:
+                    writer.add_data(int(page_number_regex.search(path).group(1)), basename(path), data)
+                    no_imported += 1
+        if delete:
+            with PageStore(folder) as store:
+                store.verify()
+            for path in paths:
+                remove(path)
+        return no_imported
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from os import remove
+from os.path import getsize
+
+from iati.outputfile import OutputFile
+
+logger = logging.getLogger(__name__)
+
+
+class ParquetOutput:
+    """
+    Writes the rows of an output to a Parquet file a row group per batch of rows. String columns
+    are dictionary encoded and the run metadata is stored as file metadata under "metadata". The
+    file replaces the output unless the output already has the same rows and metadata other than
+    #date+run. Needs pyarrow which is only imported when a Parquet output is configured.
+    """
+
+    def __init__(self, path, hxltags, metadata_json):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        self.temp_path = f'{path}.tmp'
+        self.hxltags = hxltags
+        self.metadata_json = metadata_json
+        self.types = [None] * len(hxltags)
+        # Batches wait here until the type of every column is known from a value that isn't None
+        self.pending = list()
+        self.writer = None
+        self.bytes_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            if self.writer is not None:
+                self.writer.close()
+                remove(self.temp_path)
+
+    def get_array(self, values, value_type):
+        pyarrow = self.pyarrow
+        if value_type == pyarrow.string():
+            return pyarrow.array(values, type=value_type).dictionary_encode()
+        return pyarrow.array(values, type=value_type)
+
+    def write_pending(self):
+        pyarrow = self.pyarrow
+        types = [pyarrow.null() if value_type is None else value_type for value_type in self.types]
+        if self.writer is None:
+            fields = list()
+            for hxltag, value_type in zip(self.hxltags, types):
+                if value_type == pyarrow.string():
+                    value_type = pyarrow.dictionary(pyarrow.int32(), value_type)
+                fields.append(pyarrow.field(hxltag, value_type))
+            schema = pyarrow.schema(fields, metadata={'metadata': self.metadata_json})
+            self.writer = self.parquet.ParquetWriter(self.temp_path, schema)
+        for columns in self.pending:
+            arrays = [self.get_array(values, value_type) for values, value_type in zip(columns, types)]
+            self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.writer.schema))
+        self.pending = list()
+
+    def write_rows(self, rows):
+        """ Write a batch of rows given as tuples of the values of the hxltags """
+        columns = list(zip(*rows))
+        if not columns:
+            return
+        if self.writer is None:
+            for i, values in enumerate(columns):
+                if self.types[i] is None:
+                    value_type = self.pyarrow.array(values).type
+                    if value_type != self.pyarrow.null():
+                        self.types[i] = value_type
+        self.pending.append(columns)
+        if self.writer is not None or None not in self.types:
+            self.write_pending()
+
+    def close(self):
+        """ Finish writing returning True if the output was changed """
+        self.write_pending()
+        self.writer.close()
+        self.bytes_written = getsize(self.temp_path)
+        return OutputFile.replace_if_changed(self.temp_path, self.path, self.is_unchanged)
+
+    def read(self, path):
+        """ Read a Parquet output returning its rows and its metadata without #date+run """
+        table = self.parquet.read_table(path)
+        metadata = json.loads(table.schema.metadata[b'metadata'])
+        metadata.pop('#date+run', None)
+        return table, metadata
+
+    def is_unchanged(self, path):
+        table, metadata = self.read(path)
+        new_table, new_metadata = self.read(self.temp_path)
+        return metadata == new_metadata and table.equals(new_table)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from time import perf_counter
+
+from hdx.location.country import Country
+from hdx.location.currency import Currency
+
+from iati.activity import Activity
+from iati.activitystore import ActivityStore
+from iati.calculatesplits import CalculateSplits
+from iati.contributions import (add_contribution, get_contribution, is_contribution_current, new_accumulators,
+                                new_current_inputs)
+from iati.dportal import iterate_activities
+from iati.fxrates import FXRates
+from iati.lookups import Lookups
+from iati.processingcontext import ProcessingContext
+from iati.topicmatcher import TopicMatcher
+
+logger = logging.getLogger(__name__)
+
+
+def get_counters():
+    """ Get the org info cache and fx rate counters so that what processing adds to them can be counted """
+    return {'org_info_cache_hits': Lookups.org_info_cache_hits, 'org_info_cache_misses': Lookups.org_info_cache_misses,
+            'fx_rate_hits': FXRates.hits, 'fx_rate_misses': FXRates.misses, 'fx_rate_fallbacks': FXRates.fallbacks}
+
+
+def new_result():
+    return {'activities': 0, 'parse_seconds': 0, 'activities_seconds': 0, 'splits_seconds': 0}
+
+
+def add_counters(result, counters):
+    """ Adds what has been added to the counters since counters (see get_counters) and the fx rates
+    looked up to result
+    """
+    for key, value in get_counters().items():
+        result[key] = value - counters[key]
+    result['fx_rates'] = FXRates.take_new_rates()
+    return result
+
+
+def parse_activities(dactivities, result):
+    """ Yields the activities of dactivities adding their number and the seconds spent parsing them to result """
+    dactivities = iter(dactivities)
+    while True:
+        start_time = perf_counter()
+        dactivity = next(dactivities, None)
+        result['parse_seconds'] += perf_counter() - start_time
+        if dactivity is None:
+            return
+        result['activities'] += 1
+        yield dactivity
+
+
+def process_activity(configuration, today_year_month, dactivity, context, accumulators, result):
+    """ Processes an activity with context into accumulators adding the seconds spent to result """
+    start_time = perf_counter()
+    activity, skipped = Activity.get_activity(configuration, dactivity, context)
+    accumulators['skipped'] += skipped
+    end_time = perf_counter()
+    result['activities_seconds'] += end_time - start_time
+    if activity:
+        accumulators['skipped'] += activity.process(today_year_month, accumulators['flows'],
+                                                    accumulators['transactions'], context)
+        result['splits_seconds'] += perf_counter() - end_time
+    accumulators['activities'] += 1
+
+
+def process_activities(configuration, today_year_month, dactivities):
+    """
+    Processes activities returning a dict with the flows (with a list of values per key),
+    transactions, number of skipped transactions, skip reasons, reporting orgs looked up, filter removals,
+    number of activities processed, org info cache hits and misses, fx rates looked up,
+    fx rate hits, misses and fallbacks to current rates and the seconds spent parsing,
+    building activities (including currency conversion) and generating flows and split
+    transactions.
+    """
+    counters = get_counters()
+    result = new_result()
+    accumulators = new_accumulators()
+    context = ProcessingContext.get().for_accumulators(accumulators)
+    for dactivity in parse_activities(dactivities, result):
+        process_activity(configuration, today_year_month, dactivity, context, accumulators, result)
+    result.update(accumulators)
+    return add_counters(result, counters)
+
+
+def process_activities_with_store(configuration, today_year_month, dactivities, store, current_inputs):
+    """
+    Processes activities as process_activities does reusing the contributions of activities in
+    the activity store that are current (see is_contribution_current). The dict returned also has
+    the keys of the activities, the new contributions to store, the number of activities reused and
+    the seconds spent getting stored contributions and checking them. Building activities includes
+    all the other work on activities including adding reused contributions.
+    """
+    counters = get_counters()
+    result = new_result()
+    accumulators = new_accumulators()
+    context = ProcessingContext.get()
+    keys = list()
+    contributions = list()
+    reused = 0
+    check_seconds = 0
+    for dactivity in parse_activities(dactivities, result):
+        key = dactivity.identifier, dactivity.get_text('@last-updated-datetime')
+        contribution = None
+        start_time = perf_counter()
+        if all(key):
+            keys.append(key)
+            contribution = store.get(*key)
+            if contribution is not None and not is_contribution_current(contribution, context, current_inputs):
+                contribution = None
+            end_time = perf_counter()
+            check_seconds += end_time - start_time
+            start_time = end_time
+        if contribution is None:
+            contribution = get_contribution(configuration, today_year_month, dactivity, context)
+            if all(key):
+                contributions.append((key, contribution))
+        else:
+            reused += 1
+        add_contribution(accumulators, contribution)
+        accumulators['activities'] += 1
+        result['activities_seconds'] += perf_counter() - start_time
+    result.update(accumulators)
+    result['keys'] = keys
+    result['contributions'] = contributions
+    result['reused'] = reused
+    result['check_seconds'] = check_seconds
+    return add_counters(result, counters)
+
+
+def process_activities_topics(configuration, today_year_month, dactivities, activity_topics):
+    """
+    Processes activities as process_activities does with the checks and org lookup of each of their
+    topics into accumulators per topic. activity_topics has the topics of each activity in order.
+    The accumulators of each topic are returned under "topics" in place of the flows, transactions,
+    number of skipped transactions, skip reasons, reporting orgs looked up and filter removals.
+    """
+    counters = get_counters()
+    result = new_result()
+    topic_accumulators = dict()
+    contexts = dict()
+    for dactivity, topics in zip(parse_activities(dactivities, result), activity_topics):
+        for topic in topics:
+            accumulators = topic_accumulators.get(topic)
+            if accumulators is None:
+                accumulators = new_accumulators()
+                topic_accumulators[topic] = accumulators
+                contexts[topic] = ProcessingContext.get(topic).for_accumulators(accumulators)
+            process_activity(configuration, today_year_month, dactivity, contexts[topic], accumulators, result)
+    result['topics'] = topic_accumulators
+    return add_counters(result, counters)
+
+
+def process_page(configuration, today_year_month, path, store=None, activity_topics=None, current_inputs=None):
+    """
+    Processes the activities of the page at path with process_activities or if an activity
+    store is given, process_activities_with_store with the run's current_inputs or if
+    activity_topics is given, process_activities_topics. An activity store can't be used
+    with topics.
+    """
+    dactivities = iterate_activities([path])
+    if activity_topics is not None:
+        return process_activities_topics(configuration, today_year_month, dactivities, activity_topics)
+    if store is not None:
+        return process_activities_with_store(configuration, today_year_month, dactivities, store, current_inputs)
+    return process_activities(configuration, today_year_month, dactivities)
+
+
+worker_state = dict()
+
+
+def get_currency_state():
+    return {key: getattr(Currency, key) for key in ('_current_rates', '_historic_rates', '_fallback_to_current')}
+
+
+def get_store_inputs(configuration, today_year_month):
+    """
+    Returns what affects the contribution of every activity to the outputs and doesn't change
+    from day to day: the lookups (including filters and checks) other than the org lookup,
+    whether fx rates fall back on current rates and configuration. The org lookup and fx rates
+    are checked for each contribution by is_contribution_current.
+    """
+    lookups_state = {key: value for key, value in Lookups.get_state().items()
+                     if key not in Lookups.org_lookup_keys + ('org_info_cache_size', 'topic_org_lookups')}
+    lookups_state['filters'] = Lookups.filters.rules
+    return {'today_year_month': today_year_month, 'lookups': lookups_state,
+            'fallback_to_current': Currency._fallback_to_current,
+            'transaction_type_info': configuration['transaction_type_info'],
+            'calculate_splits': configuration['calculate_splits']}
+
+
+def setup_worker(configuration, today_year_month, lookups_state, calculate_splits_configuration, currency_state,
+                 fx_rates_state, countriesdata, topic_matchers, store_path=None):
+    """
+    Sets up a worker process with the frozen lookups, splits, currency, fx rates, country
+    state and topic matchers of the parent process and opens the activity store if there is one.
+    """
+    worker_state['configuration'] = configuration
+    worker_state['today_year_month'] = today_year_month
+    if store_path:
+        worker_state['store'] = ActivityStore(store_path, read_only=True)
+        worker_state['current_inputs'] = new_current_inputs()
+    Lookups.set_state(lookups_state)
+    Lookups.setup_org_info_cache(Lookups.org_info_cache_size)
+    CalculateSplits.setup(calculate_splits_configuration)
+    for key, value in currency_state.items():
+        setattr(Currency, key, value)
+    FXRates.set_state(fx_rates_state)
+    Country._countriesdata = countriesdata
+    TopicMatcher.matchers = topic_matchers
+
+
+def process_page_in_worker(path, activity_topics=None):
+    return process_page(worker_state['configuration'], worker_state['today_year_month'], path,
+                        worker_state.get('store'), activity_topics, worker_state.get('current_inputs'))
+
+
+def process_pages(configuration, today_year_month, paths, processes=1, store=None, page_topics=None):
+    """
+    Processes the pages of activities at paths yielding the results of process_page for
+    each page in order. If processes is more than 1, pages are processed by a pool of
+    worker processes. If page_topics is given, it has the topics of each activity of each
+    page (see process_activities_topics).
+    """
+    if page_topics is None:
+        page_topics = repeat(None)
+    if processes < 2:
+        current_inputs = new_current_inputs() if store else None
+        for path, activity_topics in zip(paths, page_topics):
+            yield process_page(configuration, today_year_month, path, store, activity_topics, current_inputs)
+        return
+    worker_configuration = {'transaction_type_info': dict(configuration['transaction_type_info'])}
+    initargs = (worker_configuration, today_year_month, Lookups.get_state(),
+                dict(configuration['calculate_splits']), get_currency_state(), FXRates.get_state(),
+                Country.countriesdata(), TopicMatcher.matchers, store.path if store else None)
+    with ProcessPoolExecutor(max_workers=processes, initializer=setup_worker, initargs=initargs) as executor:
+        yield from executor.map(process_page_in_worker, paths, page_topics)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from iati.filters import FilterRegistry
+from iati.fxrates import FXRates
+from iati.lookups import Lookups
+from iati.skipledger import SkipLedger
+from iati.topicmatcher import TopicMatcher
+
+
+class ProcessingContext:
+    """ The checks and org lookup with which activities are processed into one set of outputs and what
+    processing them records: the reporting orgs looked up, filter removals and skip reasons. It is passed
+    explicitly to Activity and Transaction so that outputs processed in one pass (eg. topics) each have
+    their own. If orgs_resolved and rates_used are dicts, what the orgs resolved to and the fx rates used
+    are recorded in them.
+    """
+    __slots__ = ('checks', 'org_lookup', 'org_info_cache', 'orgs_lookedup', 'filter_removals', 'skip_counts',
+                 'orgs_resolved', 'rates_used')
+
+    def __init__(self, checks, org_lookup, org_info_cache, orgs_lookedup=None, filter_removals=None,
+                 skip_counts=None, orgs_resolved=None, rates_used=None):
+        self.checks = checks
+        self.org_lookup = org_lookup
+        self.org_info_cache = org_info_cache
+        self.orgs_lookedup = set() if orgs_lookedup is None else orgs_lookedup
+        self.filter_removals = dict() if filter_removals is None else filter_removals
+        self.skip_counts = dict() if skip_counts is None else skip_counts
+        self.orgs_resolved = orgs_resolved
+        self.rates_used = rates_used
+
+    @classmethod
+    def get(cls, topic=None):
+        """ Get a context with the checks, org lookup and org info cache of the run or if topic is given,
+        of the topic
+        """
+        checks = Lookups.checks if topic is None else TopicMatcher.get(topic)
+        return cls(checks, Lookups.get_org_lookup(topic), Lookups.get_org_info_cache(topic))
+
+    def for_accumulators(self, accumulators):
+        """ Get a context with the same checks and org lookup that records into accumulators
+        (see new_accumulators)
+        """
+        return ProcessingContext(self.checks, self.org_lookup, self.org_info_cache, accumulators['orgs_lookedup'],
+                                 accumulators['filter_removals'], accumulators['skip_reasons'])
+
+    def for_contribution(self):
+        """ Get a context with the same checks and org lookup that records into empty recorders including
+        what orgs resolved to and the fx rates used
+        """
+        return ProcessingContext(self.checks, self.org_lookup, self.org_info_cache, orgs_resolved=dict(),
+                                 rates_used=dict())
+
+    def record_skip(self, reason, org_ref, no_transactions=1, no_activities=0):
+        SkipLedger.record(self.skip_counts, reason, org_ref, no_transactions, no_activities)
+
+    def record_removal(self, rule, org_id, no_transactions):
+        FilterRegistry.record_removal(self.filter_removals, rule, org_id, no_transactions)
+
+    def get_resolved_org_info(self, raw_org, reporting_org=False, expenditure=False):
+        return Lookups.get_resolved_org_info(self.org_lookup, self.org_info_cache, raw_org, reporting_org,
+                                             expenditure)
+
+    def get_org_info(self, org, reporting_org=False, expenditure=False):
+        """ Get the standardised id, name and type of an org """
+        return self.get_raw_org_info(Lookups.get_raw_org(org), reporting_org, expenditure)
+
+    def get_raw_org_info(self, raw_org, reporting_org=False, expenditure=False):
+        """ Get the standardised id, name and type of an org from the output of get_raw_org recording
+        the reporting org looked up and if orgs_resolved is a dict, what the org resolved to
+        """
+        resolved = self.get_resolved_org_info(raw_org, reporting_org, expenditure)
+        if self.orgs_resolved is not None:
+            self.orgs_resolved[raw_org + (reporting_org, expenditure)] = resolved
+        org_info, org_lookedup = resolved
+        if org_lookedup:
+            self.orgs_lookedup.add(org_lookedup)
+        return dict(org_info)
+
+    def get_values_in_usd(self, conversions):
+        return FXRates.get_values_in_usd(conversions, self.rates_used)
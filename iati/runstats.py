@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import json
+import logging
+from contextlib import contextmanager
+from os.path import join
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class RunStats:
+    """
+    Times the stages of a run and keeps counts of what was processed which are logged and, if
+    stats_dir is given, written with the peak memory use to run_stats.json in stats_dir. If
+    profile is True, each stage is run under cProfile and its stats are dumped to
+    profile_<stage>.pstats in stats_dir. stats_dir should not be a folder that is published
+    with the outputs.
+    """
+    filename = 'run_stats.json'
+
+    def __init__(self, stats_dir=None, profile=False):
+        self.stats_dir = stats_dir
+        self.profile = profile
+        self.stages = dict()
+        self.counts = dict()
+        self.start_time = perf_counter()
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the code in the with block as stage name (profiling it if profile is True) """
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start_time)
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(join(self.stats_dir, f'profile_{name.replace(" ", "_")}.pstats'))
+
+    def timed(self, name, iterable):
+        """ Yield from iterable adding the time spent waiting for each item to stage name """
+        iterator = iter(iterable)
+        while True:
+            start_time = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, perf_counter() - start_time)
+                return
+            self.add_time(name, perf_counter() - start_time)
+            yield item
+
+    def add_counts(self, **counts):
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    @staticmethod
+    def get_peak_rss():
+        """ Peak resident set size in bytes of this process and of the largest of its finished child
+        processes (eg. worker processes) or None if it can't be found
+        """
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux
+        return {'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024}
+
+    def get_stats(self):
+        return {'total_seconds': perf_counter() - self.start_time, 'stages': self.stages, 'counts': self.counts,
+                'peak_rss_bytes': self.get_peak_rss()}
+
+    def save(self):
+        stats = self.get_stats()
+        for name, seconds in stats['stages'].items():
+            logger.info(f'{name} took {seconds:.2f}s')
+        logger.info(f'Run took {stats["total_seconds"]:.2f}s')
+        if self.stats_dir:
+            with open(join(self.stats_dir, self.filename), 'w') as f:
+                json.dump(stats, f, indent=2)
+        return stats
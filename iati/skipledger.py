@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SkipLedger:
+    """ Counts of the activities and transactions skipped by reason and reporting org. Skips are
+    recorded where they happen during processing so that no extra pass is needed to explain them.
+    The counts are kept in a dict of (reason, reporting org) to activities and transactions skipped
+    which belongs to the output being processed (see ProcessingContext).
+    Reasons are HXL attribute safe so that they can be used in metadata hxltags.
+    """
+    reasons = ('secondary_reporter', 'filtered_org', 'filtered_parent', 'no_value', 'unknown_type',
+               'invalid_date_or_currency', 'fx_failure', 'out_of_range_month', 'no_net_value')
+
+    @staticmethod
+    def record(counts, reason, org_ref, no_transactions=1, no_activities=0):
+        key = reason, org_ref or ''
+        totals = counts.get(key)
+        if totals is None:
+            totals = [0, 0]
+            counts[key] = totals
+        totals[0] += no_activities
+        totals[1] += no_transactions
+
+    @staticmethod
+    def merge_counts(counts, partial_counts):
+        """ Add the counts of eg. a worker process or a stored contribution to counts """
+        for key, (no_activities, no_transactions) in partial_counts.items():
+            totals = counts.get(key)
+            if totals is None:
+                counts[key] = [no_activities, no_transactions]
+            else:
+                totals[0] += no_activities
+                totals[1] += no_transactions
+
+    @classmethod
+    def get_totals(cls, counts):
+        """ Totals of skipped activities and transactions for every reason """
+        totals = {reason: [0, 0] for reason in cls.reasons}
+        for (reason, _), (no_activities, no_transactions) in counts.items():
+            totals[reason][0] += no_activities
+            totals[reason][1] += no_transactions
+        return totals
+
+    @classmethod
+    def get_rows(cls, counts):
+        """ Rows of reporting org, reason, activities skipped and transactions skipped """
+        order = {reason: i for i, reason in enumerate(cls.reasons)}
+        return [[org_ref, reason, no_activities, no_transactions]
+                for (reason, org_ref), (no_activities, no_transactions)
+                in sorted(counts.items(), key=lambda x: (x[0][1], order[x[0][0]]))]
+
+    @classmethod
+    def log_totals(cls, counts):
+        for reason, (no_activities, no_transactions) in cls.get_totals(counts).items():
+            if no_activities or no_transactions:
+                logger.info(f'Skipped {no_activities} activities and {no_transactions} transactions: {reason}')
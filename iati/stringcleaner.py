@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import re
+
+
+class StringCleaner:
+    """ Normalises strings like org and region names. Patterns are compiled once, already cleaned strings are
+    memoised (up to max_memo_size of them) and plain ASCII alphanumeric and space strings skip the regexes.
+    """
+    repeated_nonword_pattern = re.compile(r'(\W)\1+')
+    whitespace_pattern = re.compile(r'\s')
+    surrounding_punctuation_pattern = re.compile(r'^\W?([\w &]*)[^a-zA-Z0-9_\.]?$')
+    max_memo_size = 100000
+    memo = dict()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def setup(cls, max_memo_size=100000):
+        cls.max_memo_size = max_memo_size
+        cls.memo = dict()
+        cls.hits = 0
+        cls.misses = 0
+
+    @classmethod
+    def clean_with_regexes(cls, s):
+        # Normalise one or more whitespaces to a single space and remove any punctuation at the start/end except
+        # for any trailing full stop
+        s = cls.repeated_nonword_pattern.sub(r'\1', s.strip())
+        s = cls.whitespace_pattern.sub(' ', s)
+        s = cls.surrounding_punctuation_pattern.sub(r'\1', s)
+        return s.strip()
+
+    @classmethod
+    def clean(cls, s):
+        cleaned = cls.memo.get(s)
+        if cleaned is not None:
+            cls.hits += 1
+            return cleaned
+        cls.misses += 1
+        if s.isascii() and s.replace(' ', '').isalnum():
+            # Only runs of spaces and spaces at the start/end can change
+            cleaned = ' '.join(s.split())
+        else:
+            cleaned = cls.clean_with_regexes(s)
+        if len(cls.memo) < cls.max_memo_size:
+            cls.memo[s] = cleaned
+        return cleaned
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import re
+
+activity_root = '/iati-activities/iati-activity'
+# Narratives that D-Portal's full text search looks in for a topic's search words
+search_narrative_paths = ('title', 'description', 'transaction/description')
+sector_paths = ('sector', 'transaction/sector')
+# The sector vocabulary an IATI sector has if none is given
+default_sector_vocabulary = '1'
+query_template = f"SELECT * FROM xson WHERE root = '{activity_root}' AND aid IN ( SELECT aid FROM xson WHERE " \
+                 "{} GROUP BY aid{{shard}} ORDER BY max(xson->>'@iati-activities:generated-datetime'), " \
+                 "max(xson->>'@last-updated-datetime'), aid {{}} )"
+
+
+def quote_sql(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+class TopicMatcher:
+    """
+    Checks of whether activities and transactions are in a topic (eg. covid) compiled from the
+    topic's rules in the configuration. Humanitarian scopes, tags and sectors are looked up in
+    frozensets, first by a string whose hash is cached (vocabulary or code) so that tuples are
+    only made for likely matches. Narratives are upper cased and searched with one regex of all
+    the topic's upper cased keywords which is much faster than a case-insensitive regex (or for
+    a topic with one keyword, checked for it as a substring which is faster still). The D-Portal
+    query that selects the topic's activities is made from the same rules.
+    """
+    matchers = dict()
+
+    def __init__(self, name, topic_configuration):
+        self.name = name
+        scopes = [[str(scope[key]) for key in ('type', 'vocabulary', 'code')]
+                  for scope in topic_configuration.get('humanitarian_scopes', ())]
+        tags = [[str(tag[key]) for key in ('vocabulary', 'code')] for tag in topic_configuration.get('tags', ())]
+        sectors = [[str(sector[key]) for key in ('vocabulary', 'code')]
+                   for sector in topic_configuration.get('sectors', ())]
+        keywords = [str(keyword) for keyword in topic_configuration.get('narratives', ())]
+        search_words = [str(word) for word in topic_configuration.get('search_words', ())]
+        self.scopes = frozenset((scope_type, vocabulary, code.upper()) for scope_type, vocabulary, code in scopes)
+        self.scope_vocabularies = frozenset(vocabulary for _, vocabulary, _ in scopes)
+        self.tags = frozenset((vocabulary, code.upper()) for vocabulary, code in tags)
+        self.tag_vocabularies = frozenset(vocabulary for vocabulary, _ in tags)
+        self.sectors = frozenset((vocabulary, code) for vocabulary, code in sectors)
+        self.sector_codes = frozenset(code for _, code in sectors)
+        self.narrative_keyword = None
+        self.narrative_regex = None
+        if len(keywords) == 1:
+            self.narrative_keyword = keywords[0].upper()
+        elif keywords:
+            self.narrative_regex = re.compile('|'.join(re.escape(keyword.upper()) for keyword in keywords))
+        self.dportal_query = self.make_dportal_query(scopes, tags, sectors, search_words)
+
+    def make_dportal_query(self, scopes, tags, sectors, search_words):
+        """ Make the D-Portal query for the topic which has placeholders for the shard and params """
+        conditions = list()
+        for scope_type, vocabulary, code in scopes:
+            conditions.append(f"root='{activity_root}/humanitarian-scope' AND xson->>'@type'={quote_sql(scope_type)} "
+                              f"AND xson->>'@vocabulary'={quote_sql(vocabulary)} AND "
+                              f"xson->>'@code'={quote_sql(code)}")
+        for vocabulary, code in tags:
+            conditions.append(f"root='{activity_root}/tag' AND xson->>'@vocabulary'={quote_sql(vocabulary)} AND "
+                              f"xson->>'@vocabulary-uri' IS NULL AND UPPER(xson->>'@code')={quote_sql(code.upper())}")
+        if search_words:
+            tsquery = quote_sql(' | '.join(search_words))
+            for path in search_narrative_paths:
+                conditions.append(f"root='{activity_root}/{path}/narrative' AND "
+                                  f"to_tsvector('simple', xson->>'') @@ to_tsquery('simple',{tsquery})")
+        for vocabulary, code in sectors:
+            vocabulary_condition = f"xson->>'@vocabulary'={quote_sql(vocabulary)}"
+            if vocabulary == default_sector_vocabulary:
+                vocabulary_condition = f"({vocabulary_condition} OR xson->>'@vocabulary'='' OR " \
+                                       f"xson->>'@vocabulary' IS NULL)"
+            for path in sector_paths:
+                conditions.append(f"root='{activity_root}/{path}' AND xson->>'@code'={quote_sql(code)} AND "
+                                  f"{vocabulary_condition}")
+        if not conditions:
+            raise ValueError(f'Topic {self.name} has no rules to select activities with!')
+        conditions = ' OR '.join(f'( {condition} )' for condition in conditions)
+        # Braces in the rules must not be taken as placeholders
+        return query_template.format(conditions.replace('{', '{{').replace('}', '}}'))
+
+    @classmethod
+    def setup(cls, topics_configuration):
+        cls.matchers = {name: cls(name, topic_configuration)
+                        for name, topic_configuration in topics_configuration.items()}
+
+    @classmethod
+    def get(cls, name):
+        matcher = cls.matchers.get(name)
+        if matcher is None:
+            raise ValueError(f'Topic {name} is not in the configuration!')
+        return matcher
+
+    def has_desired_scope(self, scopes):
+        """ Check if any of the topic's humanitarian scopes (eg. GLIDE number or HRP code) is present """
+        vocabularies = self.scope_vocabularies
+        if vocabularies:
+            for scope in scopes:
+                vocabulary = scope.vocabulary
+                if vocabulary in vocabularies and scope.code and \
+                        (scope.type, vocabulary, scope.code.upper()) in self.scopes:
+                    return True
+        return False
+
+    def has_desired_tag(self, tags):
+        """ Check if any of the topic's tags is present """
+        vocabularies = self.tag_vocabularies
+        if vocabularies:
+            for tag in tags:
+                vocabulary = tag.vocabulary
+                if vocabulary in vocabularies and tag.code and (vocabulary, tag.code.upper()) in self.tags:
+                    return True
+        return False
+
+    def has_desired_sector(self, sectors):
+        """ Check if any of the topic's sector codes is present """
+        codes = self.sector_codes
+        if codes:
+            for sector in sectors:
+                code = sector.code
+                if code in codes and (sector.vocabulary, code) in self.sectors:
+                    return True
+        return False
+
+    def is_desired_narrative(self, narratives):
+        """ Check a dict of different-language text for any of the topic's keywords (case-insensitive) """
+        keyword = self.narrative_keyword
+        if keyword is not None:
+            for text in narratives.values():
+                if keyword in text.upper():
+                    return True
+            return False
+        regex = self.narrative_regex
+        if regex is not None:
+            for text in narratives.values():
+                if regex.search(text.upper()):
+                    return True
+        return False
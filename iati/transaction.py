@@ -1,45 +1,88 @@
 # -*- coding: utf-8 -*-
-from hdx.location.currency import Currency
-from hdx.utilities.dateparse import parse_date
-
 from iati.calculatesplits import CalculateSplits
 from iati.lookups import Lookups
 
 
 class Transaction:
-    def __init__(self, transaction_type_info, dtransaction, value):
+    __slots__ = ('transaction_type_info', 'year_month', 'value', 'humanitarian', 'strict', 'country_splits',
+                 'sector_splits', 'provider_org', 'receiver_org', 'net_value', 'is_humanitarian', 'is_strict')
+
+    def __init__(self, transaction_type_info, dtransaction, value, activity, checks):
         """
-        Use the get_transaction static method to construct
+        Use the get_transactions static method to construct. Only the fields needed for
+        processing are copied from dtransaction so that it can be released afterwards.
         """
         self.transaction_type_info = transaction_type_info
-        self.dtransaction = dtransaction
         # Use date falling back on value-date
         if dtransaction.date:
             self.year_month = dtransaction.date[:7]
         else:
             self.year_month = dtransaction.value_date[:7]
         self.value = value
+        self.humanitarian = dtransaction.humanitarian
+        sectors = dtransaction.sectors
+        description = dtransaction.description
+        self.strict = True if (checks.has_desired_sector(sectors) or
+                               (description and checks.is_desired_narrative(description.narratives))) \
+            else False
+        # Make the splits for the transaction (default to activity splits)
+        self.country_splits, self.sector_splits = \
+            CalculateSplits.make_transaction_splits(dtransaction, activity.countryregion_splits, activity.sector_splits)
+        self.provider_org = None
+        self.receiver_org = None
+        if self.get_classification() == 'spending':
+            if self.get_direction() == 'incoming':
+                self.provider_org = Lookups.get_raw_org(dtransaction.provider_org)
+            else:
+                self.receiver_org = Lookups.get_raw_org(dtransaction.receiver_org)
+        self.net_value = None
+        self.is_humanitarian = None
+        self.is_strict = None
 
     @staticmethod
-    def get_transaction(configuration, dtransaction):
-        # We're not interested in transactions that have no value
-        if not dtransaction.value:
-            return None
-        # We're only interested in some transaction types
-        transaction_type_info = configuration['transaction_type_info'].get(dtransaction.type)
-        if not transaction_type_info:
-            return None
-        # We're not interested in transactions that can't be valued
-        try:
-            # Use value-date falling back on date
-            date = dtransaction.value_date
-            if not date:
-                date = dtransaction.date
-            # Convert the transaction value to USD
-            value = Currency.get_historic_value_in_usd(dtransaction.value, dtransaction.currency, parse_date(date))
-        except (ValueError, AttributeError):
-            return None
-        return Transaction(transaction_type_info, dtransaction, value)
+    def get_transactions(configuration, dtransactions, activity, context):
+        """
+        Construct transactions for an activity converting all their values to USD in one
+        batch with the checks of context recording skips into it. Returns the transactions
+        and the number skipped.
+        """
+        candidates = list()
+        conversions = list()
+        skipped = 0
+        for dtransaction in dtransactions:
+            # We're not interested in transactions that have no value
+            value = dtransaction.value
+            if not value:
+                context.record_skip('no_value', activity.reporting_org_ref)
+                skipped += 1
+                continue
+            # We're only interested in some transaction types
+            transaction_type_info = configuration['transaction_type_info'].get(dtransaction.type)
+            if not transaction_type_info:
+                context.record_skip('unknown_type', activity.reporting_org_ref)
+                skipped += 1
+                continue
+            try:
+                # Use value-date falling back on date
+                date = dtransaction.value_date
+                if not date:
+                    date = dtransaction.date
+                currency = dtransaction.currency
+            except (ValueError, AttributeError):
+                context.record_skip('invalid_date_or_currency', activity.reporting_org_ref)
+                skipped += 1
+                continue
+            candidates.append((transaction_type_info, dtransaction))
+            conversions.append((value, currency, date))
+        transactions = list()
+        # Convert the transaction values to USD. We're not interested in transactions that can't be valued
+        for (transaction_type_info, dtransaction), value in zip(candidates, context.get_values_in_usd(conversions)):
+            if value is None:
+                context.record_skip('fx_failure', activity.reporting_org_ref)
+                skipped += 1
+                continue
+            transactions.append(Transaction(transaction_type_info, dtransaction, value, activity, context.checks))
+        return transactions, skipped
 
     def get_label(self):
         return self.transaction_type_info['label']
@@ -50,19 +93,21 @@ class Transaction:
     def get_direction(self):
         return self.transaction_type_info['direction']
 
-    def process(self, today_year_month, activity):
+    def process(self, today_year_month, activity, context):
         if self.value:
             if (Lookups.filter_transaction_date and self.year_month < Lookups.filter_transaction_date) or self.year_month > today_year_month:
                 # Skip transactions with out-of-range months
+                context.record_skip('out_of_range_month', activity.reporting_org_ref)
                 return False
         else:
+            context.record_skip('no_value', activity.reporting_org_ref)
             return False
 
         # Set the net (new money) factors based on the type (commitments or spending)
         self.net_value = self.get_usd_net_value(activity.commitment_factor, activity.spending_factor)
         # transaction status defaults to activity
-        self.is_humanitarian = self.is_humanitarian(activity.humanitarian)
-        self.is_strict = self.is_strict(activity.strict)
+        self.is_humanitarian = self.get_humanitarian(activity.humanitarian)
+        self.is_strict = self.get_strict(activity.strict)
         return True
 
     def get_usd_net_value(self, commitment_factor, spending_factor):
@@ -74,33 +119,24 @@ class Transaction:
                 return self.value * spending_factor
         return None
 
-    def is_humanitarian(self, activity_humanitarian):
-        transaction_humanitarian = self.dtransaction.humanitarian
+    def get_humanitarian(self, activity_humanitarian):
+        transaction_humanitarian = self.humanitarian
         if transaction_humanitarian is None:
             is_humanitarian = activity_humanitarian
         else:
             is_humanitarian = transaction_humanitarian
         return 1 if is_humanitarian else 0
 
-    def is_strict(self, activity_strict):
-        is_strict = True if (Lookups.checks.has_desired_sector(self.dtransaction.sectors) or
-                             (self.dtransaction.description and
-                              Lookups.checks.is_desired_narrative(self.dtransaction.description.narratives))) else False
-        is_strict = is_strict or activity_strict
+    def get_strict(self, activity_strict):
+        is_strict = self.strict or activity_strict
         return 1 if is_strict else 0
 
-    def make_country_or_region_splits(self, activity_country_splits):
-        return CalculateSplits.make_country_or_region_splits(self.dtransaction, activity_country_splits)
-
-    def make_sector_splits(self, activity_sector_splits):
-        return CalculateSplits.make_sector_splits(self.dtransaction, activity_sector_splits)
-
-    def get_provider_receiver(self):
+    def get_provider_receiver(self, context):
         if self.get_direction() == 'incoming':
-            provider = Lookups.get_org_info(self.dtransaction.provider_org)
+            provider = context.get_raw_org_info(self.provider_org)
             receiver = {'id': '', 'name': '', 'type': ''}
         else:
             provider = {'id': '', 'name': '', 'type': ''}
             expenditure = self.get_label() == 'Expenditure'
-            receiver = Lookups.get_org_info(self.dtransaction.receiver_org, expenditure=expenditure)
+            receiver = context.get_raw_org_info(self.receiver_org, expenditure=expenditure)
         return provider, receiver
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+from iati.lookups import Lookups
+
+
+def none_first(value):
+    """ Sort key that puts None before any other value rather than failing to compare it """
+    return value is not None, value
+
+
+class TransactionColumns:
+    """
+    Accumulates split transactions column by column. Strings are stored as integer codes into
+    per column categories (in order of first appearance) so that a split transaction costs a
+    few bytes per column rather than a 12 element list. Iterating gives the output rows.
+    """
+    categorical_columns = ('year_month', 'org', 'sector', 'country', 'classification', 'identifier')
+    # The value and the column holding it for each position in an output row before the money
+    row_values = ('year_month', 'org_id', 'org_name', 'org_type', 'sector', 'country', 'humanitarian', 'strict',
+                  'classification', 'identifier')
+    row_columns = ('year_month', 'org', 'org', 'org', 'sector', 'country', 'humanitarian', 'strict',
+                   'classification', 'identifier')
+
+    def __init__(self):
+        self.categories = {column: dict() for column in self.categorical_columns}
+        self.columns = {column: array('i') for column in self.categorical_columns}
+        self.columns['humanitarian'] = array('b')
+        self.columns['strict'] = array('b')
+        self.columns['net_money'] = array('q')
+        self.columns['total_money'] = array('q')
+        self.splits_memo = dict()
+
+    def __len__(self):
+        return len(self.columns['total_money'])
+
+    def __getstate__(self):
+        # The memo is only useful to the process adding transactions
+        state = dict(self.__dict__)
+        state['splits_memo'] = dict()
+        return state
+
+    def get_code(self, column, value):
+        categories = self.categories[column]
+        code = categories.get(value)
+        if code is None:
+            code = len(categories)
+            categories[value] = code
+        return code
+
+    def get_splits(self, country_splits, sector_splits):
+        """ Get country code, country percentage, sector code and sector percentage for each
+        split. Most transactions take their splits from their activity so these are memoised.
+        """
+        key = tuple(country_splits.items()), tuple(sector_splits.items())
+        splits = self.splits_memo.get(key)
+        if splits is None:
+            splits = list()
+            for country, country_percentage in country_splits.items():
+                country_code = self.get_code('country', Lookups.get_country_region_name(country))
+                for sector, sector_percentage in sector_splits.items():
+                    sector_code = self.get_code('sector', Lookups.get_sector_group_name(sector))
+                    splits.append((country_code, country_percentage, sector_code, sector_percentage))
+            self.splits_memo[key] = splits
+        return splits
+
+    def get_activity_splits(self, transactions):
+        """ Get the splits of each of an activity's transactions. Transactions without splits of their
+        own share their activity's split dicts so splits are looked up once per pair of dicts.
+        """
+        activity_splits = dict()
+        for transaction in transactions:
+            country_splits = transaction.country_splits
+            sector_splits = transaction.sector_splits
+            key = id(country_splits), id(sector_splits)
+            splits = activity_splits.get(key)
+            if splits is None:
+                splits = self.get_splits(country_splits, sector_splits)
+                activity_splits[key] = splits
+            yield splits
+
+    def add_activity(self, org, identifier, transactions):
+        """ Apply the country and sector percentage splits to an activity's transactions adding the
+        splits that have non zero total money. The columns are extended once per activity.
+        """
+        year_months = list()
+        sectors = list()
+        countries = list()
+        humanitarians = list()
+        stricts = list()
+        classifications = list()
+        net_moneys = list()
+        total_moneys = list()
+        for transaction, splits in zip(transactions, self.get_activity_splits(transactions)):
+            year_month = self.get_code('year_month', transaction.year_month)
+            classification = self.get_code('classification', transaction.get_classification())
+            value = transaction.value
+            net_value = transaction.net_value
+            for country, country_percentage, sector, sector_percentage in splits:
+                total_money = int(round(value * country_percentage * sector_percentage))
+                if total_money == 0:
+                    continue
+                year_months.append(year_month)
+                sectors.append(sector)
+                countries.append(country)
+                humanitarians.append(transaction.is_humanitarian)
+                stricts.append(transaction.is_strict)
+                classifications.append(classification)
+                net_moneys.append(int(round(net_value * country_percentage * sector_percentage)))
+                total_moneys.append(total_money)
+        no_splits = len(total_moneys)
+        if no_splits == 0:
+            return
+        columns = self.columns
+        columns['year_month'].extend(year_months)
+        org_code = self.get_code('org', (org['id'], org['name'], org['type']))
+        columns['org'].extend([org_code] * no_splits)
+        columns['sector'].extend(sectors)
+        columns['country'].extend(countries)
+        columns['humanitarian'].extend(humanitarians)
+        columns['strict'].extend(stricts)
+        columns['classification'].extend(classifications)
+        columns['identifier'].extend([self.get_code('identifier', identifier)] * no_splits)
+        columns['net_money'].extend(net_moneys)
+        columns['total_money'].extend(total_moneys)
+
+    def add_rows(self, rows):
+        """ Append split transactions given as output rows (eg. from an activity store) """
+        columns = self.columns
+        get_code = self.get_code
+        for year_month, org_id, org_name, org_type, sector, country, humanitarian, strict, classification, \
+                identifier, net_money, total_money in rows:
+            columns['year_month'].append(get_code('year_month', year_month))
+            columns['org'].append(get_code('org', (org_id, org_name, org_type)))
+            columns['sector'].append(get_code('sector', sector))
+            columns['country'].append(get_code('country', country))
+            columns['humanitarian'].append(humanitarian)
+            columns['strict'].append(strict)
+            columns['classification'].append(get_code('classification', classification))
+            columns['identifier'].append(get_code('identifier', identifier))
+            columns['net_money'].append(net_money)
+            columns['total_money'].append(total_money)
+
+    def extend(self, other):
+        """ Append the split transactions of another accumulator (eg. from another process) """
+        for column, other_column in other.columns.items():
+            if column in self.categories:
+                codes = [self.get_code(column, value) for value in other.categories[column]]
+                self.columns[column].extend([codes[code] for code in other_column])
+            else:
+                self.columns[column].extend(other_column)
+
+    def get_ranks(self, column):
+        """ Get a mapping from the codes or values in a column to their position in sort order and the
+        number of positions. Equal sort keys get equal ranks. Orgs are sorted by name then type.
+        """
+        if column not in self.categories:
+            values = sorted(set(self.columns[column]))
+            return {value: rank for rank, value in enumerate(values)}, len(values)
+        if column == 'org':
+            keys = [(none_first(name), none_first(org_type)) for _, name, org_type in self.categories[column]]
+        else:
+            keys = [none_first(value) for value in self.categories[column]]
+        rank_of_key = {key: rank for rank, key in enumerate(sorted(set(keys)))}
+        return [rank_of_key[key] for key in keys], len(rank_of_key)
+
+    def sort(self):
+        """ Sort the split transactions into output order. Each row gets one integer key made from the
+        ranks of its sort columns and the columns are permuted by a stable sort on those keys.
+        """
+        columns = self.columns
+        year_month_ranks, _ = self.get_ranks('year_month')
+        org_ranks, no_orgs = self.get_ranks('org')
+        sector_ranks, no_sectors = self.get_ranks('sector')
+        country_ranks, no_countries = self.get_ranks('country')
+        classification_ranks, no_classifications = self.get_ranks('classification')
+        identifier_ranks, no_identifiers = self.get_ranks('identifier')
+        net_money_ranks, no_net_moneys = self.get_ranks('net_money')
+        sort_keys = [(((((((year_month_ranks[year_month] * no_orgs + org_ranks[org])
+                            * no_sectors + sector_ranks[sector])
+                           * no_countries + country_ranks[country])
+                          * 2 + humanitarian)
+                         * 2 + strict)
+                        * no_classifications + classification_ranks[classification])
+                       * no_identifiers + identifier_ranks[identifier])
+                      * no_net_moneys + net_money_ranks[net_money]
+                     for year_month, org, sector, country, humanitarian, strict, classification, identifier, net_money
+                     in zip(columns['year_month'], columns['org'], columns['sector'], columns['country'],
+                            columns['humanitarian'], columns['strict'], columns['classification'],
+                            columns['identifier'], columns['net_money'])]
+        order = sorted(range(len(sort_keys)), key=sort_keys.__getitem__)
+        del sort_keys
+        for column, values in columns.items():
+            columns[column] = array(values.typecode, [values[i] for i in order])
+
+    def rollup(self, fields):
+        """ Sum net and total money grouping by the fields (positions in an output row before the money)
+        returning rows of the field values followed by net and total money sorted by the field values.
+        Grouping is done on the column codes so no rows are built until the groups are known.
+        """
+        columns = [self.row_columns[field] for field in fields]
+        group_columns = list(dict.fromkeys(columns))
+        net_moneys = dict()
+        total_moneys = dict()
+        for key, net_money, total_money in zip(zip(*(self.columns[column] for column in group_columns)),
+                                               self.columns['net_money'], self.columns['total_money']):
+            net_moneys[key] = net_moneys.get(key, 0) + net_money
+            total_moneys[key] = total_moneys.get(key, 0) + total_money
+        categories = {column: list(self.categories[column]) for column in group_columns if column in self.categories}
+        rows = list()
+        for key, net_money in net_moneys.items():
+            values = dict()
+            for column, code in zip(group_columns, key):
+                if column == 'org':
+                    values['org_id'], values['org_name'], values['org_type'] = categories['org'][code]
+                elif column in categories:
+                    values[column] = categories[column][code]
+                else:
+                    values[column] = code
+            row = [values[self.row_values[field]] for field in fields]
+            row.append(net_money)
+            row.append(total_moneys[key])
+            rows.append(row)
+        rows.sort(key=lambda row: [none_first(value) for value in row[:len(fields)]])
+        return rows
+
+    def __iter__(self):
+        categories = {column: list(self.categories[column]) for column in self.categorical_columns}
+        columns = self.columns
+        year_months = categories['year_month']
+        orgs = categories['org']
+        sectors = categories['sector']
+        countries = categories['country']
+        classifications = categories['classification']
+        identifiers = categories['identifier']
+        for year_month, org, sector, country, humanitarian, strict, classification, identifier, net_money, \
+                total_money in zip(columns['year_month'], columns['org'], columns['sector'], columns['country'],
+                                   columns['humanitarian'], columns['strict'], columns['classification'],
+                                   columns['identifier'], columns['net_money'], columns['total_money']):
+            org_id, org_name, org_type = orgs[org]
+            yield [year_months[year_month], org_id, org_name, org_type, sectors[sector], countries[country],
+                   humanitarian, strict, classifications[classification], identifiers[identifier], net_money,
+                   total_money]
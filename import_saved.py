@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Imports saved D-Portal pages (the dportal_{n}.xml files of saved_data_covid etc. saved by --save
+without a page store) into a compressed page store in the same folder that --use_saved reads.
+
+    python import_saved.py saved_data_covid --compression zstd --delete
+"""
+import argparse
+import logging
+from time import perf_counter
+
+from hdx.utilities.easy_logging import setup_logging
+
+from iati.pagestore import PageStore
+
+setup_logging()
+logger = logging.getLogger()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Import saved D-Portal pages into a page store')
+    parser.add_argument('saved_dirs', nargs='+', help='Saved data folders to import')
+    parser.add_argument('-p', '--pattern', default='dportal_*.xml', help='Filename pattern of saved pages')
+    parser.add_argument('-c', '--compression', default='gzip', choices=('gzip', 'zstd'),
+                        help='Compression (zstd needs zstandard)')
+    parser.add_argument('-l', '--level', default=None, type=int, help='Compression level')
+    parser.add_argument('-d', '--delete', default=False, action='store_true',
+                        help='Delete the saved pages once the page store has been verified')
+    return parser.parse_args()
+
+
+def main(saved_dirs, pattern, compression, level, delete):
+    for saved_dir in saved_dirs:
+        start_time = perf_counter()
+        no_pages = PageStore.import_folder(saved_dir, pattern, compression, level, delete)
+        logger.info(f'Imported {no_pages} pages into {saved_dir} in {perf_counter() - start_time:.2f}s')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.saved_dirs, args.pattern, args.compression, args.level, args.delete)
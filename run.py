@@ -2,9 +2,8 @@
 import argparse
 import logging
 from datetime import datetime
-from os import getenv, mkdir
+from os import getenv, makedirs
 from os.path import join
-from shutil import rmtree
 
 from hdx.facades.keyword_arguments import facade
 from hdx.hdx_configuration import Configuration
@@ -12,7 +11,10 @@ from hdx.utilities.downloader import Download
 from hdx.utilities.easy_logging import setup_logging
 from hdx.utilities.retriever import Retrieve
 
-from iati.main import start
+from iati.asyncretriever import AsyncDownload, AsyncRetrieve
+from iati.main import start, start_topics
+from iati.outputs import remove_stale_outputs
+from iati.pagestore import parse_pages
 
 setup_logging()
 logger = logging.getLogger()
@@ -31,22 +33,73 @@ def parse_args():
     parser.add_argument('-sv', '--save', default=False, action='store_true', help='Save downloaded data')
     parser.add_argument('-usv', '--use_saved', default=False, action='store_true', help='Use saved data')
     parser.add_argument('-dp', '--dportal_params', default='', help='Parameters for DPortal query (eg. limit X, offset Y')
-    parser.add_argument('-wh', '--what', default='covid', help='What to run eg. covid, ebola')
+    parser.add_argument('-wh', '--what', default='covid',
+                        help='What to run eg. covid, ebola or covid,ebola to run several topics in one pass')
     parser.add_argument('-df', '--date_filter', default='2020-01', help='Start date of date filter')
+    parser.add_argument('-pr', '--processes', default=1, type=int, help='Number of processes to use for processing activities')
+    parser.add_argument('-is', '--incremental_store', default=None, help='Activity store to use for incremental runs')
+    parser.add_argument('-ls', '--lookups_snapshot', default=None, help='Snapshot of prepared lookups to start from')
+    parser.add_argument('-off', '--offline', default=False, action='store_true',
+                        help='Take filters from lookups snapshot instead of downloading them')
+    parser.add_argument('-st', '--stats_dir', default=None,
+                        help='Folder to save run_stats.json to (not the output folder which is published)')
+    parser.add_argument('-pf', '--profile', default=False, action='store_true',
+                        help='Profile each stage of the run saving pstats files to the stats folder')
+    parser.add_argument('-rp', '--replay_pages', default=None,
+                        help='Saved pages to use with --use_saved (eg. 0-2,5) instead of all of them')
     args = parser.parse_args()
     return args
 
 
-def main(output_dir, saved_dir, save, use_saved, dportal_params, whattorun, filterdate, **ignore):
+def get_downloader(configuration):
+    """ Get a Download and the Retrieve class to use with it or, if async_retriever is configured, an AsyncDownload
+    and AsyncRetrieve
+    """
+    async_configuration = configuration.get('async_retriever')
+    if async_configuration is None:
+        return Download(), Retrieve
+    return AsyncDownload(**async_configuration), AsyncRetrieve
+
+
+def main(output_dir, saved_dir, save, use_saved, dportal_params, whattorun, filterdate, processes, incremental_store,
+         lookups_snapshot, offline, profile, replay_pages, stats_dir, **ignore):
     logger.info('##### hdx-scraper-iati-viz version %.1f ####' % VERSION)
     configuration = Configuration.read()
+    if replay_pages and not use_saved:
+        raise ValueError('Can only replay pages when using saved data!')
+    if profile and not stats_dir:
+        raise ValueError('Can only profile when saving run stats to a stats folder!')
+    if stats_dir:
+        makedirs(stats_dir, exist_ok=True)
+    replay_pages = parse_pages(replay_pages) if replay_pages else None
+    topics = whattorun.split(',')
+    if len(topics) > 1:
+        if incremental_store:
+            raise ValueError('Cannot use an incremental store when running several topics!')
+        output_dirs = dict()
+        for topic in topics:
+            output_dirs[topic] = f'{output_dir}_{topic}'
+            makedirs(output_dirs[topic], exist_ok=True)
+            remove_stale_outputs(output_dirs[topic], configuration['outputs'])
+        downloader, retrieve_class = get_downloader(configuration)
+        with downloader:
+            retrievers = {topic: retrieve_class(downloader, configuration['fallback_dir'], f'{saved_dir}_{topic}',
+                                          output_dirs[topic], save, use_saved) for topic in topics}
+            today = datetime.utcnow().isoformat()
+            start_topics(configuration, today, retrievers, output_dirs, dportal_params, filterdate, processes,
+                         lookups_snapshot, offline, profile, replay_pages, stats_dir)
+        return
     output_dir = f'{output_dir}_{whattorun}'
-    rmtree(output_dir, ignore_errors=True)
-    mkdir(output_dir)
-    with Download() as downloader:
-        retriever = Retrieve(downloader, configuration['fallback_dir'], f'{saved_dir}_{whattorun}', output_dir, save, use_saved)
+    makedirs(output_dir, exist_ok=True)
+    remove_stale_outputs(output_dir, configuration['outputs'])
+    downloader, retrieve_class = get_downloader(configuration)
+    with downloader:
+        retriever = retrieve_class(downloader, configuration['fallback_dir'], f'{saved_dir}_{whattorun}', output_dir, save, use_saved)
         today = datetime.utcnow().isoformat()
-        start(configuration, today, retriever, output_dir, dportal_params, whattorun, filterdate)
+        if incremental_store:
+            incremental_store = f'{incremental_store}_{whattorun}.db'
+        start(configuration, today, retriever, output_dir, dportal_params, whattorun, filterdate, processes,
+              incremental_store, lookups_snapshot, offline, profile, replay_pages, stats_dir)
 
 
 if __name__ == '__main__':
@@ -65,4 +118,6 @@ if __name__ == '__main__':
     facade(main, hdx_read_only=True, user_agent=user_agent, preprefix=preprefix, hdx_site=hdx_site,
            project_config_yaml=join('config', 'project_configuration.yml'), output_dir=args.output_dir,
            saved_dir=args.saved_dir, save=args.save, use_saved=args.use_saved, dportal_params=args.dportal_params,
-           whattorun=args.what, filterdate=args.date_filter)
+           whattorun=args.what, filterdate=args.date_filter, processes=args.processes,
+           incremental_store=args.incremental_store, lookups_snapshot=args.lookups_snapshot, offline=args.offline,
+           profile=args.profile, replay_pages=args.replay_pages, stats_dir=args.stats_dir)
@@ -1,15 +1,157 @@
+import csv
 import filecmp
+import gzip
+import json
+import pstats
+import random
+import re
+from functools import partial
+from html import unescape
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir, makedirs, stat
 from os.path import join
+from shutil import copyfile
+from threading import Thread
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
 
+import diterator
 import pytest
 from hdx.hdx_configuration import Configuration
 from hdx.hdx_locations import Locations
+from hdx.location.country import Country
 from hdx.utilities.compare import assert_files_same
-from hdx.utilities.downloader import Download
+from hdx.utilities.downloader import Download, DownloadError
+from hdx.utilities.loader import load_json
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_str_to_file
 
-from iati.main import start
+from iati import outputs
+from iati.activity import Activity
+from iati.activitystore import ActivityStore
+from iati.asyncretriever import AsyncDownload, AsyncRetrieve
+from iati.calculatesplits import CalculateSplits
+from iati.dportal import (copy_retriever, get_activity_sort_key, get_rate_limiter, join_activities, retrieve_dportal,
+                          retrieve_dportal_topics, split_activities)
+from iati.lookups import Lookups
+from iati.main import start, start_topics
+from iati.pagestore import PageStore, parse_pages
+from iati.runstats import RunStats
+from iati.skipledger import SkipLedger
+from iati.stringcleaner import StringCleaner
+from iati.topicmatcher import TopicMatcher
+from iati.transactioncolumns import TransactionColumns
+
+
+def reference_clean_string(s):
+    # clean_string as it was before StringCleaner
+    s = re.sub(r'(\W)\1+', r'\1', s.strip())
+    s = re.sub(r'\s', ' ', s)
+    s = re.sub(r'^\W?([\w &]*)[^a-zA-Z0-9_\.]?$', r'\1', s)
+    return s.strip()
+
+
+class DPortalHandler(BaseHTTPRequestHandler):
+    """ Serves the fixture pages as a stand-in for D-Portal, using the OFFSET in the sql query to pick the page """
+    def __init__(self, *args, fixtures_dir=None, limit=None, **kwargs):
+        self.fixtures_dir = fixtures_dir
+        self.limit = limit
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        sql = parse_qs(urlsplit(self.path).query)['sql'][0]
+        n = int(re.search(r'OFFSET (\d+)', sql).group(1)) // self.limit
+        if n > 4:
+            n = 4
+        with open(join(self.fixtures_dir, f'dportal_{n}.xml'), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FlakyDPortalHandler(DPortalHandler):
+    """ DPortalHandler over keep-alive connections that fails the first request for each page with a 503 and
+    records the client port of each request. Paths that aren't D-Portal queries are not found.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, failed=None, ports=None, **kwargs):
+        self.failed = failed
+        self.ports = ports
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.ports.add(self.client_address[1])
+        if 'sql=' not in self.path:
+            self.send_error(404)
+            return
+        if self.path not in self.failed:
+            self.failed.add(self.path)
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+class ShardedDPortalHandler(BaseHTTPRequestHandler):
+    """ Serves the fixture activities split into shards as a stand-in for D-Portal, using the HAVING predicate in
+    the sql query to pick the shard and the OFFSET to pick the page. Activities within a page are not in order.
+    """
+    def __init__(self, *args, shard_pages=None, failing=None, requests=None, **kwargs):
+        self.shard_pages = shard_pages
+        self.failing = failing
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        sql = parse_qs(urlsplit(self.path).query)['sql'][0]
+        predicate = re.search(r'HAVING (.*) ORDER BY', sql).group(1)
+        self.requests.append(predicate)
+        if predicate in self.failing:
+            self.send_error(500)
+            return
+        pages = self.shard_pages[predicate]
+        n = int(re.search(r'LIMIT (\d+) OFFSET (\d+)', sql).group(2)) // int(re.search(r'LIMIT (\d+)', sql).group(1))
+        if n < len(pages):
+            body = pages[n]
+        else:
+            body = '{"result":[]}'
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SplitTransaction:
+    """ The fields of a processed Transaction that TransactionColumns uses """
+    def __init__(self, year_month, value, net_value, is_humanitarian, is_strict, classification, country_splits,
+                 sector_splits):
+        self.year_month = year_month
+        self.value = value
+        self.net_value = net_value
+        self.is_humanitarian = is_humanitarian
+        self.is_strict = is_strict
+        self.classification = classification
+        self.country_splits = country_splits
+        self.sector_splits = sector_splits
+
+    def get_classification(self):
+        return self.classification
 
 
 class TestIATI:
@@ -18,25 +160,585 @@ class TestIATI:
         Configuration._create(hdx_read_only=True, hdx_site='prod', user_agent='test',
                               project_config_yaml=join('tests', 'config', 'project_configuration.yml'))
         Locations.set_validlocations([{'name': 'afg', 'title': 'Afghanistan'}, {'name': 'pse', 'title': 'State of Palestine'}])
-        return Configuration.read()
+        configuration = Configuration.read()
+        TopicMatcher.setup(configuration['topics'])
+        return configuration
 
     @pytest.fixture(scope='class')
     def fixtures_dir(self):
         return join('tests', 'fixtures')
 
-    def test_run(self, configuration, fixtures_dir):
+    @pytest.fixture(scope='function')
+    def dportal_url(self, fixtures_dir):
+        handler = partial(DPortalHandler, fixtures_dir=fixtures_dir, limit=100)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield f'http://127.0.0.1:{server.server_port}/dquery?form=xml&sql=%s'
+        server.shutdown()
+        server.server_close()
+
+    def test_retrieve_dportal_concurrently(self, configuration, fixtures_dir, dportal_url):
+        dportal_configuration = dict(configuration['dportal'])
+        dportal_configuration.update({'url': dportal_url, 'limit': 100, 'workers': 3, 'max_in_flight': 4})
+        with temp_dir('TestIATIVizDPortal', delete_on_success=True, delete_on_failure=False) as tempdir:
+            with Download(user_agent='test', rate_limit={'calls': 100, 'period': 60}) as downloader:
+                retriever = Retrieve(downloader, tempdir, tempdir, tempdir, save=True, use_saved=False)
+                rate_limiter = get_rate_limiter(downloader)
+                paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid', tempdir))
+                assert paths == [join(tempdir, f'dportal_{n}.xml') for n in range(4)]
+                # The threads' copies of the downloader count towards its rate limit
+                assert get_rate_limiter(copy_retriever(retriever).downloader) is rate_limiter
+                assert rate_limiter.num_calls >= 5
+                for n, path in enumerate(paths):
+                    assert filecmp.cmp(join(fixtures_dir, f'dportal_{n}.xml'), path, shallow=False)
+                retriever = Retrieve(downloader, tempdir, tempdir, tempdir, save=False, use_saved=True)
+                saved_paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid',
+                                                    tempdir))
+                assert saved_paths == paths
+
+    def test_async_retriever(self, configuration, fixtures_dir):
+        pytest.importorskip('aiohttp')
+        failed = set()
+        ports = set()
+        handler = partial(FlakyDPortalHandler, fixtures_dir=fixtures_dir, limit=100, failed=failed, ports=ports)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        dportal_configuration = dict(configuration['dportal'])
+        dportal_configuration.update({'url': f'http://127.0.0.1:{server.server_port}/dquery?form=xml&sql=%s',
+                                      'limit': 100, 'max_in_flight': 4})
+        try:
+            with temp_dir('TestIATIVizAsync', delete_on_success=True, delete_on_failure=False) as tempdir:
+                with AsyncDownload(user_agent='test', limit_per_host=2, retries=2, backoff_factor=0.01) as downloader:
+                    retriever = AsyncRetrieve(downloader, tempdir, tempdir, tempdir, save=True, use_saved=False)
+                    paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid',
+                                                  tempdir))
+                    assert paths == [join(tempdir, f'dportal_{n}.xml') for n in range(4)]
+                    for n, path in enumerate(paths):
+                        assert filecmp.cmp(join(fixtures_dir, f'dportal_{n}.xml'), path, shallow=False)
+                    # Every page failed once and was retried over the same kept-alive connections
+                    assert downloader.retried >= len(paths) + 1
+                    assert len(ports) <= 2
+                    retried = downloader.retried
+                    missing_url = f'http://127.0.0.1:{server.server_port}/missing'
+                    with pytest.raises(DownloadError):
+                        retriever.retrieve_text(missing_url, 'missing.txt')
+                    assert downloader.retried == retried
+                    save_str_to_file('fallback', join(tempdir, 'missing.txt'))
+                    assert retriever.retrieve_text(missing_url, 'missing.txt', fallback=True) == 'fallback'
+                    retriever = AsyncRetrieve(downloader, tempdir, tempdir, tempdir, save=False, use_saved=True)
+                    saved_paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid',
+                                                        tempdir))
+                    assert saved_paths == paths
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_page_store(self, configuration, fixtures_dir, dportal_url):
+        pytest.importorskip('zstandard')
+        dportal_configuration = dict(configuration['dportal'])
+        dportal_configuration.update({'url': dportal_url, 'limit': 100, 'saved_store': {'compression': 'gzip'}})
+        fixture_paths = [join(fixtures_dir, f'dportal_{n}.xml') for n in range(4)]
+        with temp_dir('TestIATIVizPageStore', delete_on_success=True, delete_on_failure=False) as tempdir:
+            saved_dir = join(tempdir, 'saved')
+            folder = join(tempdir, 'pages')
+            makedirs(folder)
+            with Download(user_agent='test') as downloader:
+                retriever = Retrieve(downloader, tempdir, saved_dir, tempdir, save=True, use_saved=False)
+                paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid', folder))
+            assert paths == [join(folder, f'dportal_{n}.xml') for n in range(4)]
+            assert sorted(listdir(saved_dir)) == [PageStore.data_filename, PageStore.index_filename]
+            with PageStore(saved_dir) as store:
+                assert [(page['page'], page['filename']) for page in store.pages] == \
+                    [(n, f'dportal_{n}.xml') for n in range(4)]
+                with open(fixture_paths[2], encoding='utf-8') as f:
+                    assert store.pages[2]['activities'] == len(split_activities(f.read())[1])
+                store.verify()
+            retriever = Retrieve(None, tempdir, saved_dir, tempdir, save=False, use_saved=True)
+            paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid', folder))
+            for path, fixture_path in zip(paths, fixture_paths):
+                assert filecmp.cmp(fixture_path, path, shallow=False)
+            assert parse_pages('1, 3-3') == {1, 3}
+            paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid', folder,
+                                          parse_pages('1, 3-3')))
+            assert paths == [join(folder, 'dportal_1.xml'), join(folder, 'dportal_3.xml')]
+            assert filecmp.cmp(fixture_paths[3], paths[1], shallow=False)
+            # Pages saved as files are imported leaving out the empty last page
+            import_dir = join(tempdir, 'import')
+            makedirs(import_dir)
+            for n in range(5):
+                copyfile(join(fixtures_dir, f'dportal_{n}.xml'), join(import_dir, f'dportal_{n}.xml'))
+            assert PageStore.import_folder(import_dir, compression='zstd', delete=True) == 4
+            assert sorted(listdir(import_dir)) == [PageStore.data_filename, PageStore.index_filename]
+            retriever = Retrieve(None, tempdir, import_dir, tempdir, save=False, use_saved=True)
+            paths = list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid', folder))
+            assert len(paths) == 4
+            for path, fixture_path in zip(paths, fixture_paths):
+                assert filecmp.cmp(fixture_path, path, shallow=False)
+
+    def test_retrieve_dportal_sharded(self, configuration, fixtures_dir):
+        limit = 40
+        shards = {"aid < 'G'": lambda aid: aid < 'G', "aid >= 'G' AND aid < 'U'": lambda aid: 'G' <= aid < 'U',
+                  "aid >= 'U'": lambda aid: aid >= 'U'}
+        header = None
+        activities = list()
+        for n in range(4):
+            with open(join(fixtures_dir, f'dportal_{n}.xml'), encoding='utf-8') as f:
+                header, page_activities = split_activities(f.read())
+            activities.extend(page_activities)
+        activities = sorted(activities, key=get_activity_sort_key)
+        shard_pages = dict()
+        for predicate, in_shard in shards.items():
+            shard_activities = [activity for activity in activities if in_shard(get_activity_sort_key(activity)[2][1])]
+            assert shard_activities
+            shard_pages[predicate] = [join_activities(header, shard_activities[i:i + limit][::-1])
+                                      for i in range(0, len(shard_activities), limit)]
+        failing = {"aid >= 'U'"}
+        requests = list()
+        handler = partial(ShardedDPortalHandler, shard_pages=shard_pages, failing=failing, requests=requests)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        with temp_dir('TestIATIVizDPortalShards', delete_on_success=True, delete_on_failure=False) as tempdir:
+            dportal_configuration = dict(configuration['dportal'])
+            dportal_configuration.update({'url': f'http://127.0.0.1:{server.server_port}/dquery?form=xml&sql=%s',
+                                          'limit': limit, 'workers': 2, 'shards': list(shards),
+                                          'shards_folder': join(tempdir, 'shards')})
+            try:
+                with Download(user_agent='test', status_forcelist=[]) as downloader:
+                    retriever = Retrieve(downloader, tempdir, tempdir, tempdir, save=False, use_saved=False)
+                    with pytest.raises(DownloadError):
+                        list(retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid', tempdir))
+                    manifest = load_json(join(tempdir, 'shards_covid', 'manifest.json'))
+                    assert {shard: len(paths) for shard, paths in manifest['completed'].items()} == \
+                        {str(i): len(shard_pages[predicate]) for i, predicate in enumerate(shards)
+                         if predicate not in failing}
+                    failing.clear()
+                    del requests[:]
+                    texts = list()
+                    for path in retrieve_dportal({'dportal': dportal_configuration}, retriever, None, 'covid',
+                                                 tempdir):
+                        with open(path, encoding='utf-8') as f:
+                            texts.append(f.read())
+            finally:
+                server.shutdown()
+                server.server_close()
+            # Only the shard that failed is downloaded again
+            assert set(requests) == {"aid >= 'U'"}
+            assert texts == [join_activities(header, activities[i:i + limit])
+                             for i in range(0, len(activities), limit)]
+
+    def test_retrieve_dportal_topics(self, configuration, fixtures_dir):
+        limit = 150
+        dportal_configuration = dict(configuration['dportal'], limit=limit)
+        # covid has fixture pages 0 and 1 and ebola has pages 1 and 2 so page 1 is in both
+        topic_pages = {'covid': (0, 1), 'ebola': (1, 2)}
+        with temp_dir('TestIATIVizDPortalTopics', delete_on_success=True, delete_on_failure=False) as tempdir:
+            with Download(user_agent='test') as downloader:
+                retrievers = dict()
+                for topic, pages in topic_pages.items():
+                    saved_dir = join(tempdir, f'saved_{topic}')
+                    makedirs(saved_dir)
+                    for n, page in enumerate(pages + (4,)):
+                        copyfile(join(fixtures_dir, f'dportal_{page}.xml'), join(saved_dir, f'dportal_{n}.xml'))
+                    retrievers[topic] = Retrieve(downloader, tempdir, saved_dir, tempdir, save=False, use_saved=True)
+                activity_topics = dict()
+                page_keys = list()
+                topic_keys = dict()
+                folder = join(tempdir, 'pages')
+                makedirs(folder)
+                texts = list()
+                for path in retrieve_dportal_topics({'dportal': dportal_configuration}, retrievers, None, folder,
+                                                    activity_topics, page_keys, topic_keys):
+                    with open(path, encoding='utf-8') as f:
+                        texts.append(f.read())
+        activities = list()
+        expected_topics = list()
+        page_activity_keys = dict()
+        for page, topics in ((0, ('covid',)), (1, ('covid', 'ebola')), (2, ('ebola',))):
+            with open(join(fixtures_dir, f'dportal_{page}.xml'), encoding='utf-8') as f:
+                header, page_activities = split_activities(f.read())
+            activities.extend(page_activities)
+            expected_topics.extend([topics] * len(page_activities))
+            page_activity_keys[page] = [get_activity_sort_key(activity) for activity in page_activities]
+        assert texts == [join_activities(header, activities[i:i + limit]) for i in range(0, len(activities), limit)]
+        assert [activity_topics[key] for keys in page_keys for key in keys] == expected_topics
+        for topic, pages in topic_pages.items():
+            assert topic_keys[topic] == [key for page in pages for key in page_activity_keys[page]]
+
+    def test_clean_string(self, fixtures_dir):
+        corpus = ['', ' ', 'Oxfam  GB', ' UNICEF ', 'A&B', '...Org..', 'Org.', 'Org,', '"Org"', 'Org\t\nName',
+                  'Ministère de la Santé ', 'Org -- Name', '__init__', '1234', 'ＵＮＩＣＥＦ', 'Org (UK)']
+        for filename in ('IATIOrganisationIdentifier.json', 'Region.json'):
+            for entry in load_json(join('data', filename))['data']:
+                corpus.append(entry['code'])
+                corpus.append(entry['name'])
+                corpus.append(f'  {entry["name"]}.. ')
+        for n in range(4):
+            with open(join(fixtures_dir, f'dportal_{n}.xml'), encoding='utf-8') as f:
+                corpus.extend(unescape(x) for x in re.findall(r'<narrative[^>]*>([^<]*)</narrative>', f.read()))
+        StringCleaner.setup(max_memo_size=100)
+        for _ in range(2):
+            for s in corpus:
+                assert StringCleaner.clean(s) == reference_clean_string(s), s
+        assert len(StringCleaner.memo) == 100
+        assert StringCleaner.hits > 0
+
+    def test_transaction_columns(self):
+        Country.countriesdata(use_live=False)
+        Lookups.sector_info = {'121': {'dac-group': 'Health'}, '720': {'dac-group': 'Emergency Response'}}
+        Lookups.default_sector = '(Unspecified sector)'
+        Lookups.region_code_to_name = {'998': 'Developing countries, unspecified'}
+        Lookups.default_country_region = '(Unspecified country)'
+        Lookups.setup_split_names()
+        assert [Lookups.get_country_region_name(code) for code in ('AF', '998', 'XX')] == \
+            ['Afghanistan', 'Developing countries, unspecified (no country specified)', '(Unspecified country)']
+        assert [Lookups.get_sector_group_name(code) for code in ('12191', '72010', '15110')] == \
+            ['Health', 'Emergency Response', '(Unspecified sector)']
+        random.seed(1)
+        orgs = [{'id': 'xm-dac-41114', 'name': 'UNDP', 'type': '40'}, {'id': 'gb-gov-1', 'name': 'FCDO', 'type': '10'},
+                {'id': 'gb-chc-202918', 'name': 'Oxfam GB', 'type': '21'}, {'id': '', 'name': 'FCDO', 'type': None}]
+        country_splits = [{'AF': 1.0}, {'PS': 0.3, 'AF': 0.7}, {'998': 0.5, 'XX': 0.5}]
+        sector_splits = [{'12191': 1.0}, {'72010': 0.25, '121': 0.75}, {'(Unspecified sector)': 1.0}]
+        accumulators = [TransactionColumns(), TransactionColumns()]
+        expected_rows = [list(), list()]
+        for n in range(100):
+            org = random.choice(orgs)
+            identifier = f'activity-{random.randint(1, 50)}'
+            transactions = list()
+            for _ in range(random.randint(0, 10)):
+                value = random.choice((0.4, 1.0, random.uniform(-1E6, 1E7)))
+                transaction = SplitTransaction(f'2020-{random.randint(1, 12):02d}', value,
+                                               value * random.choice((0.0, 0.5, 1.0)), random.randint(0, 1),
+                                               random.randint(0, 1), random.choice(('commitments', 'spending')),
+                                               random.choice(country_splits), random.choice(sector_splits))
+                transactions.append(transaction)
+            accumulators[n % 2].add_activity(org, identifier, transactions)
+            for transaction in transactions:
+                for country, country_percentage in transaction.country_splits.items():
+                    for sector, sector_percentage in transaction.sector_splits.items():
+                        total_money = int(round(transaction.value * country_percentage * sector_percentage))
+                        if total_money != 0:
+                            net_money = int(round(transaction.net_value * country_percentage * sector_percentage))
+                            expected_rows[n % 2].append([
+                                transaction.year_month, org['id'], org['name'], org['type'],
+                                Lookups.get_sector_group_name(sector), Lookups.get_country_region_name(country),
+                                transaction.is_humanitarian, transaction.is_strict, transaction.classification,
+                                identifier, net_money, total_money])
+        transactions = TransactionColumns()
+        for accumulator in accumulators:
+            transactions.extend(accumulator)
+        expected = expected_rows[0] + expected_rows[1]
+        assert list(transactions) == expected
+        transactions.sort()
+        expected.sort(key=lambda x: (x[0], x[2], x[3] or '', x[4], x[5], x[6], x[7], x[8], x[9], x[10]))
+        assert list(transactions) == expected
+        for fields in ((0, 5), (4, 0), (1, 2, 3, 6, 7), (3, 8)):
+            expected_rollup = dict()
+            for row in expected:
+                key = tuple(row[field] for field in fields)
+                net_money, total_money = expected_rollup.get(key, (0, 0))
+                expected_rollup[key] = net_money + row[10], total_money + row[11]
+            expected_rollup = sorted(([*key, *money] for key, money in expected_rollup.items()),
+                                     key=lambda x: [(y is not None, y) for y in x[:len(fields)]])
+            assert transactions.rollup(fields) == expected_rollup
+
+    def test_calculate_splits(self):
+        CalculateSplits.setup({'default_sector': '(Unspecified sector)',
+                               'default_country_region': '(Unspecified country)'})
+        xml = b'''<iati-activities><iati-activity><iati-identifier>XM-1</iati-identifier>
+<recipient-country code="af" percentage="60"/><recipient-country code="SO" percentage="40"/>
+<recipient-region code="998" vocabulary="2"/><sector code="12191" vocabulary="1"/>
+<sector code="121" vocabulary="2" percentage="50"/><sector code="720" vocabulary="2" percentage="50"/>
+<transaction><value>1</value></transaction>
+<transaction><value>2</value><recipient-region code="998" vocabulary="1"/><sector code="15110"/></transaction>
+<transaction><value>3</value><recipient-country code="KE"/><sector code="15110" vocabulary="1"/></transaction>
+</iati-activity></iati-activities>'''
+        dactivity = next(iter(diterator.XMLIterator(BytesIO(xml))))
+        country_splits, sector_splits = CalculateSplits.make_activity_splits(dactivity)
+        assert country_splits == {'AF': 0.6, 'SO': 0.4}
+        assert sector_splits == {'121': 0.5, '720': 0.5}
+        splits = [CalculateSplits.make_transaction_splits(dtransaction, country_splits, sector_splits)
+                  for dtransaction in dactivity.transactions]
+        # Transactions without their own share their activity's splits, a transaction with only regions has its
+        # activity's countries too and sectors without vocabulary 1 give the activity's sector splits
+        assert splits[0][0] is country_splits and splits[0][1] is sector_splits
+        assert splits[1] == ({'AF': 0.6, 'SO': 0.4, '998': 1.0}, sector_splits)
+        assert splits[2] == ({'KE': 1.0}, {'15110': 1.0})
+
+    def test_lookups_snapshot(self, configuration):
+        with temp_dir('TestIATIVizSnapshot', delete_on_success=True, delete_on_failure=False) as tempdir:
+            lookups_configuration = dict(configuration['lookups'])
+            del lookups_configuration['filters_url']
+            del lookups_configuration['blocklist_url']
+            config_dir = join('tests', 'config')
+            lookups_configuration['filters_file'] = join(config_dir, 'IATI Explorer Filters - Skipped Activities.csv')
+            lookups_configuration['blocklist_file'] = join(config_dir, 'IATI Explorer Filters - Spurious References.csv')
+            snapshot_path = join(tempdir, 'lookups.json')
+            with pytest.raises(ValueError):
+                Lookups.setup(lookups_configuration, snapshot_path, offline=True)
+            Lookups.setup(lookups_configuration, snapshot_path)
+            expected = {key: getattr(Lookups, key) for key in ('org_ref_to_name', 'org_names_to_ref', 'sector_info',
+                                                               'region_code_to_name')}
+            expected['filters'] = Lookups.filters.rules
+            assert Lookups.load_snapshot(snapshot_path, Lookups.get_snapshot_sources(lookups_configuration))
+            for offline in (False, True):
+                Lookups.setup(lookups_configuration, snapshot_path, offline)
+                for key in ('org_ref_to_name', 'org_names_to_ref', 'sector_info', 'region_code_to_name'):
+                    assert getattr(Lookups, key) == expected[key]
+                assert Lookups.filters.rules == expected['filters']
+            # A snapshot whose sources have changed or whose checksum doesn't match is not used
+            sources = Lookups.get_snapshot_sources(lookups_configuration)
+            changed_configuration = dict(lookups_configuration)
+            changed_configuration['default_sector'] = '(Unknown sector)'
+            assert Lookups.load_snapshot(snapshot_path, Lookups.get_snapshot_sources(changed_configuration)) is None
+            with open(snapshot_path, encoding='utf-8') as f:
+                text = f.read()
+            with open(snapshot_path, 'w', encoding='utf-8') as f:
+                f.write(text.replace('"org_ref_to_name":{', '"org_ref_to_name":{"a":"b",'))
+            assert Lookups.load_snapshot(snapshot_path, sources) is None
+
+    def test_write(self, configuration, monkeypatch):
+        monkeypatch.setattr(outputs, 'write_batch_size', 2)
+        outputs_configuration = {'orgs': dict(configuration['outputs']['orgs'])}
+        rows = [('xm-org-1', 'Org "One", Ltd'), ('xm-org-2', 'Org Two'), ('xm-org-3', 'Orgué Three')]
+        expected_csv = 'Reporting org id,Reporting org name\n#org+id+reporting,#org+name+reporting\n' \
+                       'xm-org-1,"Org ""One"", Ltd"\nxm-org-2,Org Two\nxm-org-3,Orgué Three\n'
+        expected_json = '{"metadata":{"#date+run":"2021-05-06","#meta+orgs+num":3},"data":[\n' + \
+                        ',\n'.join(json.dumps({'#org+id+reporting': org_id, '#org+name+reporting': name},
+                                               separators=(',', ':')) for org_id, name in rows) + ']}'
+        with temp_dir('TestIATIVizWrite', delete_on_success=True, delete_on_failure=False) as tempdir:
+            csv_path = join(tempdir, 'reporting_orgs.csv')
+            json_path = join(tempdir, 'reporting_orgs.json')
+            outputs.write('2021-05-06', tempdir, outputs_configuration, 'orgs', rows)
+            with open(csv_path, encoding='utf-8') as f:
+                assert f.read() == expected_csv
+            with open(json_path, encoding='utf-8') as f:
+                assert f.read() == expected_json
+            # Unchanged outputs are left untouched
+            inode = stat(csv_path).st_ino
+            json_inode = stat(json_path).st_ino
+            outputs.write('2021-05-06', tempdir, outputs_configuration, 'orgs', rows)
+            assert stat(csv_path).st_ino == inode
+            assert stat(json_path).st_ino == json_inode
+            # The run date is left out of the comparison
+            outputs.write('2021-05-07', tempdir, outputs_configuration, 'orgs', rows)
+            assert stat(csv_path).st_ino == inode
+            assert stat(json_path).st_ino == json_inode
+            outputs.write('2021-05-06', tempdir, outputs_configuration, 'orgs', rows[:2])
+            assert stat(csv_path).st_ino != inode
+            outputs_configuration['orgs']['csv'] = {'filename': 'reporting_orgs.csv', 'gzip': True}
+            outputs_configuration['orgs']['json'] = {'filename': 'reporting_orgs.json', 'gzip': True}
+            outputs.write('2021-05-06', tempdir, outputs_configuration, 'orgs', rows)
+            with gzip.open(f'{csv_path}.gz', 'rt', encoding='utf-8') as f:
+                assert f.read() == expected_csv
+            with gzip.open(f'{json_path}.gz', 'rt', encoding='utf-8') as f:
+                assert f.read() == expected_json
+            inode = stat(f'{json_path}.gz').st_ino
+            outputs.write('2021-05-07', tempdir, outputs_configuration, 'orgs', rows)
+            assert stat(f'{json_path}.gz').st_ino == inode
+
+    def test_write_parquet(self, configuration, monkeypatch):
+        pyarrow = pytest.importorskip('pyarrow')
+        parquet = pytest.importorskip('pyarrow.parquet')
+        monkeypatch.setattr(outputs, 'write_batch_size', 2)
+        outputs_configuration = {'transactions': dict(configuration['outputs']['transactions'])}
+        outputs_configuration['transactions']['parquet'] = {'filename': 'transactions.parquet'}
+        rows = [['2020-01', 'xm-org-1', 'Org One', None, 'Health', 'Afghanistan', 1, 0, 'spending', 'act-1', 10, 20],
+                ['2020-01', 'xm-org-2', 'Org Two', '10', 'Health', 'Yemen', 0, 1, 'commitments', 'act-2', 0, 5],
+                ['2020-02', 'xm-org-1', 'Org One', None, 'Education', 'Afghanistan', 1, 1, 'spending', 'act-1', -3,
+                 7]]
+        with temp_dir('TestIATIVizParquet', delete_on_success=True, delete_on_failure=False) as tempdir:
+            outputs.write('2021-05-06', tempdir, outputs_configuration, 'transactions', rows, 4)
+            table = parquet.read_table(join(tempdir, 'transactions.parquet'))
+            assert json.loads(table.schema.metadata[b'metadata']) == \
+                {'#date+run': '2021-05-06', '#meta+transactions+num': 3, '#meta+transactions+skipped+num': 4}
+            assert pyarrow.types.is_dictionary(table.schema.field('#org+name').type)
+            with open(join(tempdir, 'transactions.csv'), encoding='utf-8') as f:
+                csv_rows = list(csv.reader(f))
+            assert csv_rows[1] == table.column_names
+            parquet_rows = [['' if value is None else str(value) for value in row]
+                            for row in zip(*(table.column(hxltag).to_pylist() for hxltag in table.column_names))]
+            assert parquet_rows == csv_rows[2:]
+
+    def test_run_stats(self):
+        with temp_dir('TestIATIVizRunStats', delete_on_success=True, delete_on_failure=False) as tempdir:
+            stats = RunStats(tempdir, profile=True)
+            with stats.stage('write flows'):
+                assert list(stats.timed('download', range(3))) == [0, 1, 2]
+            stats.add_counts(activities=2, transactions=5)
+            stats.add_counts(activities=1)
+            stats.save()
+            run_stats = load_json(join(tempdir, 'run_stats.json'))
+            assert list(run_stats['stages']) == ['download', 'write flows']
+            assert run_stats['stages']['download'] <= run_stats['stages']['write flows'] <= run_stats['total_seconds']
+            assert run_stats['counts'] == {'activities': 3, 'transactions': 5}
+            assert run_stats['peak_rss_bytes']['main'] > 0
+            assert pstats.Stats(join(tempdir, 'profile_write_flows.pstats')).total_calls > 0
+
+    def test_skip_ledger(self):
+        partial_counts = dict()
+        SkipLedger.record(partial_counts, 'out_of_range_month', 'XM-DAC-41114')
+        SkipLedger.record(partial_counts, 'secondary_reporter', 'KR-GOV-010', 3, 1)
+        counts = dict()
+        SkipLedger.record(counts, 'no_net_value', 'XM-DAC-41114')
+        SkipLedger.record(counts, 'out_of_range_month', 'XM-DAC-41114')
+        SkipLedger.record(counts, 'no_value', None)
+        SkipLedger.merge_counts(counts, partial_counts)
+        assert SkipLedger.get_rows(counts) == [['', 'no_value', 0, 1], ['KR-GOV-010', 'secondary_reporter', 1, 3],
+                                               ['XM-DAC-41114', 'out_of_range_month', 0, 2],
+                                               ['XM-DAC-41114', 'no_net_value', 0, 1]]
+        totals = SkipLedger.get_totals(counts)
+        assert list(totals) == list(SkipLedger.reasons)
+        assert sum(no_transactions for _, no_transactions in totals.values()) == 7
+        assert totals['secondary_reporter'] == [1, 3]
+
+    def test_topic_matcher(self, configuration):
+        covid = TopicMatcher.get('covid')
+        ebola = TopicMatcher.get('ebola')
+        scope = SimpleNamespace(type='2', vocabulary='2-1', code='hcovd20')
+        assert covid.has_desired_scope([SimpleNamespace(type='1', vocabulary='1-2', code=None), scope])
+        assert not ebola.has_desired_scope([scope])
+        assert covid.has_desired_tag([SimpleNamespace(vocabulary='99', code='Covid-19')])
+        assert not covid.has_desired_tag([SimpleNamespace(vocabulary='98', code='COVID-19')])
+        assert covid.has_desired_sector([SimpleNamespace(vocabulary='1', code='12264')])
+        assert not ebola.has_desired_sector([SimpleNamespace(vocabulary='1', code='12264')])
+        assert covid.is_desired_narrative({'en': 'Health', 'fr': 'Réponse à la covid-19'})
+        assert not covid.is_desired_narrative({'en': 'Ebola response'})
+        assert ebola.is_desired_narrative({'en': 'Ebola response'})
+        query = covid.dportal_query.format('LIMIT 10 OFFSET 0', shard='')
+        assert "xson->>'@code'='HCOVD20'" in query
+        assert "to_tsquery('simple','COVID | CORONAVIRUS')" in query
+        assert query.endswith("GROUP BY aid ORDER BY max(xson->>'@iati-activities:generated-datetime'), "
+                              "max(xson->>'@last-updated-datetime'), aid LIMIT 10 OFFSET 0 )")
+        with pytest.raises(ValueError):
+            TopicMatcher('empty', {'narratives': ['EMPTY']})
+
+    @staticmethod
+    def check_outputs(fixtures_dir, tempdir):
+        for filename in ('flows', 'transactions', 'reporting_orgs', 'skipped'):
+            csv_filename = f'{filename}.csv'
+            expected_file = join(fixtures_dir, csv_filename)
+            actual_file = join(tempdir, csv_filename)
+            assert_files_same(expected_file, actual_file)
+            json_filename = f'{filename}.json'
+            expected_file = join(fixtures_dir, json_filename)
+            actual_file = join(tempdir, json_filename)
+            assert filecmp.cmp(expected_file, actual_file)
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_run(self, configuration, fixtures_dir, processes):
         with temp_dir('TestIATIViz', delete_on_success=True, delete_on_failure=False) as tempdir:
             with Download(user_agent='test') as downloader:
                 retriever = Retrieve(downloader, tempdir, fixtures_dir, tempdir, save=False, use_saved=True)
                 today = '2021-05-06'
-                start(configuration, today, retriever, tempdir, dportal_params=None, whattorun='covid', filterdate='2020-01')
-                for filename in ('flows', 'transactions', 'reporting_orgs'):
-                    csv_filename = f'{filename}.csv'
-                    expected_file = join(fixtures_dir, csv_filename)
-                    actual_file = join(tempdir, csv_filename)
-                    assert_files_same(expected_file, actual_file)
-                    json_filename = f'{filename}.json'
-                    expected_file = join(fixtures_dir, json_filename)
-                    actual_file = join(tempdir, json_filename)
-                    assert filecmp.cmp(expected_file, actual_file)
+                start(configuration, today, retriever, tempdir, dportal_params=None, whattorun='covid', filterdate='2020-01',
+                      processes=processes)
+                self.check_outputs(fixtures_dir, tempdir)
+
+    def test_run_unchanged(self, configuration, fixtures_dir):
+        with temp_dir('TestIATIVizUnchanged', delete_on_success=True, delete_on_failure=False) as tempdir:
+            output_dir = join(tempdir, 'output')
+            makedirs(output_dir)
+            save_str_to_file('stale', join(output_dir, 'transactions_month_country.csv'))
+            with Download(user_agent='test') as downloader:
+                retriever = Retrieve(downloader, tempdir, fixtures_dir, tempdir, save=False, use_saved=True)
+                inodes = None
+                # Outputs that are the same as the last run's are left untouched even though the run date changes
+                for today in ('2021-05-06T01:02:03', '2021-05-07T04:05:06'):
+                    outputs.remove_stale_outputs(output_dir, configuration['outputs'])
+                    start(configuration, today, retriever, output_dir, dportal_params=None, whattorun='covid',
+                          filterdate='2020-01')
+                    filenames = sorted(listdir(output_dir))
+                    assert filenames == sorted(outputs.get_output_filenames(configuration['outputs']))
+                    if inodes is None:
+                        inodes = {filename: stat(join(output_dir, filename)).st_ino for filename in filenames}
+                assert {filename: stat(join(output_dir, filename)).st_ino for filename in filenames} == inodes
+                with open(join(output_dir, 'flows.json'), encoding='utf-8') as f:
+                    assert json.loads(f.readline()[:-len(',"data":[\n')] + '}')['metadata']['#date+run'] == \
+                        '2021-05-06T01:02:03'
 
+    def test_run_incremental(self, configuration, fixtures_dir, monkeypatch):
+        with temp_dir('TestIATIVizIncremental', delete_on_success=True, delete_on_failure=False) as tempdir:
+            with Download(user_agent='test') as downloader:
+                retriever = Retrieve(downloader, tempdir, fixtures_dir, tempdir, save=False, use_saved=True)
+                store_path = join(tempdir, 'activities.db')
+                # The first run fills the activity store and the second reuses it
+                for processes, reused in ((1, 0), (2, 400)):
+                    run_stats = start(configuration, '2021-05-06', retriever, tempdir, dportal_params=None,
+                                      whattorun='covid', filterdate='2020-01', processes=processes,
+                                      incremental_store=store_path)
+                    assert run_stats['counts']['reused_activities'] == reused
+                    self.check_outputs(fixtures_dir, tempdir)
+                # Reused activities are not built again
+                built = list()
+                get_activity = Activity.get_activity
+
+                def get_activity_counted(configuration, dactivity, context):
+                    built.append(dactivity.identifier)
+                    return get_activity(configuration, dactivity, context)
+
+                monkeypatch.setattr(Activity, 'get_activity', staticmethod(get_activity_counted))
+                run_stats = start(configuration, '2021-05-06', retriever, tempdir, dportal_params=None,
+                                  whattorun='covid', filterdate='2020-01', incremental_store=store_path)
+                assert run_stats['counts']['reused_activities'] == 400
+                assert built == list()
+                self.check_outputs(fixtures_dir, tempdir)
+                # A contribution that used an fx rate that has since changed is recomputed
+                store = ActivityStore(store_path)
+                identifier, last_updated, contribution = next(
+                    row for row in store.connection.execute('SELECT * FROM contributions')
+                    if json.loads(row[2])['fx_rates'])
+                contribution = json.loads(contribution)
+                contribution['fx_rates'][0][2][0] *= 2
+                store.put([((identifier, last_updated), contribution)])
+                store.close()
+                run_stats = start(configuration, '2021-05-06', retriever, tempdir, dportal_params=None,
+                                  whattorun='covid', filterdate='2020-01', incremental_store=store_path)
+                assert run_stats['counts']['reused_activities'] == 399
+                assert built == [identifier]
+                self.check_outputs(fixtures_dir, tempdir)
+
+    def test_run_topics(self, configuration, fixtures_dir):
+        # ebola has every third covid activity so it is a strict subset of covid. Whichever topic comes first,
+        # the outputs of each topic must be the same as from a run of the topic alone.
+        with temp_dir('TestIATIVizTopics', delete_on_success=True, delete_on_failure=False) as tempdir:
+            saved_dirs = {'covid': fixtures_dir, 'ebola': join(tempdir, 'saved_ebola')}
+            makedirs(saved_dirs['ebola'])
+            copyfile(join(fixtures_dir, 'currentrates.json'), join(saved_dirs['ebola'], 'currentrates.json'))
+            activities = list()
+            for n in range(4):
+                with open(join(fixtures_dir, f'dportal_{n}.xml'), encoding='utf-8') as f:
+                    header, page_activities = split_activities(f.read())
+                activities.extend(page_activities)
+            activities = activities[::3]
+            for n, i in enumerate(range(0, len(activities), 100)):
+                save_str_to_file(join_activities(header, activities[i:i + 100]),
+                                 join(saved_dirs['ebola'], f'dportal_{n}.xml'))
+            copyfile(join(fixtures_dir, 'dportal_4.xml'), join(saved_dirs['ebola'], f'dportal_{n + 1}.xml'))
+            with Download(user_agent='test') as downloader:
+                ebola_dir = join(tempdir, 'ebola')
+                makedirs(ebola_dir)
+                retriever = Retrieve(downloader, tempdir, saved_dirs['ebola'], tempdir, save=False, use_saved=True)
+                ebola_stats = start(configuration, '2021-05-06', retriever, ebola_dir, dportal_params=None,
+                                    whattorun='ebola', filterdate='2020-01')
+                assert ebola_stats['counts']['activities'] == len(activities)
+                for topics, processes in ((('covid', 'ebola'), 2), (('ebola', 'covid'), 1)):
+                    run_dir = join(tempdir, '_'.join(topics))
+                    retrievers = dict()
+                    output_dirs = dict()
+                    for topic in topics:
+                        output_dirs[topic] = join(run_dir, topic)
+                        makedirs(output_dirs[topic])
+                        retrievers[topic] = Retrieve(downloader, tempdir, saved_dirs[topic], tempdir, save=False,
+                                                     use_saved=True)
+                    run_stats = start_topics(configuration, '2021-05-06', retrievers, output_dirs, None, '2020-01',
+                                             processes=processes, stats_dir=run_dir)
+                    self.check_outputs(fixtures_dir, output_dirs['covid'])
+                    self.check_outputs(ebola_dir, output_dirs['ebola'])
+                    # Run stats are kept out of the output folders which are published
+                    assert RunStats.filename not in listdir(output_dirs['covid'])
+                    assert load_json(join(run_dir, RunStats.filename))['counts'] == run_stats['counts']
+                    assert run_stats['counts']['activities'] == 400
+                    topic_counts = run_stats['counts']['topics']
+                    assert topic_counts['covid']['transactions'] == 879
+                    assert topic_counts['ebola'] == {key: ebola_stats['counts'][key] for key in topic_counts['ebola']}